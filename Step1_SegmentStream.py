@@ -50,11 +50,17 @@ import gc
 import time
 import traceback
 from datetime import timedelta
-from math import ceil, atan2, degrees
+from math import ceil
 from operator import itemgetter
+import numpy as np
 import arcpy
 from arcpy import env
 
+import projections
+import raster_blocks
+import raster_cache
+import stream_nodes
+
 env.overwriteOutput = True
 
 # ----------------------------------------------------------------------
@@ -113,84 +119,72 @@ def create_node_list(streamline_fc, checkDirection, z_raster):
     nodeID = 0
     # Determine input projection and spatial units
     proj = arcpy.Describe(streamline_fc).spatialReference
-    con_from_m = from_meters_con(streamline_fc)
     con_to_m = to_meters_con(streamline_fc)
 
-    # Pull the stream IDs into a list
+    # Pull the stream IDs and OBJECTIDs into a list
     sid_list = []
-    with arcpy.da.SearchCursor(streamline_fc, sid_field,"",proj) as Inrows:
+    oid_list = []
+    with arcpy.da.SearchCursor(streamline_fc, [sid_field, "OID@"],"",proj) as Inrows:
         for row in Inrows:
             sid_list.append(row[0])
+            oid_list.append(row[1])
+
+    # Check for missing stream IDs
+    nulls = stream_nodes.find_null_ids(sid_list, oid_list)
+    if nulls:
+        arcpy.AddError("There are features without a stream ID. "+
+                       "OBJECTID {0}".format(nulls))
+        sys.exit("There are features without a stream ID in your input "+
+                 "stream feature class."+
+                 "\nHere are the OBJECTIDs:  \n"+
+                 "{0}".format(nulls))
 
     # Check for duplicate stream IDs
-    dups = list(set([i for i in sid_list if sid_list.count(i) > 1]))
+    dups = stream_nodes.find_duplicate_ids(sid_list, oid_list)
     if dups:
+        arcpy.AddError("There are duplicate stream IDs in your input stream "+
+                       "feature class.\n"+
+                       stream_nodes.format_duplicate_ids(dups))
         sys.exit("There are duplicate stream IDs in your input stream"+
                  "feature class."+
                  "\nHere are the duplicates:  \n"+
-                 "{0}".format(dups))
+                 stream_nodes.format_duplicate_ids(dups))
+
+    if checkDirection is True:
+        flips = check_stream_direction(streamline_fc, z_raster, proj)
 
     # Now create the nodes. I'm pulling the fc data twice because on
     # speed tests it is faster compared to saving all the incursorFields
     # to a list and iterating over the list
     arcpy.AddMessage("Creating Nodes")
     print("Creating Nodes")
+    arcpy.SetProgressor("step", "Creating Nodes", 0, len(sid_list), 1)
     with arcpy.da.SearchCursor(streamline_fc, incursorFields,"",proj) as Inrows:
         for row in Inrows:
             lineLength = row[1]  # These units are in the units of projection
-            numNodes = int(lineLength * con_to_m / node_dx)
-            nodes = range(0,numNodes+1)
-            mid = range(0,numNodes)
 
             if checkDirection is True:
-                flip = check_stream_direction(row[0], z_raster, row[2])
+                flip = flips[row[2]]
             else:
                 flip = 1
-            arcpy.SetProgressor("step", "Creating Nodes", 0, numNodes+1, 1)
-            # list of percentage of feature length to traverse
-            positions = [n * node_dx * con_from_m / lineLength for n in nodes]
-            segment_length = [node_dx] * numNodes + [lineLength * con_to_m % node_dx]
-            mid_distance = node_dx * con_from_m / lineLength
-            if mid_distance > 1:
-                # this situation occurs when the stream < node_dx.
-                # The azimith is calculated for the entire stream line.
-                mid_distance = 1
-
-            i = 0
-            for position in positions:
-                node = row[0].positionAlongLine(abs(flip - position),
-                                                True).centroid
-                # Get the coordinates at the up/down midway point along
-                # the line between nodes and calculate the stream azimuth
-                if position == 0.0:
-                    mid_up = row[0].positionAlongLine(
-                        abs(flip - (position + mid_distance)),True).centroid
-                    mid_down = node
-                elif 0.0 < position + mid_distance < 1:
-                    mid_up = row[0].positionAlongLine(
-                        abs(flip - (position + mid_distance)),True).centroid
-                    mid_down = row[0].positionAlongLine(
-                        abs(flip - (position - mid_distance)),True).centroid
-                else:
-                    mid_up = node
-                    mid_down = row[0].positionAlongLine(
-                        abs(flip - (position - mid_distance)),True).centroid
-
-                stream_azimuth = degrees(atan2((mid_down.X - mid_up.X),
-                                               (mid_down.Y - mid_up.Y)))
-                if stream_azimuth < 0:
-                    stream_azimuth = stream_azimuth + 360
-
-                # list of "NODE_ID","STREAM_ID". "STREAM_KM", "LENGTH",
-                # "POINT_X","POINT_Y", "STREAM_AZMTH", "SHAPE@X", "SHAPE@Y"
-                nodeList.append([nodeID, row[2],
-                                 float(position * lineLength * con_to_m /1000),
-                                 segment_length[i],
-                                 node.X, node.Y, stream_azimuth, node.X, node.Y])
+
+            # Read the vertices once and place all the nodes on the line
+            xy, parts = stream_nodes.line_vertices(row[0])
+            (stream_km, segment_length, node_x, node_y,
+             stream_azimuth) = stream_nodes.stream_nodes(xy, parts, lineLength,
+                                                         node_dx, con_to_m, flip)
+
+            # list of "NODE_ID","STREAM_ID". "STREAM_KM", "LENGTH",
+            # "POINT_X","POINT_Y", "STREAM_AZMTH", "SHAPE@X", "SHAPE@Y"
+            for i in range(len(stream_km)):
+                nodeList.append([nodeID, row[2], float(stream_km[i]),
+                                 float(segment_length[i]),
+                                 float(node_x[i]), float(node_y[i]),
+                                 float(stream_azimuth[i]),
+                                 float(node_x[i]), float(node_y[i])])
                 nodeID = nodeID + 1
-                i = i + 1
 
-        arcpy.SetProgressorPosition()
+            arcpy.SetProgressorPosition()
 
     arcpy.ResetProgressor()
     return(nodeList)
@@ -229,44 +223,89 @@ def create_nodes_fc(nodeList, nodes_fc, sid_field, proj):
             arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "",
                                       "", "NULLABLE", "NON_REQUIRED")
 
+    # Change X/Y from input spatial units to decimal degrees for all
+    # the nodes at once before they are written
+    to_geographic = projections.transform_for(proj)
+    if to_geographic is not None:
+        x = np.array([row[7] for row in nodeList], dtype=float)
+        y = np.array([row[8] for row in nodeList], dtype=float)
+        lon, lat = to_geographic(x, y)
+        for row, lon_i, lat_i in zip(nodeList, lon.tolist(), lat.tolist()):
+            row[4] = lon_i # LONGITUDE
+            row[5] = lat_i # LATITUDE
+
     with arcpy.da.InsertCursor(nodes_fc, cursorfields + ["SHAPE@X","SHAPE@Y"]) as cursor:
         for row in nodeList:
             cursor.insertRow(row)
 
-    #Change X/Y from input spatial units to decimal degrees
-    proj_dd = arcpy.SpatialReference(4326) # GCS_WGS_1984
-    with arcpy.da.UpdateCursor(nodes_fc,["SHAPE@X","SHAPE@Y","LONGITUDE",
-                                         "LATITUDE"],"",proj_dd) as cursor:
-        for row in cursor:
-            row[2] = row[0] # LONGITUDE
-            row[3] = row[1] # LATITUDE
-            cursor.updateRow(row)
-
-def check_stream_direction(stream, z_raster, streamID):
-    """Samples the elevation raster at both ends of the stream
-    polyline to see which is the downstream end and returns flip = 1
-    if the stream km need to be reversed"""
-
-    down = stream.positionAlongLine(0,True).centroid
-    up = stream.positionAlongLine(1,True).centroid
-
-    # when a single raster cell is sampled it is a little faster to
-    # use arcpy compared to converting to an array and then sampling.
-    # I left the code just in case though
-    z_down = float(arcpy.GetCellValue_management (z_raster, str(down.X)+ " "+ str(down.Y),1).getOutput(0))
-    z_up = float(arcpy.GetCellValue_management (z_raster, str(up.X) + " "+ str(up.Y),1).getOutput(0))
-    #z_down = arcpy.RasterToNumPyArray(z_raster, arcpy.Point(down.X, down.Y), 1, 1, -9999)[0][0]
-    #z_up = arcpy.RasterToNumPyArray(z_raster, arcpy.Point(up.X, up.Y), 1, 1, -9999)[0][0]
-
-    if z_down <= z_up or z_down == -9999 or z_up == -9999:
-        # do not reverse stream km
-        flip = 0
-    else:
-        print("Reversing {0}".format(streamID))
-        # reversed stream km
-        flip = 1
-
-    return flip
+    if to_geographic is None:
+        # projection not supported by projections.py, use arcpy
+        arcpy.AddMessage("Calculating LONGITUDE/LATITUDE with arcpy")
+        proj_dd = arcpy.SpatialReference(4326) # GCS_WGS_1984
+        with arcpy.da.UpdateCursor(nodes_fc,["SHAPE@X","SHAPE@Y","LONGITUDE",
+                                             "LATITUDE"],"",proj_dd) as cursor:
+            for row in cursor:
+                row[2] = row[0] # LONGITUDE
+                row[3] = row[1] # LATITUDE
+                cursor.updateRow(row)
+
+def check_stream_direction(streamline_fc, z_raster, proj):
+    """Samples the elevation raster at both ends of every stream
+    polyline to see which is the downstream end and returns a
+    dictionary of stream ID to flip = 1 if the stream km need to be
+    reversed"""
+
+    arcpy.AddMessage("Checking stream direction")
+    print("Checking stream direction")
+
+    # gather all the endpoints first
+    sids = []
+    xy = []
+    with arcpy.da.SearchCursor(streamline_fc, ["SHAPE@", sid_field],"",proj) as Inrows:
+        for row in Inrows:
+            down = row[0].firstPoint
+            up = row[0].lastPoint
+            sids.append(row[1])
+            xy.extend([(down.X, down.Y), (up.X, up.Y)])
+    xy = np.array(xy, dtype=float)
+
+    # sample them with one array per 5 km block
+    block_size = 5000 * from_meters_con(streamline_fc)
+    z = sample_raster_points(z_raster, xy[:, 0], xy[:, 1], block_size)
+    flips = stream_nodes.stream_flips(z[0::2], z[1::2])
+
+    for streamID, flip in zip(sids, flips):
+        if flip == 1:
+            print("Reversing {0}".format(streamID))
+
+    return dict(zip(sids, flips.tolist()))
+
+def sample_raster_points(z_raster, x, y, block_size):
+    """Returns the raster value at each x/y coordinate. The points are
+    grouped into blocks with raster_blocks.plan_blocks() and each block
+    array is read once. Points outside the raster are -9999"""
+
+    # Get the raster properties once for all the blocks
+    z_info = raster_blocks.describe_raster(z_raster)
+    tile_cache = raster_cache.TileCache(None)
+
+    z = np.full(len(x), -9999.0)
+    extents, members = raster_blocks.plan_blocks(x, y, block_size)
+    for extent, member in zip(extents, members):
+        # a cell more so points on the block edge are in the array
+        block = (extent[0] - z_info.x_cellsize, extent[1] - z_info.y_cellsize,
+                 extent[2] + z_info.x_cellsize, extent[3] + z_info.y_cellsize)
+
+        # block extent snapped to the raster cell corners, cells outside
+        # the raster are -9999. Note returned array is (row, col) so (y, x)
+        z_array, block_x_min, block_y_max = tile_cache.read_block(z_info, block)
+        rows, cols = raster_blocks.array_row_col(x[member], y[member],
+                                                 block_x_min, block_y_max,
+                                                 z_info.x_cellsize,
+                                                 z_info.y_cellsize)
+        z[member] = z_array[rows, cols]
+
+    return z
 
 def to_meters_con(inFeature):
     """Returns the conversion factor to get from the
@@ -8,12 +8,30 @@
 # 1: Right Bank feature class(rb_fc)
 # 2: Left Bank feature class(lb_fc)
 # 3: True/False flag if existing data can be over written (overwrite_data)
+# 4: OPTIONAL field in the bank feature classes with the STREAM_ID of
+#    the stream each bank belongs to (bank_sid_field). If not set each
+#    bank feature is assigned to the stream with the nearest centerline.
+# 5: OPTIONAL output point feature class of the nearest bank point to
+#    each node for QA (bank_points_fc)
+# 6: OPTIONAL channel width method (width_method), NEAREST (default) or
+#    TRANSECT. NEAREST measures from the node to the nearest point on
+#    each bank. TRANSECT measures along the transect perpendicular to
+#    the stream azimuth (STRM_AZMTH from Step 1) to where it crosses each
+#    bank. Nodes where the transect does not cross a bank within
+#    TRANSECT_MAX meters use NEAREST.
+# 7: OPTIONAL number of processes to measure the streams in parallel
+#    (processes), default 1 measures them in this process, 0 uses every
+#    core
 
 # OUTPUTS
 # 0: point feature class (edit nodes_fc) with the following fields added:
 #    CHANWIDTH - distance in meters between left and right banks
 #    LEFT - distance in meters from centerline to left bank feature
 #    RIGHT - distance in meters from centerline to right bank feature
+#    WIDTH_MTHD - the method used to measure the node, NEAREST or TRANSECT
+# 1: OPTIONAL point feature class (bank_points_fc) with the nearest left
+#    and right bank point measured from each node:
+#    NODE_ID, STREAM_ID, BANK (LEFT or RIGHT), DISTANCE
 
 # Future Updates
 # eliminate arcpy and use gdal for reading/writing feature class data
@@ -25,15 +43,21 @@
 
 # Import system modules
 from __future__ import division, print_function
+import os
 import sys
 import gc
 import time
 import traceback
+import multiprocessing
 from datetime import timedelta
 import arcpy
 from arcpy import env
 from math import ceil
 from collections import defaultdict
+import numpy as np
+
+import bank_index
+import node_table
 
 def str_to_bool(s):
     if s == 'True':
@@ -49,12 +73,30 @@ def str_to_bool(s):
 #rb_fc = parameters[1].valueAsText
 #lb_fc = parameters[2].valueAsText
 #overwrite_data = parameters[3].valueAsText
+#bank_sid_field = parameters[4].valueAsText
+#bank_points_fc = parameters[5].valueAsText
+#width_method = parameters[6].valueAsText
+#processes = parameters[7].valueAsText
 
 nodes_fc = arcpy.GetParameterAsText(0)
 rb_fc = arcpy.GetParameterAsText(1)
 lb_fc = arcpy.GetParameterAsText(2)
 overwrite_data = arcpy.GetParameterAsText(3)
 overwrite_data = str_to_bool(overwrite_data)
+bank_sid_field = arcpy.GetParameterAsText(4)
+if bank_sid_field in ["#", ""]:
+    bank_sid_field = None
+bank_points_fc = arcpy.GetParameterAsText(5)
+if bank_points_fc in ["#", ""]:
+    bank_points_fc = None
+width_method = arcpy.GetParameterAsText(6)
+if width_method in ["#", ""]:
+    width_method = "NEAREST"
+width_method = width_method.upper()
+processes = arcpy.GetParameterAsText(7)
+if processes in ["#", ""]:
+    processes = 1
+processes = int(processes)
 
 # ----------------------------------------------------------------------
 # Start Fill in Data
@@ -62,9 +104,16 @@ overwrite_data = str_to_bool(overwrite_data)
 #rb_fc = r"C:\Google Drive\SiCr_Digitization\Shade_a_lator\TNC_2017\GIS\SilverCreek_Shade.gdb\TTools_Input\traced_river_upper_section_branch2_2_rightBank"
 #lb_fc = r"C:\Google Drive\SiCr_Digitization\Shade_a_lator\TNC_2017\GIS\SilverCreek_Shade.gdb\TTools_Input\traced_river_upper_section_branch2_2_leftBank"
 #overwrite_data = True
+#bank_sid_field = "STREAM_ID" # OPTIONAL
+#bank_points_fc = r"C:\Google Drive\SiCr_Digitization\Shade_a_lator\TNC_2017\GIS\SilverCreek_Shade.gdb\SC_bank_points" # OPTIONAL
+#width_method = "TRANSECT" # OPTIONAL NEAREST or TRANSECT
+#processes = 4 # OPTIONAL default 1, 0 uses every core
 # End Fill in Data
 # ----------------------------------------------------------------------
 
+# Maximum transect length in meters from the node to each bank
+TRANSECT_MAX = 500
+
 def nested_dict():
     """Build a nested dictionary"""
     return defaultdict(nested_dict)
@@ -72,7 +121,8 @@ def nested_dict():
 def read_nodes_fc(nodes_fc, overwrite_data, addFields):
     """Reads the input point feature class and returns the STREAM_ID, NODE_ID, and X/Y coordinates as a nested dictionary"""
     nodeDict = nested_dict()
-    incursorFields = ["STREAM_ID","NODE_ID", "STREAM_KM", "SHAPE@X","SHAPE@Y"]
+    incursorFields = ["STREAM_ID","NODE_ID", "STREAM_KM", "SHAPE@X","SHAPE@Y",
+                      "STRM_AZMTH"]
 
     # Get a list of existing fields
     existingFields = []
@@ -94,14 +144,16 @@ def read_nodes_fc(nodes_fc, overwrite_data, addFields):
                 nodeDict[row[0]][row[1]]["STREAM_KM"] = row[2]
                 nodeDict[row[0]][row[1]]["POINT_X"] = row[3]
                 nodeDict[row[0]][row[1]]["POINT_Y"] = row[4]
+                nodeDict[row[0]][row[1]]["STRM_AZMTH"] = row[5]
         else:
             for row in Inrows:
                 # if the data is null or zero (0 = default for shapefile),
                 # it is retreived and will be overwritten.
-                if row[5] is None or row[5] == 0 or row[5] < -9998:
+                if row[6] is None or row[6] == 0 or row[6] < -9998:
                     nodeDict[row[0]][row[1]]["STREAM_KM"] = row[2]
                     nodeDict[row[0]][row[1]]["POINT_X"] = row[3]
                     nodeDict[row[0]][row[1]]["POINT_Y"] = row[4]
+                    nodeDict[row[0]][row[1]]["STRM_AZMTH"] = row[5]
     if len(nodeDict) == 0:
         sys.exit("The fields checked in the input point feature class "+
                  "have existing data. There is nothing to process. Exiting")
@@ -123,31 +175,107 @@ def to_meters_con(inFeature):
                  "linear units of feet or meters.")
     return con_to_m
 
-def read_polyline_geometry(polyline_fc, proj_polyline):
-    """Reads an input polyline into an arcpy polyline geometry object"""
-    poly_list = []
-    # Get the x and y of each vertex in the polyline and save
-    # it as a list.
-    for row in arcpy.da.SearchCursor(polyline_fc, ["SHAPE@"]):
-        for part in row[0]:
-            for pnt in part:
-                poly_list.append(arcpy.Point(pnt.X, pnt.Y))
-    poly_array = arcpy.Array(poly_list)
-    # put it into a geometry object.
-    poly_geom = arcpy.Polyline(poly_array, proj_polyline)
-    del row
-    return(poly_geom)
-
-def calc_channel_width(node_geom, rb_geom, lb_geom):
-
-    rb_distance = node_geom.distanceTo(rb_geom)
-    lb_distance = node_geom.distanceTo(lb_geom)
-
-    return(lb_distance, rb_distance)
-
-def update_nodes_fc(nodeDict, nodes_fc, addFields):
-    """Updates the input point feature class with
-    data from the nodes dictionary"""
+def read_centerline_nodes(nodes_fc):
+    """Reads the X/Y coordinates and STREAM_ID of all the nodes in the
+    input point feature class in stream and stream km order so they
+    trace the centerlines"""
+    proj_nodes = arcpy.Describe(nodes_fc).spatialReference
+    nodes = []
+    with arcpy.da.SearchCursor(nodes_fc, ["STREAM_ID", "STREAM_KM", "SHAPE@X",
+                                          "SHAPE@Y"], "", proj_nodes) as Inrows:
+        for row in Inrows:
+            nodes.append(row)
+    nodes.sort(key=lambda row: (row[0], row[1]))
+    centerline_sid = [row[0] for row in nodes]
+    centerline_xy = np.array([(row[2], row[3]) for row in nodes], dtype=float)
+    return centerline_xy, centerline_sid
+
+def read_polyline_geometry(polyline_fc, proj_polyline, bank_sid_field,
+                           centerline_xy, centerline_sid):
+    """Reads the segments of an input polyline into a
+    bank_index.StreamBankIndex keyed by the stream ID of each bank.
+    Without bank_sid_field the banks are assigned to the nearest
+    centerline of the nodes in centerline_xy/centerline_sid."""
+    if bank_sid_field:
+        segments, segment_sid = bank_index.read_segments(polyline_fc,
+                                                         proj_polyline,
+                                                         field=bank_sid_field)
+    else:
+        segments, oids = bank_index.read_segments(polyline_fc, proj_polyline)
+        segment_sid = bank_index.assign_to_streams(segments, oids,
+                                                   centerline_xy, centerline_sid)
+    return bank_index.StreamBankIndex(segments, segment_sid)
+
+def calc_channel_width(node_xy, node_sid, rb_index, lb_index,
+                       width_method="NEAREST", node_azimuth=None,
+                       max_distance=None, processes=1):
+    """Returns the distance from each node in the (N, 2) node_xy
+    array to the left and right bank segments of its stream, the
+    measured left and right bank points as (N, 2) arrays and the
+    method used for each node (see bank_index.channel_width()).
+    processes other than 1 measures the streams in a process pool,
+    0 uses every core."""
+    if processes == 1:
+        return bank_index.channel_width(node_xy, node_sid, rb_index, lb_index,
+                                        width_method, node_azimuth,
+                                        max_distance)
+
+    # inside ArcGIS sys.executable is ArcMap/ArcGIS Pro, the workers
+    # need to be started with python
+    python = os.path.join(sys.exec_prefix, "python.exe")
+    if os.path.exists(python):
+        multiprocessing.set_executable(python)
+    result, seconds = bank_index.measure_parallel(node_xy, node_sid, rb_index,
+                                                  lb_index, width_method,
+                                                  node_azimuth, max_distance,
+                                                  processes or None)
+
+    # per stream timing
+    slowest = sorted(seconds, key=seconds.get, reverse=True)[:5]
+    msg = "Measured {0} streams in {1:.1f} seconds of worker time, slowest: {2}".format(
+        len(seconds), sum(seconds.values()),
+        ", ".join("{0} ({1:.2f} s)".format(sid, seconds[sid]) for sid in slowest))
+    arcpy.AddMessage(msg)
+    print(msg)
+    return result
+
+def create_bank_points_fc(bank_points_fc, nodes_fc, nodeKeys, lb_distance,
+                          rb_distance, lb_xy, rb_xy, nodexy_to_m, proj):
+    """Creates a point feature class of the nearest left and
+    right bank point measured from each node for QA"""
+    arcpy.AddMessage("Exporting bank points")
+    print("Exporting bank points")
+
+    # Determine Stream ID field properties
+    sid = arcpy.ListFields(nodes_fc, "STREAM_ID")[0]
+
+    cursorfields = ["NODE_ID", "STREAM_ID", "BANK", "DISTANCE"]
+    arcpy.CreateFeatureclass_management(os.path.dirname(bank_points_fc),
+                                        os.path.basename(bank_points_fc),
+                                        "POINT","","DISABLED","DISABLED",proj)
+    arcpy.AddField_management(bank_points_fc, "NODE_ID", "DOUBLE", "", "", "",
+                              "", "NULLABLE", "NON_REQUIRED")
+    arcpy.AddField_management(bank_points_fc, "STREAM_ID", sid.type,
+                              sid.precision, sid.scale, sid.length, "",
+                              "NULLABLE", "NON_REQUIRED")
+    arcpy.AddField_management(bank_points_fc, "BANK", "TEXT", "", "", 5,
+                              "", "NULLABLE", "NON_REQUIRED")
+    arcpy.AddField_management(bank_points_fc, "DISTANCE", "DOUBLE", "", "", "",
+                              "", "NULLABLE", "NON_REQUIRED")
+
+    with arcpy.da.InsertCursor(bank_points_fc, cursorfields +
+                               ["SHAPE@X","SHAPE@Y"]) as cursor:
+        for bank, distance, xy in [("LEFT", lb_distance, lb_xy),
+                                   ("RIGHT", rb_distance, rb_xy)]:
+            distance = (distance * nodexy_to_m).tolist()
+            for n, (streamID, nodeID) in enumerate(nodeKeys):
+                cursor.insertRow([nodeID, streamID, bank, distance[n],
+                                  xy[n, 0], xy[n, 1]])
+
+def update_nodes_fc(nodeIDs, results, nodes_fc, addFields):
+    """Updates the input point feature class with the results, a list
+    of arrays in the order of addFields for each node in nodeIDs. Each
+    row is updated once with all the fields."""
     arcpy.AddMessage("Updating input point feature class")
     print("Updating input point feature class")
 
@@ -158,111 +286,150 @@ def update_nodes_fc(nodeDict, nodes_fc, addFields):
 
     # Check to see if the field exists and add it if not
     for f in addFields:
-        if (f in existingFields) is False:
+        if (f in existingFields) is False and f == "WIDTH_MTHD":
+            arcpy.AddField_management(nodes_fc, f, "TEXT", "", "", 8,
+                                      "", "NULLABLE", "NON_REQUIRED")
+        elif (f in existingFields) is False:
             arcpy.AddField_management(nodes_fc, f, "DOUBLE", "", "", "",
                                       "", "NULLABLE", "NON_REQUIRED")
 
-    with arcpy.da.UpdateCursor(nodes_fc,["STREAM_ID","NODE_ID"] +
-                               addFields) as cursor:
-        for row in cursor:
-            for f, field in enumerate(addFields):
-                streamID = row[0]
-                nodeID =row[1]
-                row[f+2] = nodeDict[streamID][nodeID][field]
-                cursor.updateRow(row)
+    node_table.write_node_table(nodes_fc, "NODE_ID", nodeIDs, results,
+                                addFields)
 
 
 #enable garbage collection
 gc.enable()
 
-try:
-    arcpy.AddMessage("Step 2: Measure Channel Width")
-    print("Step 2: Measure Channel Width")
-
-    #keeping track of time
-    startTime= time.time()
-
-    # Check if the output exists
-    if not arcpy.Exists(nodes_fc):
-        arcpy.AddError("\nThis output does not exist: \n" +
-                       "{0}\n".format(nodes_fc))
-        sys.exit("This output does not exist: \n" +
-                 "{0}\n".format(nodes_fc))
-
-    if overwrite_data is True:
-        env.overwriteOutput = True
-    else:
-        env.overwriteOutput = False
-
-    # Determine input spatial units
-    proj_nodes = arcpy.Describe(nodes_fc).spatialReference
-    proj_rb = arcpy.Describe(rb_fc).spatialReference
-    proj_lb = arcpy.Describe(lb_fc).spatialReference
-
-    # Check to make sure the rb_fc/lb_fc and input points are
-    # in the same projection.
-    if proj_nodes.name != proj_rb.name:
-        arcpy.AddError("{0} and {1} do not have ".format(nodes_fc, rb_fc)+
-                       "the same projection. Please reproject your data.")
-        sys.exit("Input points and right bank feature class do not have "+
-                 "the same projection. Please reproject your data.")
-
-    if proj_nodes.name != proj_lb.name:
-        arcpy.AddError("{0} and {1} do not have ".format(nodes_fc, lb_fc)+
-                        "the same projection. Please reproject your data.")
-        sys.exit("Input points and left bank feature class do not have "+
-                 "the same projection. Please reproject your data.")
-
-    nodexy_to_m = to_meters_con(nodes_fc)
-
-    addFields = ["CHANWIDTH", "LEFT", "RIGHT"]
-
-    # Read the feature class data into a nested dictionary
-    nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
-
-    # Read each of the bank polylines into geometry objects
-    rb_geom = read_polyline_geometry(rb_fc, proj_rb)
-    lb_geom = read_polyline_geometry(lb_fc, proj_lb)
-
-    for n, streamID in enumerate(nodeDict):
-        arcpy.AddMessage("Processing stream {0} of {1}".format(n+1, len(nodeDict)))
-        print("Processing stream {0} of {1}".format(n+1, len(nodeDict)))
-
-        for nodeID in nodeDict[streamID]:
-            node_x = float(nodeDict[streamID][nodeID]["POINT_X"])
-            node_y = float(nodeDict[streamID][nodeID]["POINT_Y"])
-            node_geom = arcpy.PointGeometry(arcpy.Point(node_x, node_y), proj_nodes)
-
-            lb_distance, rb_distance = calc_channel_width(node_geom, rb_geom, lb_geom)
-            nodeDict[streamID][nodeID]["CHANWIDTH"] = (lb_distance + rb_distance) * nodexy_to_m
-            nodeDict[streamID][nodeID]["LEFT"] = lb_distance * nodexy_to_m
-            nodeDict[streamID][nodeID]["RIGHT"] = rb_distance * nodexy_to_m
-
-    update_nodes_fc(nodeDict, nodes_fc, addFields)
-
-    gc.collect()
+# the pool workers import this script, only run the tool in the main process
+if __name__ == "__main__":
+    try:
+        arcpy.AddMessage("Step 2: Measure Channel Width")
+        print("Step 2: Measure Channel Width")
 
-    endTime = time.time()
-    elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
-    mspernode = timedelta(seconds=(endTime - startTime) / (n+1)).microseconds
-    print("Process Complete in {0} minutes. {1} microseconds per node".format(elapsedmin, mspernode))
-    arcpy.AddMessage("Process Complete in %s minutes. %s microseconds per node" % (elapsedmin, mspernode))
+        #keeping track of time
+        startTime= time.time()
 
-# For arctool errors
-except arcpy.ExecuteError:
-    msgs = arcpy.GetMessages(2)
-    arcpy.AddError(msgs)
-    print(msgs)
+        # Check if the output exists
+        if not arcpy.Exists(nodes_fc):
+            arcpy.AddError("\nThis output does not exist: \n" +
+                           "{0}\n".format(nodes_fc))
+            sys.exit("This output does not exist: \n" +
+                     "{0}\n".format(nodes_fc))
 
-# For other errors
-except:
-    tbinfo = traceback.format_exc()
+        if overwrite_data is True:
+            env.overwriteOutput = True
+        else:
+            env.overwriteOutput = False
+
+        # Determine input spatial units
+        proj_nodes = arcpy.Describe(nodes_fc).spatialReference
+        proj_rb = arcpy.Describe(rb_fc).spatialReference
+        proj_lb = arcpy.Describe(lb_fc).spatialReference
+
+        # Check to make sure the rb_fc/lb_fc and input points are
+        # in the same projection.
+        if proj_nodes.name != proj_rb.name:
+            arcpy.AddError("{0} and {1} do not have ".format(nodes_fc, rb_fc)+
+                           "the same projection. Please reproject your data.")
+            sys.exit("Input points and right bank feature class do not have "+
+                     "the same projection. Please reproject your data.")
+
+        if proj_nodes.name != proj_lb.name:
+            arcpy.AddError("{0} and {1} do not have ".format(nodes_fc, lb_fc)+
+                            "the same projection. Please reproject your data.")
+            sys.exit("Input points and left bank feature class do not have "+
+                     "the same projection. Please reproject your data.")
+
+        nodexy_to_m = to_meters_con(nodes_fc)
+
+        if width_method not in ["NEAREST", "TRANSECT"]:
+            arcpy.AddError("width_method must be NEAREST or TRANSECT")
+            sys.exit("width_method must be NEAREST or TRANSECT")
+
+        addFields = ["CHANWIDTH", "LEFT", "RIGHT", "WIDTH_MTHD"]
+
+        # Read the feature class data into a nested dictionary
+        nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
+
+        # nodes in stream and stream km order so they trace the centerlines
+        nodeKeys = [(streamID, nodeID) for streamID in nodeDict
+                    for nodeID in sorted(nodeDict[streamID],
+                                         key=lambda n: nodeDict[streamID][n]["STREAM_KM"])]
+        node_sid = [streamID for streamID, nodeID in nodeKeys]
+        node_xy = np.array([(nodeDict[streamID][nodeID]["POINT_X"],
+                             nodeDict[streamID][nodeID]["POINT_Y"])
+                            for streamID, nodeID in nodeKeys], dtype=float)
+        node_azimuth = np.array([nodeDict[streamID][nodeID]["STRM_AZMTH"]
+                                 for streamID, nodeID in nodeKeys], dtype=float)
+
+        # The banks are assigned to the centerlines of all the nodes, not
+        # only the nodes measured when overwrite_data is False
+        centerline_xy, centerline_sid = node_xy, node_sid
+        if not bank_sid_field and overwrite_data is False:
+            centerline_xy, centerline_sid = read_centerline_nodes(nodes_fc)
+
+        # Read each of the bank polylines into a segment index per stream
+        rb_index = read_polyline_geometry(rb_fc, proj_rb, bank_sid_field,
+                                          centerline_xy, centerline_sid)
+        lb_index = read_polyline_geometry(lb_fc, proj_lb, bank_sid_field,
+                                          centerline_xy, centerline_sid)
+
+        # Measure all the nodes at once
+        arcpy.AddMessage("Measuring {0} streams".format(len(nodeDict)))
+        print("Measuring {0} streams".format(len(nodeDict)))
+
+        lb_distance, rb_distance, lb_xy, rb_xy, method = calc_channel_width(
+            node_xy, node_sid, rb_index, lb_index, width_method, node_azimuth,
+            TRANSECT_MAX / nodexy_to_m, processes)
+
+        if width_method == "TRANSECT":
+            n_nearest = int((method == "NEAREST").sum())
+            if n_nearest:
+                arcpy.AddWarning("{0} nodes where the transect does not ".format(n_nearest)+
+                                 "cross both banks were measured with NEAREST")
+
+        missing = rb_index.missing | lb_index.missing
+        if missing:
+            arcpy.AddWarning("No bank features for stream {0}, ".format(sorted(missing))+
+                             "these nodes were measured to the nearest bank "+
+                             "of any stream")
+
+        # results in the order of addFields
+        results = [(lb_distance + rb_distance) * nodexy_to_m,
+                   lb_distance * nodexy_to_m,
+                   rb_distance * nodexy_to_m,
+                   method]
+        nodeIDs = [nodeID for streamID, nodeID in nodeKeys]
+
+        update_nodes_fc(nodeIDs, results, nodes_fc, addFields)
+
+        if bank_points_fc:
+            create_bank_points_fc(bank_points_fc, nodes_fc, nodeKeys, lb_distance,
+                                  rb_distance, lb_xy, rb_xy, nodexy_to_m, proj_nodes)
+
+        gc.collect()
+
+        endTime = time.time()
+        elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
+        mspernode = timedelta(seconds=(endTime - startTime) / len(nodeKeys)).microseconds
+        print("Process Complete in {0} minutes. {1} microseconds per node".format(elapsedmin, mspernode))
+        arcpy.AddMessage("Process Complete in %s minutes. %s microseconds per node" % (elapsedmin, mspernode))
+
+    # For arctool errors
+    except arcpy.ExecuteError:
+        msgs = arcpy.GetMessages(2)
+        arcpy.AddError(msgs)
+        print(msgs)
+
+    # For other errors
+    except:
+        tbinfo = traceback.format_exc()
 
-    pymsg = "PYTHON ERRORS:\n" + tbinfo + "\nError Info:\n" +str(sys.exc_info()[1])
-    msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages(2) + "\n"
+        pymsg = "PYTHON ERRORS:\n" + tbinfo + "\nError Info:\n" +str(sys.exc_info()[1])
+        msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages(2) + "\n"
 
-    arcpy.AddError(pymsg)
-    arcpy.AddError(msgs)
+        arcpy.AddError(pymsg)
+        arcpy.AddError(msgs)
 
-    print(pymsg)
-    print(msgs)
+        print(pymsg)
+        print(msgs)
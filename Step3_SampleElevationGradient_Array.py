@@ -40,11 +40,14 @@ import time
 import traceback
 from datetime import timedelta
 import arcpy
-import itertools
 from arcpy import env
 from math import ceil
 from collections import defaultdict
 
+import raster_blocks
+import raster_cache
+import gradients
+
 def str_to_bool(s):
     if s == 'True':
         return True
@@ -88,6 +91,9 @@ block_size = int(block_size)
 
 overwrite_data = arcpy.GetParameterAsText(6)
 overwrite_data = str_to_bool(overwrite_data)
+tile_cache_dir = arcpy.GetParameterAsText(7) # OPTIONAL folder to cache the raster tiles
+if tile_cache_dir in ["#", ""]:
+    tile_cache_dir = None
 
 #-------------------------------------------------------------------------
 
@@ -193,30 +199,6 @@ def read_nodes_fc2(nodes_fc, overwrite_data, addFields):
                  "have existing data. There is nothing to process. Exiting")
     return nodeDict
 
-def calculate_gradient(zList, len_list, smooth_flag):
-
-    skipupNodes = [0]
-    gradientList = [0 for i in zList]
-
-    for i in range(1,len(zList)):
-        z = zList[i]
-        zUp = zList[i - 1 - max(skipupNodes)]
-
-        # Check if the gradient is <= 0, if yes keep going until
-        # it is positive again. Then recalculate the gradient over
-        # the longer distance
-        if z > zUp and smooth_flag is True:
-            skipupNodes.append(max(skipupNodes) + 1)
-        else:
-            dx_meters = sum(len_list[i:i+max(skipupNodes)+1])
-            #dx_meters = float(kmList[i] - kmList[i- max(skipdownNodes)]) * 1000
-            gradient = (zUp - z) / dx_meters
-            for Skip in skipupNodes:
-                gradientList[i-Skip] = gradient
-            skipupNodes = [0]
-
-    return (gradientList)
-
 def update_nodes_fc1(nodeDict, nodes_fc, addFields, nodes_to_query):
     """Updates the input point feature class with data from
     the nodes dictionary with node_id as the primary key"""
@@ -261,145 +243,54 @@ def create_block_list(nodeDict, nodes, buffer, block_size):
     x_coord_list = [nodeDict[nodeID]["POINT_X"] for nodeID in nodes]
     y_coord_list = [nodeDict[nodeID]["POINT_Y"] for nodeID in nodes]
 
-    # calculate bounding box extent for samples
-    x_min = min(x_coord_list)
-    x_max = max(x_coord_list)
-    y_min = min(y_coord_list)
-    y_max = max(y_coord_list)
-
-    x_width = int(x_max - x_min + 1)
-    y_width = int(y_max - y_min + 1)
+    # Group the nodes into blocks, each block extent is minimized
+    # to the true extent of the nodes in the block
+    extents, members = raster_blocks.plan_blocks(x_coord_list, y_coord_list,
+                                                 block_size)
 
     block_extents = []
     block_nodes = []
-
-    # Build data blocks
-    for x in range(0, x_width, block_size):
-        for y in range(0, y_width, block_size):
-
-            # Lower left coordinate of block (in map units)
-            block0_x_min = min([x_min + x, x_max])
-            block0_y_min = min([y_min + y, y_max])
-            # Upper right coordinate of block (in map units)
-            block0_x_max = min([block0_x_min + block_size, x_max])
-            block0_y_max = min([block0_y_min + block_size, y_max])
-
-            block_x_min = block0_x_max
-            block_x_max = block0_x_min
-            block_y_min = block0_y_max
-            block_y_max = block0_y_min
-
-            nodes_in_block = []
-            for nodeID in nodes:
-                node_x = nodeDict[nodeID]["POINT_X"]
-                node_y = nodeDict[nodeID]["POINT_Y"]
-                if (block0_x_min <= node_x <= block0_x_max and
-                    block0_y_min <= node_y <= block0_y_max):
-                    nodes_in_block.append([nodeID, node_x, node_y])
-
-                    # Minimize the size of the block0 by the true
-                    # extent of the nodes in the block
-                    if block_x_min > node_x: block_x_min = node_x
-                    if block_x_max < node_x: block_x_max = node_x
-                    if block_y_min > node_y: block_y_min = node_y
-                    if block_y_max < node_y: block_y_max = node_y
-
-            if nodes_in_block:
-                # add the block extent for processing
-                # order 0 left,      1 bottom,    2 right,     3 top
-                block_extents.append([block_x_min - buffer, block_y_min - buffer,
-                                      block_x_max + buffer, block_y_max + buffer])
-                block_nodes.append(nodes_in_block)
+    for extent, member in zip(extents, members):
+        # add the block extent for processing
+        # order 0 left,      1 bottom,    2 right,     3 top
+        block_extents.append([extent[0] - buffer, extent[1] - buffer,
+                              extent[2] + buffer, extent[3] + buffer])
+        block_nodes.append([[nodes[i], x_coord_list[i], y_coord_list[i]]
+                            for i in member.tolist()])
 
     return block_extents, block_nodes
 
-def coord_to_array(easting, northing, block_x_min, block_y_max, x_cellsize, y_cellsize):
-    """converts x/y coordinates to col and row of the array"""
-    xy = []
-    xy.append(int((easting - block_x_min) / x_cellsize))  # col, x
-    xy.append(int((northing - block_y_max) / y_cellsize * -1))  # row, y
-    return xy
+def sample_raster(block, nodes_in_block, z_info, searchCells, tile_cache):
 
-def sample_raster(block, nodes_in_block, z_raster, cellcoords, con_z_to_m):
-
-    if con_z_to_m is not None:
-        nodata_to_value = -9999 / con_z_to_m
-    else:
-        nodata_to_value = -9999
-
-    # localize the block extent values
-    block_x_min = block[0]
-    block_y_min = block[1]
-    block_x_max = block[2]
-    block_y_max = block[3]
-
-    x_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEY").getOutput(0))
-
-    # Get the coordinates extent of the input raster
-    raster_x_min = float(arcpy.GetRasterProperties_management(z_raster, "LEFT").getOutput(0))
-    raster_y_min = float(arcpy.GetRasterProperties_management(z_raster, "BOTTOM").getOutput(0))
-    raster_x_max = float(arcpy.GetRasterProperties_management(z_raster, "RIGHT").getOutput(0))
-    raster_y_max = float(arcpy.GetRasterProperties_management(z_raster, "TOP").getOutput(0))
-
-    # Calculate the X and Y offset from the upper left node
-    # coordinates bounding box
-    x_minoffset = (block_x_min - raster_x_min)%x_cellsize
-    y_minoffset = (block_y_min - raster_y_min)%y_cellsize
-    x_maxoffset = (raster_x_max - block_x_max)%x_cellsize
-    y_maxoffset = (raster_y_max - block_y_max)%y_cellsize
-
-    # adjust so the coordinates are at the raster cell corners
-    block_x_min = block_x_min - x_minoffset
-    block_y_min = block_y_min - y_minoffset
-    block_x_max = block_x_max + x_maxoffset
-    block_y_max = block_y_max + y_maxoffset
-
-    # Get the lower left cell center coordinate. This is for ESRI's
-    # RastertoNumpyArray function which defaults to the adjacent
-    # lower left cell
-    block_x_min_center = block_x_min + (x_cellsize / 2)
-    block_y_min_center = block_y_min + (y_cellsize / 2)
-
-    # calculate the number or cols/ros from the lower left
-    ncols = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
-    nrows = max([int(ceil((block_y_max - block_y_min)/ y_cellsize)), 1])
-
-    # Construct the array. Note returned array is (row, col) so (y, x)
+    # Construct the array in meters with the block extent snapped to the
+    # raster cell corners. Note returned array is (row, col) so (y, x)
     try:
-        raster_array = arcpy.RasterToNumPyArray(z_raster, arcpy.Point(block_x_min_center, block_y_min_center),
-                                                ncols, nrows, nodata_to_value)
+        raster_array, block_x_min, block_y_max = tile_cache.read_block(z_info, block)
     except:
         tbinfo = traceback.format_exc()
         pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"
         sys.exit(pymsg)
 
-    # convert array values to meters if needed
-    if con_z_to_m is not None:
-        raster_array = raster_array * con_z_to_m
-
     z_list = []
-    z_node = []
     if raster_array.max() > -9999:
         # There is at least one pixel of data
-        for node in nodes_in_block:
-            xy = coord_to_array(node[1], node[2], block_x_min, block_y_max, x_cellsize, y_cellsize)
-            z_sampleList = []
-            for coord in cellcoords:
-                # Calculate the cell X/Y based on the base coordinate movement
-                cell_x = xy[0] + coord[0]
-                cell_y = xy[1] + coord[1]
-                z_sampleList.append(raster_array[cell_y,cell_x])
-
-            # sample at node:
-            z_node = raster_array[xy[1], xy[0]]
-
-            # Remove no data values (-9999) unless they are all no data
-            if not max(z_sampleList) < -9998:
-                z_sampleList = [z for z in z_sampleList if z > -9999]
-            # Get the lowest elevation
-            node.append(min(z_sampleList))
-            node.append(z_node)
+        rows, cols = raster_blocks.array_row_col([node[1] for node in nodes_in_block],
+                                                 [node[2] for node in nodes_in_block],
+                                                 block_x_min, block_y_max,
+                                                 z_info.x_cellsize, z_info.y_cellsize)
+
+        # Get the lowest elevation in the search cells around every
+        # node at once. No data values (-9999) are removed unless
+        # they are all no data.
+        z_min = raster_blocks.window_minimum(raster_array, rows, cols,
+                                             searchCells).tolist()
+
+        # sample at node:
+        z_node = raster_array[rows, cols].tolist()
+
+        for i, node in enumerate(nodes_in_block):
+            node.append(z_min[i])
+            node.append(z_node[i])
             z_list.append(node)
 
     else:
@@ -491,8 +382,10 @@ try:
     else:
         block_size = int(con_from_m * block_size * 1000)
 
-    # Get the elevation raster cell size
-    cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
+    # Get the elevation raster properties once for all the blocks
+    z_info = raster_blocks.describe_raster(z_raster, con_z_to_m)
+    cellsize = z_info.x_cellsize
+    tile_cache = raster_cache.TileCache(tile_cache_dir)
 
     # calculate the buffer distance (in raster spatial units) to add to
     # the base bounding box when extracting to an array. The buffer is
@@ -500,14 +393,10 @@ try:
     # the surrounding cells at each corner
     buffer = int((searchCells + 1)* cellsize)
 
-    # Make a list of the base x/y coordinate movments
-    # from the node origin. These values will be
-    # multipled by the cell size.
+    # The lowest elevation is searched in the cells around the node
     # searchCells = 0 samples at the node
     # searchCells = 1 cell width around node = 9 cells
     # searchCells = 2 cell widths around node = 25 cells ...
-    cell_moves = [i for i in range(searchCells*-1, searchCells+1, 1)]
-    cellcoords = list(itertools.product(cell_moves, cell_moves))
 
     # read the data into a nested dictionary
     addFields = ["ELEVATION", "Z_NODE"]
@@ -533,7 +422,7 @@ try:
             arcpy.AddMessage("Processing block {0} of {1}".format(p + 1, len(block_extents)))
             print("Processing block {0} of {1}".format(p + 1, len(block_extents)))
 
-            z_list = sample_raster(block, nodes_in_block, z_raster, cellcoords, con_z_to_m)
+            z_list = sample_raster(block, nodes_in_block, z_info, searchCells, tile_cache)
 
             # Update the node fc
             for row in z_list:
@@ -549,6 +438,9 @@ try:
             del z_list
             gc.collect()
 
+        arcpy.AddMessage("Raster reads {0}, cached tiles used {1}".format(
+            tile_cache.reads, tile_cache.hits + tile_cache.disk_hits))
+
     else:
         arcpy.AddMessage("The elevation field checked in the input point feature class " +
               "have existing data. Andvancing to gradient processing")
@@ -575,7 +467,7 @@ try:
         len_list = [nodeDict[streamID][km]["LENGTH"] for km in stream_kms]
 
         # Calculate Gradient
-        gradientList = calculate_gradient(z_list, len_list, smooth_flag)
+        gradientList = gradients.node_gradients(z_list, len_list, smooth_flag).tolist()
 
         for i, km in enumerate(stream_kms):
             nodeDict[streamID][km]["GRADIENT"] = gradientList[i]
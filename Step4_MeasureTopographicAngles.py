@@ -16,8 +16,21 @@
 # 4: input elevation raster z units (z_units)
 #     "Feet", "Meters", or "Other"
 # 5: output sample point file name/path (topo_fc)
-# 6: input flag if existing data can be over
+# 6: OPTIONAL block size in km (block_size)
+# 7: input flag if existing data can be over
 #     written (overwrite_data) True or False
+# 8: OPTIONAL folder to cache the raster tiles (tile_cache_dir)
+# 9: OPTIONAL topo method (topo_method) "RAY" (default) samples the topo
+#     lines of each node. "HORIZON" builds horizon rasters of the DEM tiles
+#     with nodes for the 45 to 315 azimuths, kept in the tile cache folder
+#     for later runs, and samples them at the nodes with Z_NODE at the
+#     elevation of their cell (Step 3 searchCells 0). It is slower than
+#     "RAY" on the first run unless the nodes are dense (see horizon.py)
+# 10: OPTIONAL pyramid tolerance in degrees (pyramid_tolerance). The
+#     topo lines take their far samples from max elevation overviews of
+#     the raster where an overview cell is no wider than the tolerance
+#     seen from the node (see pyramid.py). The overviews are kept in the
+#     tile cache folder. Blank samples every cell.
 
 # OUTPUTS
 # 0. point feature class (edit nodes_fc) - Added fields with topographic
@@ -50,6 +63,11 @@ from math import radians, sin, cos, hypot, ceil
 from collections import defaultdict
 import numpy as np
 
+import raster_blocks
+import raster_cache
+import horizon
+import pyramid
+
 def str_to_bool(s):
     if s == 'True':
         return True
@@ -99,6 +117,17 @@ topo_fc = arcpy.GetParameterAsText(5)
 block_size = arcpy.GetParameterAsText(6)
 overwrite_data = arcpy.GetParameterAsText(7)
 overwrite_data = str_to_bool(overwrite_data)
+tile_cache_dir = arcpy.GetParameterAsText(8) # OPTIONAL folder to cache the raster tiles
+if tile_cache_dir in ["#", ""]:
+    tile_cache_dir = None
+topo_method = arcpy.GetParameterAsText(9) # OPTIONAL RAY or HORIZON
+if topo_method in ["#", ""]:
+    topo_method = "RAY"
+pyramid_tolerance = arcpy.GetParameterAsText(10) # OPTIONAL degrees
+if pyramid_tolerance in ["#", ""]:
+    pyramid_tolerance = None
+else:
+    pyramid_tolerance = float(pyramid_tolerance)
 
 def nested_dict():
     """Build a nested dictionary"""
@@ -298,54 +327,6 @@ def from_z_units_to_meters_con(zUnits):
 
     return con_z_to_m
 
-def build_search_array(searchDistance_min, searchDistance_max, cellsize, use_skippy):
-    """Build a numpy array from the minimum to the max
-    search distance by increments of the cellsize."""
-
-    # use next cell over to avoid divide by zero errors
-    if searchDistance_min <= 0: searchDistance_min = cellsize
-
-    if use_skippy:
-        # This is a modified version of the skippy
-        # algorithm from Greg Pelletier. It is not being used but I'm
-        # keeping it in here in case someone wants to turn it on.
-        # It needs to be fixed so the ncells are adjusted based on distance
-        searchDistance = searchDistance_min
-        distanceList = [searchDistance_min]
-
-        #ncells = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
-
-        ncells = 1
-        while not searchDistance > searchDistance_max:
-            if ncells <= 10:
-                searchDistance_m = searchDistance + (cellsize)
-            if 10 < ncells <= 20:
-                searchDistance = searchDistance + (cellsize * 3)
-            if 20 < ncells <= 40:
-                searchDistance = searchDistance + (cellsize * 6)
-            if 40 < ncells <= 50:
-                searchDistance = searchDistance + (cellsize * 12)
-            if 50 < ncells <= 60:
-                searchDistance = searchDistance + (cellsize * 25)
-            if ncells > 60:
-                searchDistance = searchDistance + (cellsize * 50)
-            distanceList.append(searchDistance)
-            ncells = ncells + 1
-        distance_array = np.array(distanceList)
-    else:
-        if (searchDistance_max - searchDistance_min >= cellsize):
-            distance_array = np.arange(searchDistance_min, searchDistance_max, cellsize)
-        else:
-            distance_array = np.array([searchDistance_min])
-    return distance_array
-
-def coord_to_array(easting, northing, block_x_min, block_y_max, x_cellsize, y_cellsize):
-    """converts x/y coordinates to col and row of the array"""
-    xy = []
-    xy.append(int((easting - block_x_min) / x_cellsize))  # col, x
-    xy.append(int((northing - block_y_max) / y_cellsize * -1))  # row, y
-    return xy
-
 def plot_it(pts1, pts2, nodeID, a, b, b0, plot_dir):
     """plots the block and topo line"""
 
@@ -390,7 +371,7 @@ def create_block_fc(block_segments, b, block_fc, proj):
             cursor.insertRow([poly, b, s])
             poly_array.removeAll()
 
-def create_blocks(NodeDict, block_size, last_azimuth, searchDistance_max):
+def create_blocks(NodeDict, block_size, searchDistance_max):
     """Returns two lists, one containting the coordinate extent
     for each block that will be itterativly extracted to an array
     and the other containing the start and stop distances for each
@@ -408,8 +389,6 @@ def create_blocks(NodeDict, block_size, last_azimuth, searchDistance_max):
     nodes.sort()
 
     topo_list = []
-    x_coord_list = []
-    y_coord_list = []
 
     for nodeID in nodes:
         node_x = nodeDict[nodeID]["POINT_X"]
@@ -422,391 +401,189 @@ def create_blocks(NodeDict, block_size, last_azimuth, searchDistance_max):
             end_x = ((searchDistance_max * sin(radians(a))) + node_x)
             end_y = ((searchDistance_max * cos(radians(a))) + node_y)
 
-            x_coord_list.append(end_x)
-            y_coord_list.append(end_y)
-
             topo_list.append([nodeID, streamID, a, z_node, node_x, node_y, end_x, end_y])
 
-    # calculate bounding box extent for samples
-    x_min = min(x_coord_list)
-    x_max = max(x_coord_list)
-    y_min = min(y_coord_list)
-    y_max = max(y_coord_list)
-
-    x_width = int(x_max - x_min + 1)
-    y_width = int(y_max - y_min + 1)
-
-    block_extents = []
-    block_samples = []
-    b = 0
-
-    # Build blocks
-    for x in range(0, x_width, block_size):
-        for y in range(0, y_width, block_size):
-
-            # Lower left coordinate of block (in map units)
-            block_x_min = min([x_min + x, x_max])
-            block_y_min = min([y_min + y, y_max])
-            # Upper right coordinate of block (in map units)
-            block_x_max = min([block_x_min + block_size, x_max])
-            block_y_max = min([block_y_min + block_size, y_max])
-
-            nodes_to_update = []
-            topo_in_block = []
-
-            block_segments = (((block_x_min, block_y_max), (block_x_min, block_y_min)),
-                              ((block_x_min, block_y_min), (block_x_max, block_y_min)),
-                              ((block_x_max, block_y_min), (block_x_max, block_y_max)),
-                              ((block_x_max, block_y_max), (block_x_min, block_y_max)))
-
-            #--------------------------------------------------------
-            # This is an argument for plot_it(). I used it for debugging.
-            # It's a tuple of the x/y coords for each block segment.
-            block_for_plot = ((block_x_min, block_y_max),
-                             (block_x_min, block_y_min),
-                             (block_x_min, block_y_min),
-                             (block_x_max, block_y_min),
-                             (block_x_max, block_y_min),
-                             (block_x_max, block_y_max),
-                             (block_x_max, block_y_max),
-                             (block_x_min, block_y_max))
-            #--------------------------------------------------------
-
-            # Now start itterating through the topo list to evaluate
-            # if any part of the topo line is in the block extent
-            for nodeID, streamID, a, z_node, node_x, node_y, end_x, end_y in topo_list:
-
-                #--------------------------------------------------------
-                # This was used for debugging.
-                # It slows the script WAY down.
-                #topo_line = ((node_x, node_y),(end_x, end_y))
-                #plot_it(block_for_plot, topo_line, nodeID, a, b, b0, plot_dir)
-                #create_topo_line_fc(topo_line, streamID, nodeID, a,
-                #                    topo_line_fc, proj)
-                #--------------------------------------------------------
-
-                contains_node = False
-                contains_end = False
-                last_sample = False
-
-                # check if the node is inside the block
-                if (block_x_min <= node_x <= block_x_max and
-                    block_y_min <= node_y <= block_y_max):
-                    contains_node = True
-
-                # check if the topo line end point is inside the block
-                if (block_x_min <= end_x <= block_x_max and
-                    block_y_min <= end_y <= block_y_max):
-                    contains_end = True
-
-                # check if this is the last block to process for this node
-                if a == last_azimuth:
-                    if a == 45:
-                        # we have to get the coordinate at
-                        # the far upper right corner
-                        searchDistance_last = (hypot(searchDistance_max, searchDistance_max))
-                        last_x = ((searchDistance_last * sin(radians(a))) + node_x)
-                        last_y = ((searchDistance_last * cos(radians(a))) + node_y)
-                    else:
-                        last_x = end_x
-                        last_y = end_y
-
-                    if (block_x_min <= last_x <= block_x_max and
-                        block_y_min <= last_y <= block_y_max):
-
-                        last_sample = True
-
-                # check if the entire topo line segment is inside the block
-                if contains_node and contains_end:
-                    block_search_start = 0
-                    block_search_end = searchDistance_max
-
-                    topo_in_block.append([nodeID, streamID, a,
-                                          z_node,
-                                          node_x, node_y,
-                                          end_x, end_y,
-                                          block_search_start,
-                                          block_search_end])
-
-                    if last_sample: nodes_to_update.append(nodeID)
-
-                # check if and where the topo segment cross the block
-                else:
-                    distance = []
-
-                    # check each block segment for an intersection
-                    for i, block_segment in enumerate(block_segments):
-
-                        intersects, inter1_x, inter1_y, inter2_x, inter2_y = find_intersection(block_segment[0],
-                                                            block_segment[1],
-                                                            (node_x, node_y),
-                                                            (end_x, end_y), True)
-
-                        # if there is an intersection calculate the
-                        # distance in fc units from node to
-                        # that intersection
-                        if intersects:
-                            if a in [0, 180]:
-                                # need to use the y directon for these
-                                distance.append((inter1_y - node_y) / cos(radians(a)))
-                            else:
-                                distance.append((inter1_x - node_x) / sin(radians(a)))
-
-                    if (len(distance) == 1 and
-                        (0 < distance[0] < searchDistance_max) and
-                        (contains_node or contains_end)):
-                        # one intersection
-                        if contains_node:
-                            # This will be changed from zero to
-                            # the cell size in build_search_array()
-                            # Should probably just change it here
-                            block_search_start = 0
-                            block_search_end = distance[0]
-                        elif contains_end:
-                            # end of the topo line
-                            block_search_start = distance[0]
-                            block_search_end = searchDistance_max
-
-                        # part of the topo line is in the block, add it
-                        topo_in_block.append([nodeID, streamID, a,
-                                              z_node,
-                                              node_x, node_y,
-                                              end_x, end_y,
-                                              block_search_start,
-                                              block_search_end])
-
-                        if last_sample and not nodeDict[nodeID]["updated"]:
-                            nodes_to_update.append(nodeID)
-                            nodeDict[nodeID]["updated"] = True
-
-                    elif len(distance) > 1:
-                        # two intersections, crosses the block
-                        # two intersections, end or start on block line
-                        # three intersections, collienar over length of block
-                        # three intersections, collienar w/ end or start on block line
-                        block_search_start = min(i for i in distance if i is not None)
-                        block_search_end = max(distance)
-
-                        topo_in_block.append([nodeID, streamID, a,
-                                              z_node,
-                                              node_x, node_y,
-                                              end_x, end_y,
-                                              block_search_start,
-                                              block_search_end])
-
-                        if last_sample and contains_end and not nodeDict[nodeID]["updated"]:
-                            nodes_to_update.append(nodeID)
-                            nodeDict[nodeID]["updated"] = True
-
-                    elif last_sample and not contains_end and not nodeDict[nodeID]["updated"]:
-                        nodes_to_update.append(nodeID)
-                        nodeDict[nodeID]["updated"] = True
-
-                    del distance[:]
-
-            if topo_in_block:
-
-                # order 0 left,      1 bottom,    2 right,     3 top
-                blockDict[b]["extent"] = (block_x_min, block_y_min,
-                                          block_x_max, block_y_max)
-                blockDict[b]["samples"] = topo_in_block
-                blockDict[b]["nodes_to_update"] = nodes_to_update
-
-                #--------------------------------------------------
-                # Creates a feature class of the blocks.
-                #create_block_fc(block_segments, b, block_fc, proj)
-                #--------------------------------------------------
-
-            b = b + 1
-    return blockDict
-
-def find_intersection(a, b, c, d, check_collinear=True):
-    """Calculates 2D intersection coordinates of segments a-b and c-d.
-    a,b,c,d are tuples in the form of (x,y). If checking for collinearity
-    then segments that overlap or touch but do not cross will be
-    considered an interesection. Returns the min and max points of
-    intersection for overlap and the same points for intersections."""
-
-    # a-b = block segment
-    # c-d = topo line
-
-    Dx_Cx = d[0] - c[0]
-    Ay_Cy = a[1] - c[1]
-    Dy_Cy = d[1] - c[1]
-    Ax_Cx = a[0] - c[0]
-    Bx_Ax = b[0] - a[0]
-    By_Ay = b[1] - a[1]
-
-    Cx_Bx = c[0] - b[0]
-    Dx_Ax = d[0] - a[0]
-    Cy_By = c[1] - b[1]
-    Dy_Ay = d[1] - a[1]
+    # Clip every topo line to the block edges it crosses at once. The
+    # topo lines in each block get the block search start and end
+    # distances and each node is updated after the last block with one
+    # of its topo lines.
+    for b, extent, topo_in_block, nodes_to_update in raster_blocks.plan_topo_blocks(
+            topo_list, block_size, searchDistance_max):
 
-    numerator_a = Dx_Cx * Ay_Cy - Dy_Cy * Ax_Cx
-    numerator_b = Bx_Ax * Ay_Cy - By_Ay * Ax_Cx
-    denominator = Dy_Cy * Bx_Ax - Dx_Cx * By_Ay
+        # order 0 left,      1 bottom,    2 right,     3 top
+        blockDict[b]["extent"] = extent
+        blockDict[b]["samples"] = topo_in_block
+        blockDict[b]["nodes_to_update"] = nodes_to_update
 
-    if (check_collinear and numerator_a == 0 and numerator_b == 0 and denominator == 0):
-        # Lines are collinear
-
-        # if the signs are different the
-        # segments have some overlap
-        overlap_x = (Cx_Bx < 0) != (Dx_Ax < 0)
-        overlap_y = (Cy_By < 0) != (Dy_Ay < 0)
-
-        point_overlap = (a == d or b == c)
-
-        # if any are True there is an intersection
-        if (overlap_x or overlap_y or point_overlap):
-            # There is overlap
-            x = sorted((a[0], b[0], c[0], d[0]))
-            y = sorted((a[1], b[1], c[1], d[1]))
-
-            # min
-            ixa = x[1]
-            iya = y[1]
-
-            # max
-            ixb = x[2]
-            iyb = y[2]
-
-            return True, ixa, iya, ixb, iyb
-        return False, None, None, None, None
-
-    if denominator == 0:
-        # Lines are parallel or
-        # maybe collinear if check_collinear=False
+    return blockDict
 
-        return False, None, None, None, None
+def get_topo_angles(nodeDict, block_extent, block_samples, z_info, azimuthdisdict, searchDistance_max_m, tile_cache, z_pyramid, stored):
+    """This gets the maximum topographic angle and other informaiton for
+    each topo line within the block. The data is saved to the nodeDict
+    as a list. If z_pyramid is not None the far samples are taken
+    from its max elevation overviews. Topo lines with a result in
+    stored (keyed by node ID and azimuth, from the horizon rasters) are
+    not sampled."""
 
-    u_a = numerator_a / denominator
-    u_b = numerator_b / denominator
+    x_cellsize = z_info.x_cellsize
+    y_cellsize = z_info.y_cellsize
 
-    if (u_a >= 0) and (u_a <= 1) and (u_b >= 0) and (u_b <= 1):
-        # segments intersect
-        ixa = a[0] + Bx_Ax * u_a
-        iya = a[1] + By_Ay * u_a
+    topo_samples = []
+    if stored:
+        new_samples = []
+        for sample in block_samples:
+            if (sample[0], sample[2]) in stored:
+                topo_samples.append(stored[(sample[0], sample[2])])
+            else:
+                new_samples.append(sample)
+        block_samples = new_samples
+        if not block_samples:
+            return topo_samples
+
+    azimuths = [sample[2] for sample in block_samples]
+    node_x = [sample[4] for sample in block_samples]
+    node_y = [sample[5] for sample in block_samples]
+    sin_a = [sin(radians(a)) for a in azimuths]
+    cos_a = [cos(radians(a)) for a in azimuths]
+    start = [sample[8] for sample in block_samples]
+    end = [sample[9] for sample in block_samples]
+    cellsize = [azimuthdisdict[a] for a in azimuths]
+    z_nodes = [sample[3] for sample in block_samples]
+
+    if z_pyramid is not None:
+        # the far samples are taken from the max elevation overviews
+        try:
+            results = z_pyramid.topo_angles(block_extent, node_x, node_y,
+                                            z_nodes, sin_a, cos_a, start,
+                                            end, cellsize, con_to_m)
+        except:
+            tbinfo = traceback.format_exc()
+            pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"
+            sys.exit(pymsg)
 
-        ixb = c[0] + Dx_Cx * u_b
-        iyb = c[1] + Dy_Cy * u_b
+    else:
+        # only the raster tiles crossed by the topo lines are read
+        tiles = raster_cache.line_tiles(z_info, *raster_blocks.topo_line_ends(
+            node_x, node_y, sin_a, cos_a, start, end, cellsize),
+            tile_cells=tile_cache.tile_cells)
+
+        # Construct the array in meters with the block extent snapped to the
+        # raster cell corners. Note returned array is (row, col) so (y, x)
+        try:
+            z_array, block_x_min, block_y_max = tile_cache.read_block(z_info, block_extent, tiles)
+
+        except:
+            tbinfo = traceback.format_exc()
+            pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"
+            sys.exit(pymsg)
+
+        results = None
+        if z_array.max() > -9999:
+            # There is at least one pixel of data
+
+            # sample all the topo lines in the block at once along the
+            # distances from the block edges (units of the fc) and find
+            # the max topo angle of each line
+            results = raster_blocks.topo_angles(
+                z_array, block_x_min, block_y_max, x_cellsize, y_cellsize,
+                node_x, node_y, z_nodes,
+                sin_a, cos_a, start, end, cellsize, con_to_m)
+
+    if results is not None:
+        topoAngles, topoAngleDistances, z_topos, off_rastersamples = results
+        for i, sample in enumerate(block_samples):
+            topo_samples.append(topo_sample(sample[:6], topoAngles[i],
+                                            z_topos[i], topoAngleDistances[i],
+                                            off_rastersamples[i],
+                                            searchDistance_max_m))
 
-        return True, ixa, iyb, ixa, iyb
-    return False, None, None, None, None
+    return topo_samples
 
-def get_topo_angles(nodeDict, block_extent, block_samples, z_raster, azimuthdisdict, searchDistance_max_m, con_z_to_m):
-    """This gets the maximum topographic angle and other informaiton for
-    each topo line within the block. The data is saved to the nodeDict
-    as a list."""
-
-    nodata_to_value = -9999 / con_z_to_m
-
-    x_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEY").getOutput(0))
-
-    # localize the block extent values
-    block_x_min = block_extent[0]
-    block_y_min = block_extent[1]
-    block_x_max = block_extent[2]
-    block_y_max = block_extent[3]
-
-    # Get the coordinates extent of the input raster
-    # this could be in main so it doesn't have to run each time
-    raster_x_min = float(arcpy.GetRasterProperties_management(z_raster, "LEFT").getOutput(0))
-    raster_y_min = float(arcpy.GetRasterProperties_management(z_raster, "BOTTOM").getOutput(0))
-    raster_x_max = float(arcpy.GetRasterProperties_management(z_raster, "RIGHT").getOutput(0))
-    raster_y_max = float(arcpy.GetRasterProperties_management(z_raster, "TOP").getOutput(0))
-
-    # Calculate the X and Y offset from the upper left node
-    # coordinates bounding box
-    x_minoffset = (block_x_min - raster_x_min)%x_cellsize
-    y_minoffset = (block_y_min - raster_y_min)%y_cellsize
-    x_maxoffset = (raster_x_max - block_x_max)%x_cellsize
-    y_maxoffset = (raster_y_max - block_y_max)%y_cellsize
-
-    # adjust so the coordinates are at the raster cell corners
-    block_x_min = block_x_min - x_minoffset
-    block_y_min = block_y_min - y_minoffset
-    block_x_max = block_x_max + x_maxoffset
-    block_y_max = block_y_max + y_maxoffset
-
-    # Get the lower left cell center coordinate. This is for ESRI's
-    # RastertoNumpyArray function which defaults to the adjacent
-    # lower left cell
-    block_x_min_center = block_x_min + (x_cellsize / 2)
-    block_y_min_center = block_y_min + (y_cellsize / 2)
-
-    # calculate the number or cols/ros from the lower left
-    ncols = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
-    nrows = max([int(ceil((block_y_max - block_y_min)/ y_cellsize)), 1])
-
-    # Construct the array. Note returned array is (row, col) so (y, x)
-    try:
-        z_array = arcpy.RasterToNumPyArray(z_raster, arcpy.Point(block_x_min_center, block_y_min_center),
-                                       ncols, nrows, nodata_to_value)
+def topo_sample(topo_line, topoAngle, z_topo, topoAngleDistance,
+                off_rastersamples, searchDistance_max_m):
+    """Returns the topo fc row of the max topo angle of a topo line
+    (node ID, stream ID, azimuth, z node, node x, node y)"""
+
+    nodeID, streamID, a, z_node, node_x, node_y = topo_line
+    # elevation change between topo angle location and node elevation
+    z_change = z_topo - z_node
+    # distance from the node to topo angle location in units of fc
+    topoAngle_x = (topoAngleDistance * sin(radians(a))) + node_x
+    topoAngle_y = (topoAngleDistance * cos(radians(a))) + node_y
+    topoAngleDistance_m = topoAngleDistance * con_to_m
+
+    return [topoAngle_x, topoAngle_y,
+            topoAngle_x, topoAngle_y,
+            streamID, nodeID, a,
+            topoAngle, z_topo,
+            z_node, z_change,
+            topoAngleDistance_m,
+            searchDistance_max_m,
+            off_rastersamples]
+
+def horizon_topo_samples(nodeDict, horizons, searchDistance_max_m):
+    """Returns the topo samples of the nodes sampled from the horizon
+    rasters keyed by node ID and azimuth"""
+    nodes = nodeDict.keys()
+    nodes.sort()
+    node_x = [nodeDict[nodeID]["POINT_X"] for nodeID in nodes]
+    node_y = [nodeDict[nodeID]["POINT_Y"] for nodeID in nodes]
+    z_node = [nodeDict[nodeID]["Z_NODE"] for nodeID in nodes]
+
+    stored = {}
+    for a, raster in horizons.items():
+        found, topoAngles, topoAngleDistances, z_topos, off_rastersamples = raster.sample(
+            node_x, node_y, z_node)
+        for i, k in enumerate(np.nonzero(found)[0].tolist()):
+            nodeID = nodes[k]
+            stored[(nodeID, a)] = topo_sample(
+                [nodeID, nodeDict[nodeID]["STREAM_ID"], a, z_node[k],
+                 node_x[k], node_y[k]], topoAngles[i], z_topos[i],
+                topoAngleDistances[i], off_rastersamples[i],
+                searchDistance_max_m)
+    return stored
+
+def update_node_dict(nodeDict, topo_samples, azimuthdict):
+    """Keeps the max topo angle of each node and azimuth from
+    the topo samples in the nodeDict"""
+    for sample in topo_samples:
+        nodeID = sample[5]
+        a = sample[6]
+        topoAngle = sample[7]
+
+        # Create a key to hold the topo list info for this block
+        topo_key = azimuthdict[a] + "_list"
+
+        if azimuthdict[a] in nodeDict[nodeID]:
+            if nodeDict[nodeID][azimuthdict[a]] < topoAngle:
+                nodeDict[nodeID][azimuthdict[a]] = topoAngle
+                nodeDict[nodeID][topo_key] = sample
 
-    except:
-        tbinfo = traceback.format_exc()
-        pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"
-        sys.exit(pymsg)
+        else:
+            nodeDict[nodeID][azimuthdict[a]] = topoAngle
+            nodeDict[nodeID][topo_key] = sample
 
-    # convert array values to meters if needed
-    z_array = z_array * con_z_to_m
+def write_nodes(nodeDict, nodes_to_update, addFields, proj):
+    """Writes the topo data of the nodes to the TTools point feature
+    class and the output topo feature class"""
 
-    topo_samples = []
-    if z_array.max() > -9999:
-        # There is at least one pixel of data
-        for (nodeID, streamID, a, z_node,
-             node_x, node_y, end_x, end_y,
-             block_search_start, block_search_end) in block_samples:
-
-            # create list of distance movements along the topo line
-            # from the block edges
-            # this is in units of the fc
-            cellsize = azimuthdisdict[a]
-            distance_array = build_search_array(block_search_start,
-                                                  block_search_end,
-                                                  cellsize,
-                                                  use_skippy=False)
-            z_topo_list = []
-            for distance in distance_array:
-                pt_x = ((distance * sin(radians(a))) + node_x)
-                pt_y = ((distance * cos(radians(a))) + node_y)
-
-                xy = coord_to_array(pt_x, pt_y, block_x_min, block_y_max, x_cellsize, y_cellsize)
-                z_topo_list.append(z_array[xy[1], xy[0]])
-
-            # convert distances to meters
-            distance_array_m = distance_array * con_to_m
-            z_topo_array = np.array(z_topo_list)
-            # Calculate the topo angles along the topo line
-            angle_array = np.degrees(np.arctan((z_topo_array - z_node) / distance_array_m))
-            # remove the off raster samples
-            naindex = np.where(z_topo_array < -9998)
-            for x in naindex[0]: angle_array[x] = -9999
-            # Find the max topo angle
-            topoAngle = angle_array.max()
-            # array index at the max topo angle
-            arryindex = np.where(angle_array==topoAngle)[0][0]
-            z_topo = z_topo_array[arryindex]
-            # elevation change between topo angle location and node elevation
-            z_change = z_topo - z_node
-            # distance from the node to topo angle location in units of fc
-            topoAngleDistance = distance_array[arryindex]
-            topoAngle_x = (topoAngleDistance * sin(radians(a))) + node_x
-            topoAngle_y = (topoAngleDistance * cos(radians(a))) + node_y
-            topoAngleDistance_m = topoAngleDistance * con_to_m
-            off_rastersamples = (z_topo_array < -9998).sum()
-
-            topo_samples.append([topoAngle_x, topoAngle_y,
-                                  topoAngle_x, topoAngle_y,
-                                  streamID, nodeID, a,
-                                  topoAngle, z_topo,
-                                  z_node, z_change,
-                                  topoAngleDistance_m,
-                                  searchDistance_max_m,
-                                  off_rastersamples])
+    update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_to_update)
 
-    return topo_samples
+    # Build/add to the output topo feature class
+    topo_list = []
+    for nodeID in nodes_to_update:
+        for field in addFields:
+            topo_key = field + "_list"
+            topo_list.append(nodeDict[nodeID][topo_key])
+            # delete some data
+            nodeDict[nodeID].pop(field, None)
+            nodeDict[nodeID].pop(topo_key, None)
+            nodeDict[nodeID].pop("updated", None)
+    update_topo_fc(topo_list, topo_fc, nodes_fc,
+                   nodes_to_update, overwrite_data, proj)
+
+    del topo_list
+    gc.collect()
 
 #enable garbage collection
 gc.enable()
@@ -878,16 +655,24 @@ try:
     else:
         block_size = int(con_from_m * float(block_size) * 1000)
 
+    # Get the elevation raster properties once for all the blocks
+    z_info = raster_blocks.describe_raster(z_raster, con_z_to_m)
+    tile_cache = raster_cache.TileCache(tile_cache_dir)
+
+    # max elevation overviews for the far samples of the topo lines
+    z_pyramid = None
+    if pyramid_tolerance is not None:
+        z_pyramid = pyramid.DemPyramid(z_info, tile_cache, pyramid_tolerance,
+                                       searchDistance_max)
+
     # Get the elevation raster cell size in units of the raster
-    x_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEY").getOutput(0))
+    x_cellsize = z_info.x_cellsize
+    y_cellsize = z_info.y_cellsize
 
     if topo_directions == 2: # All directions
         azimuths = [45,90,135,180,225,270,315,365]
-        last_azimuth = 45
     else:
         azimuths = [270,180,90]
-        last_azimuth = 90
 
     azimuthdict = {45:"TOPO_NE",90:"TOPO_E",135:"TOPO_SE",
                    180:"TOPO_S",225:"TOPO_SW",270:"TOPO_W",
@@ -918,12 +703,24 @@ try:
     # Read the feature class data into a nested dictionary
     nodeDict = read_nodes_fc(nodes_fc, overwrite_data, addFields)
 
+    # Topo lines sampled from the horizon rasters
+    stored = {}
+    if topo_method == "HORIZON":
+        horizons = {}
+        for a in azimuths:
+            if a in horizon.DIRECTIONS:
+                horizons[a] = horizon.HorizonRaster(tile_cache, z_info, a,
+                                                    searchDistance_max,
+                                                    azimuthdisdict[a], con_to_m)
+        stored = horizon_topo_samples(nodeDict, horizons, searchDistance_max)
+        arcpy.AddMessage("{0} topo lines from the horizon rasters, {1} horizon tiles built".format(
+            len(stored), sum(raster.built for raster in horizons.values())))
+        del horizons
+
     # Build the blockDict
-    blockDict = create_blocks(nodeDict, block_size, last_azimuth,
-                              searchDistance_max)
+    blockDict = create_blocks(nodeDict, block_size, searchDistance_max)
 
     # Itterate through each block
-    total_samples = 0
     blockIDs = blockDict.keys()
     blockIDs.sort()
 
@@ -940,51 +737,21 @@ try:
         # convert raster to array, sample the raster
         # calculate the topo angles and other info
         topo_samples = get_topo_angles(nodeDict, block_extent , block_samples,
-                                   z_raster, azimuthdisdict,
-                                   searchDistance_max, con_z_to_m)
+                                   z_info, azimuthdisdict,
+                                   searchDistance_max, tile_cache, z_pyramid,
+                                   stored)
         if topo_samples:
-            # Update the nodeDict
-            for sample in topo_samples:
-                nodeID = sample[5]
-                a = sample[6]
-                topoAngle = sample[7]
-
-                # Create a key to hold the topo list info for this block
-                topo_key = azimuthdict[a] + "_list"
-
-                if azimuthdict[a] in nodeDict[nodeID]:
-                    if nodeDict[nodeID][azimuthdict[a]] < topoAngle:
-                        nodeDict[nodeID][azimuthdict[a]] = topoAngle
-                        nodeDict[nodeID][topo_key] = sample
-
-                else:
-                    nodeDict[nodeID][azimuthdict[a]] = topoAngle
-                    nodeDict[nodeID][topo_key] = sample
-
+            update_node_dict(nodeDict, topo_samples, azimuthdict)
             del topo_samples
 
         # Check if any nodes can be updated in the node and topo fc
         if blockDict[blockID]["nodes_to_update"]:
-            nodes_to_update = blockDict[blockID]["nodes_to_update"]
-
-            # Write the topo data to the TTools point feature class
-            update_nodes_fc(nodeDict, nodes_fc, addFields, nodes_to_update)
-
-            # Build/add to the output topo feature class
-            topo_list = []
-            for nodeID in nodes_to_update:
-                for field in addFields:
-                    topo_key = field + "_list"
-                    topo_list.append(nodeDict[nodeID][topo_key])
-                    # delete some data
-                    nodeDict[nodeID].pop(field, None)
-                    nodeDict[nodeID].pop(topo_key, None)
-                    nodeDict[nodeID].pop("updated", None)
-            update_topo_fc(topo_list, topo_fc, nodes_fc,
-                           nodes_to_update, overwrite_data, proj)
-
-            del topo_list
-            gc.collect()
+            write_nodes(nodeDict, blockDict[blockID]["nodes_to_update"],
+                        addFields, proj)
+
+    arcpy.AddMessage("Raster reads {0}, cached tiles used {1}, {2:.0f} bytes read per node".format(
+        tile_cache.reads, tile_cache.hits + tile_cache.disk_hits,
+        tile_cache.bytes_read / max(len(nodeDict), 1)))
 
     endTime = time.time()
     elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
@@ -77,6 +77,9 @@ import numpy
 import arcpy
 from arcpy import env
 
+import raster_blocks
+import raster_cache
+
 env.overwriteOutput = True
 
 def str_to_bool(s):
@@ -134,6 +137,9 @@ lc_point_fc = arcpy.GetParameterAsText(15)
 block_size = int(arcpy.GetParameterAsText(16)) # OPTIONAL defualt to 5
 overwrite_data = arcpy.GetParameterAsText(17)
 overwrite_data = str_to_bool(overwrite_data)
+tile_cache_dir = arcpy.GetParameterAsText(18) # OPTIONAL folder to cache the raster tiles
+if tile_cache_dir in ["#", ""]:
+    tile_cache_dir = None
 
 
 def nested_dict():
@@ -370,117 +376,36 @@ def create_block_list(nodes, block_size):
     # all the landcover samples for each node.
     buffer = int((transsample_count + 1) * transsample_distance * con_from_m)
 
-    # calculate bounding box extent for samples
-    x_min = min(x_coord_list)
-    x_max = max(x_coord_list)
-    y_min = min(y_coord_list)
-    y_max = max(y_coord_list)
-
-    x_width = int(x_max - x_min + 1)
-    y_width = int(y_max - y_min + 1)
+    # Group the nodes into blocks, each block extent is minimized
+    # to the true extent of the nodes in the block
+    extents, members = raster_blocks.plan_blocks(x_coord_list, y_coord_list,
+                                                 block_size)
 
     block_extents = []
     block_nodes = []
-
-    # Build data blocks
-    for x in range(0, x_width, block_size):
-        for y in range(0, y_width, block_size):
-
-            # Lower left coordinate of block (in map units)
-            block0_x_min = min([x_min + x, x_max])
-            block0_y_min = min([y_min + y, y_max])
-            # Upper right coordinate of block (in map units)
-            block0_x_max = min([block0_x_min + block_size, x_max])
-            block0_y_max = min([block0_y_min + block_size, y_max])
-
-            block_x_min = block0_x_max
-            block_x_max = block0_x_min
-            block_y_min = block0_y_max
-            block_y_max = block0_y_min
-
-            nodes_in_block = []
-            for nodeID in nodes:
-                node_x = nodeDict[nodeID]["POINT_X"]
-                node_y = nodeDict[nodeID]["POINT_Y"]
-                if (block0_x_min <= node_x <= block0_x_max and
-                    block0_y_min <= node_y <= block0_y_max):
-
-                    nodes_in_block.append(nodeID)
-
-                    # Minimize the size of the block0 by the true
-                    # extent of the nodes in the block
-                    if block_x_min > node_x: block_x_min = node_x
-                    if block_x_max < node_x: block_x_max = node_x
-                    if block_y_min > node_y: block_y_min = node_y
-                    if block_y_max < node_y: block_y_max = node_y
-
-            if nodes_in_block:
-                # add the block extent for processing
-                # order 0 left,      1 bottom,    2 right,     3 top
-                block_extents.append((block_x_min - buffer, block_y_min - buffer,
-                                      block_x_max + buffer, block_y_max + buffer))
-                block_nodes.append(nodes_in_block)
+    for extent, member in zip(extents, members):
+        # add the block extent for processing
+        # order 0 left,      1 bottom,    2 right,     3 top
+        block_extents.append((extent[0] - buffer, extent[1] - buffer,
+                              extent[2] + buffer, extent[3] + buffer))
+        block_nodes.append([nodes[i] for i in member.tolist()])
 
     return block_extents, block_nodes
 
-def sample_raster(block, lc_point_list, raster, con):
+def sample_raster(block, lc_point_list, raster_info, tile_cache):
 
-    if con is not None:
-        nodata_to_value = -9999 / con
-    else:
-        nodata_to_value = -9999
-
-    # localize the block extent values
-    block_x_min = block[0]
-    block_y_min = block[1]
-    block_x_max = block[2]
-    block_y_max = block[3]
-
-    x_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEX").getOutput(0))
-    y_cellsize = float(arcpy.GetRasterProperties_management(z_raster, "CELLSIZEY").getOutput(0))
-
-    # Get the coordinates extent of the input raster
-    raster_x_min = float(arcpy.GetRasterProperties_management(raster, "LEFT").getOutput(0))
-    raster_y_min = float(arcpy.GetRasterProperties_management(raster, "BOTTOM").getOutput(0))
-    raster_x_max = float(arcpy.GetRasterProperties_management(raster, "RIGHT").getOutput(0))
-    raster_y_max = float(arcpy.GetRasterProperties_management(raster, "TOP").getOutput(0))
-
-    # Calculate the X and Y offset from the upper left node
-    # coordinates bounding box
-    x_minoffset = (block_x_min - raster_x_min)%x_cellsize
-    y_minoffset = (block_y_min - raster_y_min)%y_cellsize
-    x_maxoffset = (raster_x_max - block_x_max)%x_cellsize
-    y_maxoffset = (raster_y_max - block_y_max)%y_cellsize
-
-    # adjust so the coordinates are at the raster cell corners
-    block_x_min = block_x_min - x_minoffset
-    block_y_min = block_y_min - y_minoffset
-    block_x_max = block_x_max + x_maxoffset
-    block_y_max = block_y_max + y_maxoffset
-
-    # Get the lower left cell center coordinate. This is for ESRI's
-    # RastertoNumpyArray function which defaults to the adjacent
-    # lower left cell
-    block_x_min_center = block_x_min + (x_cellsize / 2)
-    block_y_min_center = block_y_min + (y_cellsize / 2)
-
-    # calculate the number or cols/ros from the lower left
-    ncols = max([int(ceil((block_x_max - block_x_min)/ x_cellsize)), 1])
-    nrows = max([int(ceil((block_y_max - block_y_min)/ y_cellsize)), 1])
-
-    # Construct the array. Note returned array is (row, col) so (y, x)
+    x_cellsize = raster_info.x_cellsize
+    y_cellsize = raster_info.y_cellsize
+
+    # Construct the array in meters with the block extent snapped to the
+    # raster cell corners. Note returned array is (row, col) so (y, x)
     try:
-        raster_array = arcpy.RasterToNumPyArray(raster, arcpy.Point(block_x_min_center, block_y_min_center),
-                                                ncols, nrows, nodata_to_value)
+        raster_array, block_x_min, block_y_max = tile_cache.read_block(raster_info, block)
     except:
         tbinfo = traceback.format_exc()
         pymsg = tbinfo + "\nError Info:\n" + "\nNot enough memory. Reduce the block size"
         sys.exit(pymsg)
 
-    # convert array values to meters if needed
-    if con is not None:
-        raster_array = raster_array * con
-
     lc_point_list_new = []
     if raster_array.max() > -9999:
         # There is at least one pixel of data
@@ -705,6 +630,19 @@ try:
     # Build the block list
     block_extents, block_nodes = create_block_list(nodes, block_size)
 
+    # Get the properties of each raster once for all the blocks
+    rasterInfo = {}
+    for type, raster in rasterDict.iteritems():
+        if raster is not None:
+            if raster == z_raster:
+                con = con_z_to_m
+            elif raster == lc_raster:
+                con = con_lc_to_m
+            else:
+                con = None
+            rasterInfo[type] = raster_blocks.describe_raster(raster, con)
+    tile_cache = raster_cache.TileCache(tile_cache_dir)
+
     # Itterate through each block, calculate sample coordinates,
     # convert raster to array, sample the raster
     total_samples = 0
@@ -723,14 +661,8 @@ try:
                 for i in range(0, len(lc_point_list)):
                     lc_point_list[i].append(-9999)
             else:
-                if raster == z_raster:
-                    con = con_z_to_m
-                elif raster == lc_raster:
-                    con = con_lc_to_m
-                else:
-                    con = None
-
-                lc_point_list = sample_raster(block, lc_point_list, raster, con)
+                lc_point_list = sample_raster(block, lc_point_list,
+                                              rasterInfo[type], tile_cache)
 
             # Update the node fc
             for row in lc_point_list:
@@ -748,6 +680,9 @@ try:
         del lc_point_list
         gc.collect()
 
+    arcpy.AddMessage("Raster reads {0}, cached tiles used {1}".format(
+        tile_cache.reads, tile_cache.hits + tile_cache.disk_hits))
+
     endTime = time.time()
 
     elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
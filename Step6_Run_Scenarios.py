@@ -0,0 +1,165 @@
+#-------------------------------------------------------------------------------
+# Name:        Step_6_Run_Scenarios
+# Purpose:      Calculate effective shade for many vegetation scenarios with
+#               the python shade engine and save them to one csv table
+#
+# Author:      George
+#
+# Created:     18/10/2026
+# Copyright:   (c) George 2017
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+# The node table is read once and every scenario is evaluated against it
+# in this process, or split over a process pool (see scenarios.py). The
+# output csv has one row per scenario and NODE_ID. The python shade
+# engine is experimental and not equivalent to the macro (see
+# shade_engine.py), compare scenarios with each other rather than with
+# macro runs.
+
+# Import system modules
+from __future__ import division, print_function
+import os
+import sys
+import gc
+import time
+import traceback
+from math import ceil
+import multiprocessing
+import arcpy
+
+import node_table
+import scenarios
+import solar_cache
+
+#enable garbage collection
+gc.enable()
+
+################################################################################
+##nodes_fc = r"C:\Google Drive\SiCr_Digitization\shadeOutput\nodes_fc.shp"
+##scenarioFile = r"C:\Google Drive\SiCr_Digitization\scripts\scenarios.json"
+##outputTable = r"C:\Google Drive\SiCr_Digitization\shadeOutput\scenarios.csv"
+##startDate = "08/01/2016"
+##numberDays = 1
+##lat = 43.28
+##longi = -114.02
+##timeZone = -8
+##daylightSavings = "Yes"
+##globalRiparianZoneWidth = 30.48
+##cloudCover = 0
+##brasVisibilityFactor = 2
+##ryanStolzenbachFactor = 0.8
+##elevationOrZone = "Elevation"
+##riparianExtinction = "On"
+##processes = 4 # OPTIONAL default 1, 0 uses every core
+##ephemeris_cache_dir = r"C:\Google Drive\SiCr_Digitization\ephemeris" # OPTIONAL
+
+
+################################################################################
+
+nodes_fc = arcpy.GetParameterAsText(0)
+scenarioFile = arcpy.GetParameterAsText(1) # OPTIONAL default is scenarios.PRESETS
+outputTable = arcpy.GetParameterAsText(2)
+startDate = arcpy.GetParameterAsText(3)
+numberDays = arcpy.GetParameterAsText(4)
+lat = arcpy.GetParameterAsText(5)
+longi = arcpy.GetParameterAsText(6)
+timeZone = arcpy.GetParameterAsText(7)
+daylightSavings = arcpy.GetParameterAsText(8)
+globalRiparianZoneWidth = arcpy.GetParameterAsText(9)
+cloudCover = arcpy.GetParameterAsText(10)
+brasVisibilityFactor = arcpy.GetParameterAsText(11)
+ryanStolzenbachFactor = arcpy.GetParameterAsText(12)
+elevationOrZone = arcpy.GetParameterAsText(13)
+riparianExtinction = arcpy.GetParameterAsText(14)
+
+# OPTIONAL number of processes, default 1 runs the scenarios in this
+# process, 0 uses every core
+processes = arcpy.GetParameterAsText(15)
+if processes in ["#", ""]:
+    processes = 1
+processes = int(processes)
+
+# OPTIONAL folder to keep the sun position tables between runs (see
+# solar_cache.py). Blank keeps them in memory only.
+ephemeris_cache_dir = arcpy.GetParameterAsText(16)
+if ephemeris_cache_dir in ["#", ""]:
+    ephemeris_cache_dir = None
+
+
+################################################################################
+
+# the pool workers import this script, only run the tool in the main process
+if __name__ == "__main__":
+    try:
+        arcpy.AddMessage("Step 6: Run Scenarios")
+        print("Step 6: Run Scenarios")
+
+        #keeping track of time
+        startTime= time.time()
+
+        # Check if the node fc exists
+        if not arcpy.Exists(nodes_fc):
+            arcpy.AddError("\nThis output does not exist: \n" +
+                           "{0}\n".format(nodes_fc))
+            sys.exit("This output does not exist: \n" +
+                     "{0}\n".format(nodes_fc))
+
+        if scenarioFile in ["#", ""]:
+            scenarioList = list(scenarios.PRESETS.values())
+        else:
+            scenarioList = scenarios.load_scenarios(scenarioFile)
+
+        nodeTable = node_table.read_node_table(nodes_fc, node_table.STEP6_FIELDS)
+
+        settings = (startDate, numberDays, lat, longi, timeZone,
+                    daylightSavings, globalRiparianZoneWidth, cloudCover,
+                    brasVisibilityFactor, ryanStolzenbachFactor,
+                    elevationOrZone, riparianExtinction)
+
+        cache = solar_cache.EphemerisCache(ephemeris_cache_dir)
+        if processes == 1:
+            results = scenarios.run_batch(nodeTable, scenarioList, *settings,
+                                          cache=cache)
+        else:
+            # inside ArcGIS sys.executable is ArcMap/ArcGIS Pro, the workers
+            # need to be started with python
+            python = os.path.join(sys.exec_prefix, "python.exe")
+            if os.path.exists(python):
+                multiprocessing.set_executable(python)
+            results = scenarios.run_batch_parallel(nodeTable, scenarioList,
+                                                   *settings, cache=cache,
+                                                   processes=processes or None)
+
+        for name, shade in results.items():
+            print("{0}: mean shade {1:.3f}".format(name, shade.mean()))
+            arcpy.AddMessage("{0}: mean shade {1:.3f}".format(name, shade.mean()))
+
+        scenarios.write_results(outputTable, nodeTable["NODE_ID"].tolist(), results)
+
+        endTime = time.time()
+
+        elapsedmin= ceil(((endTime - startTime) / 60)* 10)/10
+
+        print("Process Complete in {0} minutes".format(elapsedmin))
+        arcpy.AddMessage("Process Complete in %s minutes" % (elapsedmin))
+
+
+    # For arctool errors
+    except arcpy.ExecuteError:
+        msgs = arcpy.GetMessages(2)
+        arcpy.AddError(msgs)
+        print(msgs)
+
+    # For other errors
+    except:
+        tbinfo = traceback.format_exc()
+
+        pymsg = "PYTHON ERRORS:\n" + tbinfo + "\nError Info:\n" +str(sys.exc_info()[1])
+        msgs = "ArcPy ERRORS:\n" + arcpy.GetMessages(2) + "\n"
+
+        arcpy.AddError(pymsg)
+        arcpy.AddError(msgs)
+
+        print(pymsg)
+        print(msgs)
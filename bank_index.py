@@ -0,0 +1,699 @@
+########################################################################
+# TTools
+# Bank segment spatial index for Step 2
+
+# The bank polylines are split into their line segments, an (M, 2, 2)
+# array of [[x0, y0], [x1, y1]], and each segment is registered in the
+# cells of a uniform grid covered by its bounding box. The nearest
+# segment to every node is found in one batch: each node searches the
+# grid cells within r cells of its own cell, and r grows for the nodes
+# whose nearest candidate is further away than r cells (a closer
+# segment could be outside the searched cells). The cost per node
+# depends on the number of segments near the node instead of the whole
+# basin's bank geometry. nearest_segments() is the same query without an
+# index (every node against every segment in chunks of CHUNK_PAIRS) for
+# small inputs and checks.
+
+# cast_rays() walks rays (the Step 2 transects perpendicular to the
+# stream) through the grid a few cells at a time and returns the first
+# bank segment crossed.
+
+# channel_width() measures the nodes to both banks. measure_parallel()
+# does the same with the streams split over a process pool.
+
+# Banks are keyed to streams so each stream's nodes only query the bank
+# segments of their own channel (StreamBankIndex). The stream of each
+# bank feature comes from a stream ID field on the bank feature class or,
+# if there is none, is assigned once to the stream with the nearest
+# centerline (the stream's nodes joined in STREAM_KM order).
+
+# This module does not need arcpy except for read_segments().
+
+########################################################################
+
+from __future__ import division, print_function
+import time
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+# maximum number of node/segment pairs evaluated at once
+CHUNK_PAIRS = 2000000
+
+# length in grid cells of the ray pieces searched at once by cast_rays()
+RAY_PIECE = 8
+
+
+def read_segments(polyline_fc, proj=None, whereclause="", field="OID@"):
+    """Reads the line segments of every part of every feature in a
+    polyline feature class. Returns the (M, 2, 2) segment array and the
+    value of field (default OBJECTID) of the feature of each segment"""
+    import arcpy
+
+    segments = []
+    values = []
+    with arcpy.da.SearchCursor(polyline_fc, ["SHAPE@", field],
+                               whereclause, proj) as cursor:
+        for row in cursor:
+            for part in row[0]:
+                xy = [(pnt.X, pnt.Y) for pnt in part if pnt]
+                for i in range(len(xy) - 1):
+                    segments.append((xy[i], xy[i + 1]))
+                    values.append(row[1])
+    return np.array(segments, dtype=float).reshape(-1, 2, 2), np.array(values)
+
+
+def point_segment_distance(px, py, segments):
+    """Returns the distance from each point to the matching segment and
+    the position (0-1) of the nearest point along the segment. px, py are
+    (K,) arrays and segments is (K, 2, 2)."""
+    x0 = segments[:, 0, 0]
+    y0 = segments[:, 0, 1]
+    dx = segments[:, 1, 0] - x0
+    dy = segments[:, 1, 1] - y0
+    length2 = dx * dx + dy * dy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((px - x0) * dx + (py - y0) * dy) / length2
+    # zero length segments are a point
+    t = np.where(length2 > 0, np.clip(t, 0.0, 1.0), 0.0)
+    return np.hypot(x0 + t * dx - px, y0 + t * dy - py), t
+
+
+def ray_segment_intersection(px, py, dx, dy, segments):
+    """Returns the distance along each ray (px, py) + s * (dx, dy) to
+    where it crosses the matching segment, inf if it does not. (dx, dy)
+    are unit vectors, segments is (K, 2, 2). Parallel segments are not
+    crossed."""
+    x0 = segments[:, 0, 0]
+    y0 = segments[:, 0, 1]
+    ex = segments[:, 1, 0] - x0
+    ey = segments[:, 1, 1] - y0
+    wx = x0 - px
+    wy = y0 - py
+    denom = dx * ey - dy * ex
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = (wx * ey - wy * ex) / denom
+        u = (wx * dy - wy * dx) / denom
+    crosses = (denom != 0) & (s >= 0) & (u >= 0) & (u <= 1)
+    return np.where(crosses, s, np.inf)
+
+
+def _nearest_pairs(x, y, segments, chunk_pairs=CHUNK_PAIRS):
+    """Nearest of all the segments for each point. Returns the distance,
+    segment index and position along the segment (see
+    point_segment_distance()). At most chunk_pairs point/segment pairs
+    are evaluated at once."""
+    n = len(x)
+    m = len(segments)
+    distance = np.empty(n)
+    segment = np.empty(n, dtype=np.int64)
+    t_best = np.empty(n)
+    x0 = segments[:, 0, 0]
+    y0 = segments[:, 0, 1]
+    dx = segments[:, 1, 0] - x0
+    dy = segments[:, 1, 1] - y0
+    length2 = dx * dx + dy * dy
+    zero = length2 == 0
+    length2 = np.where(zero, 1.0, length2)
+
+    step = max(1, chunk_pairs // max(m, 1))
+    for s in range(0, n, step):
+        e = min(s + step, n)
+        # (points, segments) pairs by broadcasting
+        px = x[s:e, np.newaxis] - x0
+        py = y[s:e, np.newaxis] - y0
+        t = np.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+        t[:, zero] = 0.0
+        d2 = (t * dx - px) ** 2 + (t * dy - py) ** 2
+        best = d2.argmin(axis=1)
+        rows = np.arange(e - s)
+        distance[s:e] = np.sqrt(d2[rows, best])
+        segment[s:e] = best
+        t_best[s:e] = t[rows, best]
+    return distance, segment, t_best
+
+
+def nearest_segments(points, segments, chunk_pairs=CHUNK_PAIRS):
+    """Finds the nearest of the (M, 2, 2) segments to each point of an
+    (N, 2) array without an index, in chunks of at most chunk_pairs
+    point/segment pairs. Returns the distance, the segment index and the
+    nearest point on the segment as an (N, 2) array."""
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    segments = np.asarray(segments, dtype=float).reshape(-1, 2, 2)
+    if len(segments) == 0:
+        raise ValueError("There are no segments")
+    distance, segment, t = _nearest_pairs(points[:, 0], points[:, 1],
+                                          segments, chunk_pairs)
+    seg = segments[segment]
+    nearest_xy = seg[:, 0] + t[:, np.newaxis] * (seg[:, 1] - seg[:, 0])
+    return distance, segment, nearest_xy
+
+
+class SegmentIndex(object):
+    """Uniform grid index of line segments. cellSize is in map units, the
+    default is about the mean segment length."""
+
+    def __init__(self, segments, cellSize=None):
+        self.segments = np.asarray(segments, dtype=float).reshape(-1, 2, 2)
+        n = len(self.segments)
+        if n == 0:
+            raise ValueError("There are no bank segments to index")
+
+        seg_min = self.segments.min(axis=1)
+        seg_max = self.segments.max(axis=1)
+        self.x_min, self.y_min = seg_min.min(axis=0)
+        x_max, y_max = seg_max.max(axis=0)
+
+        if cellSize is None:
+            lengths = np.hypot(*(self.segments[:, 1] - self.segments[:, 0]).T)
+            cellSize = max(lengths.mean(), max(x_max - self.x_min,
+                                               y_max - self.y_min) / 1000)
+        self.cellSize = max(float(cellSize), 1e-9)
+        self.n_cols = int((x_max - self.x_min) / self.cellSize) + 1
+        self.n_rows = int((y_max - self.y_min) / self.cellSize) + 1
+
+        # register every segment in the cells of its bounding box
+        c0, r0 = self._cell(seg_min[:, 0], seg_min[:, 1])
+        c1, r1 = self._cell(seg_max[:, 0], seg_max[:, 1])
+        n_c = c1 - c0 + 1
+        n_r = r1 - r0 + 1
+        count = n_c * n_r
+        seg = np.repeat(np.arange(n), count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        cols = np.repeat(c0, count) + k % np.repeat(n_c, count)
+        rows = np.repeat(r0, count) + k // np.repeat(n_c, count)
+        cell = rows * self.n_cols + cols
+
+        order = np.argsort(cell, kind="mergesort")
+        self.cell_segments = seg[order]
+        cell = cell[order]
+        self.cell_ids, self.cell_start = np.unique(cell, return_index=True)
+        self.cell_count = np.diff(np.append(self.cell_start, len(cell)))
+
+    def _cell(self, x, y):
+        col = np.floor((x - self.x_min) / self.cellSize).astype(np.int64)
+        row = np.floor((y - self.y_min) / self.cellSize).astype(np.int64)
+        return col, row
+
+    def _candidates(self, col, row, r0, r1):
+        """Returns the point index and segment index of every segment
+        registered in the ring of cells more than r0 and up to r1 cells
+        from each point (r0 = -1 includes the point's cell), ordered by
+        point"""
+        offsets = np.arange(-r1, r1 + 1)
+        d_col = np.tile(offsets, len(offsets))
+        d_row = np.repeat(offsets, len(offsets))
+        ring = np.maximum(np.abs(d_col), np.abs(d_row)) > r0
+        d_col = d_col[ring]
+        d_row = d_row[ring]
+        cols = col[:, np.newaxis] + d_col
+        rows = row[:, np.newaxis] + d_row
+        valid = ((cols >= 0) & (cols < self.n_cols) &
+                 (rows >= 0) & (rows < self.n_rows))
+        point = np.repeat(np.arange(len(col)), valid.sum(axis=1))
+        cell = (rows * self.n_cols + cols)[valid]
+        return self._cell_pairs(point, cell)
+
+    def _box_cells(self, c0, r0, c1, r1):
+        """Returns the box index and grid cell of every cell from c0, r0
+        to c1, r1 of each box that is in the grid"""
+        c0 = np.maximum(c0, 0)
+        r0 = np.maximum(r0, 0)
+        n_c = np.maximum(np.minimum(c1, self.n_cols - 1) - c0 + 1, 0)
+        n_r = np.maximum(np.minimum(r1, self.n_rows - 1) - r0 + 1, 0)
+        count = n_c * n_r
+        box = np.repeat(np.arange(len(c0)), count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        cols = np.repeat(c0, count) + k % np.repeat(n_c, count)
+        rows = np.repeat(r0, count) + k // np.repeat(n_c, count)
+        return box, rows * self.n_cols + cols
+
+    def _cell_pairs(self, point, cell):
+        """Expands (point, grid cell) pairs to (point, segment) pairs"""
+        pos = np.searchsorted(self.cell_ids, cell)
+        pos = np.minimum(pos, len(self.cell_ids) - 1)
+        found = self.cell_ids[pos] == cell
+        point = point[found]
+        start = self.cell_start[pos[found]]
+        count = self.cell_count[pos[found]]
+
+        pair_point = np.repeat(point, count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        pair_seg = self.cell_segments[np.repeat(start, count) + k]
+        return pair_point, pair_seg
+
+    def _nearest_in_ring(self, x, y, col, row, r0, r1, distance, segment, t_best):
+        """Updates the nearest segment of each point with the segments in
+        the ring of cells from r0 to r1 (see _candidates())"""
+        n = len(x)
+        # keep the number of pairs per chunk bounded
+        ring_cells = (2 * r1 + 1) ** 2 - max(0, 2 * r0 + 1) ** 2
+        per_point = max(1, int(ring_cells * self.cell_count.mean()))
+        step = max(1, CHUNK_PAIRS // per_point)
+        for s in range(0, n, step):
+            e = min(s + step, n)
+            point, seg = self._candidates(col[s:e], row[s:e], r0, r1)
+            if len(point) == 0:
+                continue
+            point = point + s
+            d, t = point_segment_distance(x[point], y[point],
+                                          self.segments[seg])
+            # first pair of each point after sorting by point then distance
+            order = np.lexsort((seg, d, point))
+            point = point[order]
+            first = np.ones(len(point), dtype=bool)
+            first[1:] = point[1:] != point[:-1]
+            best = order[first]
+            point = point[first]
+            closer = (d[best] < distance[point]) | (
+                (d[best] == distance[point]) & (seg[best] < segment[point]))
+            point = point[closer]
+            best = best[closer]
+            distance[point] = d[best]
+            segment[point] = seg[best]
+            t_best[point] = t[best]
+
+    def _nearest_all(self, x, y):
+        """Nearest segment for each point checking every segment"""
+        return _nearest_pairs(x, y, self.segments)
+
+    def nearest(self, points):
+        """Finds the nearest segment to each point. points is an (N, 2)
+        array. Returns the distance, the segment index and the nearest
+        point on the segment as an (N, 2) array."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        n = len(points)
+        x = points[:, 0]
+        y = points[:, 1]
+        col, row = self._cell(x, y)
+
+        distance = np.full(n, np.inf)
+        segment = np.full(n, -1, dtype=np.int64)
+        t = np.zeros(n)
+
+        # distance from each point to the edge of its own cell
+        cell_x = x - (self.x_min + col * self.cellSize)
+        cell_y = y - (self.y_min + row * self.cellSize)
+        edge = np.maximum(0.0, np.minimum.reduce([cell_x, self.cellSize - cell_x,
+                                                  cell_y, self.cellSize - cell_y]))
+
+        # points outside the grid start from the ring that reaches it
+        outside = np.maximum.reduce([-col, col - self.n_cols + 1,
+                                     -row, row - self.n_rows + 1,
+                                     np.zeros(n, dtype=np.int64)])
+        max_r = max(self.n_cols, self.n_rows)
+        far = outside >= max_r
+        if far.any():
+            # the first ring already covers the whole grid
+            distance[far], segment[far], t[far] = self._nearest_all(x[far], y[far])
+
+        todo = np.nonzero(~far)[0]
+        r0 = np.full(n, -1, dtype=np.int64)
+        r1 = outside.copy()
+        while len(todo):
+            for key in set(zip(r0[todo].tolist(), r1[todo].tolist())):
+                sel = todo[(r0[todo] == key[0]) & (r1[todo] == key[1])]
+                d, s, tt = distance[sel], segment[sel], t[sel]
+                self._nearest_in_ring(x[sel], y[sel], col[sel], row[sel],
+                                      key[0], key[1], d, s, tt)
+                distance[sel], segment[sel], t[sel] = d, s, tt
+
+            # a point is done if the nearest segment is closer than any
+            # cell that has not been searched or all the cells were searched
+            reach = r1[todo] * self.cellSize + edge[todo]
+            done = (distance[todo] <= reach) | (r1[todo] - outside[todo] >= max_r)
+            todo = todo[~done]
+            r0[todo] = r1[todo]
+            r1[todo] = np.maximum(2 * r1[todo], r1[todo] + 1)
+
+        seg = self.segments[segment]
+        nearest_xy = seg[:, 0] + t[:, np.newaxis] * (seg[:, 1] - seg[:, 0])
+        return distance, segment, nearest_xy
+
+
+    def cast_rays(self, origins, directions, max_distance):
+        """Finds the first segment crossed by a ray from each origin in
+        the direction of the matching unit vector, up to max_distance
+        map units. origins and directions are (N, 2) arrays. Returns
+        the distance (inf if no segment is crossed) and the crossing
+        point as an (N, 2) array (nan if none)."""
+        origins = np.asarray(origins, dtype=float).reshape(-1, 2)
+        directions = np.asarray(directions, dtype=float).reshape(-1, 2)
+        n = len(origins)
+        x, y = origins[:, 0], origins[:, 1]
+        dx, dy = directions[:, 0], directions[:, 1]
+        distance = np.full(n, np.inf)
+
+        # walk the rays through the grid in pieces of RAY_PIECE cells, a
+        # crossing found in one piece is closer than any in the next. A
+        # piece is split in one cell steps and each step is in the (up
+        # to 2 x 2) cells of its bounding box.
+        piece = RAY_PIECE * self.cellSize
+        per_point = max(1, int(4 * RAY_PIECE * self.cell_count.mean()))
+        step = max(1, CHUNK_PAIRS // per_point)
+        # the rays stop where they leave the grid (slab method)
+        x_max = self.x_min + self.n_cols * self.cellSize
+        y_max = self.y_min + self.n_rows * self.cellSize
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tx0 = (self.x_min - x) / dx
+            tx1 = (x_max - x) / dx
+            ty0 = (self.y_min - y) / dy
+            ty1 = (y_max - y) / dy
+        inside_x = (x >= self.x_min) & (x <= x_max)
+        inside_y = (y >= self.y_min) & (y <= y_max)
+        t_near = np.maximum(np.where(dx == 0, np.where(inside_x, -np.inf, np.inf),
+                                     np.minimum(tx0, tx1)),
+                            np.where(dy == 0, np.where(inside_y, -np.inf, np.inf),
+                                     np.minimum(ty0, ty1)))
+        t_far = np.minimum(np.where(dx == 0, np.where(inside_x, np.inf, -np.inf),
+                                    np.maximum(tx0, tx1)),
+                           np.where(dy == 0, np.where(inside_y, np.inf, -np.inf),
+                                    np.maximum(ty0, ty1)))
+        ray_end = np.where(t_near <= t_far, np.minimum(t_far, max_distance), -1.0)
+
+        todo = np.nonzero(ray_end >= 0)[0]
+        s0 = 0.0
+        while len(todo):
+            s1 = min(s0 + piece, max_distance)
+            ends = np.linspace(s0, s1, RAY_PIECE + 1)
+            for c in range(0, len(todo), step):
+                sel = todo[c:c + step]
+                x0 = x[sel, np.newaxis] + dx[sel, np.newaxis] * ends[:-1]
+                y0 = y[sel, np.newaxis] + dy[sel, np.newaxis] * ends[:-1]
+                x1 = x[sel, np.newaxis] + dx[sel, np.newaxis] * ends[1:]
+                y1 = y[sel, np.newaxis] + dy[sel, np.newaxis] * ends[1:]
+                c0, r0 = self._cell(np.minimum(x0, x1).ravel(),
+                                    np.minimum(y0, y1).ravel())
+                c1, r1 = self._cell(np.maximum(x0, x1).ravel(),
+                                    np.maximum(y0, y1).ravel())
+                box, cell = self._box_cells(c0, r0, c1, r1)
+                # each cell once per point
+                key = np.unique(box // RAY_PIECE * (self.n_cols * self.n_rows) + cell)
+                point, seg = self._cell_pairs(key // (self.n_cols * self.n_rows),
+                                              key % (self.n_cols * self.n_rows))
+                if len(point) == 0:
+                    continue
+                p = sel[point]
+                d = ray_segment_intersection(x[p], y[p], dx[p], dy[p],
+                                             self.segments[seg])
+                d[d > s1] = np.inf
+                np.minimum.at(distance, p, d)
+            todo = todo[np.isinf(distance[todo]) & (ray_end[todo] > s1)]
+            s0 = s1
+
+        hit = np.isfinite(distance)
+        crossing_xy = np.full((n, 2), np.nan)
+        crossing_xy[hit] = origins[hit] + distance[hit, np.newaxis] * directions[hit]
+        return distance, crossing_xy
+
+
+def centerline_segments(node_xy, node_sid):
+    """Joins consecutive nodes of the same stream into centerline
+    segments. The nodes must be ordered by stream and STREAM_KM. Returns
+    the (M, 2, 2) segments and the stream ID of each."""
+    node_xy = np.asarray(node_xy, dtype=float).reshape(-1, 2)
+    node_sid = np.asarray(node_sid)
+    same = node_sid[1:] == node_sid[:-1]
+    segments = np.stack((node_xy[:-1][same], node_xy[1:][same]), axis=1)
+    segment_sid = node_sid[:-1][same]
+
+    # streams with one node are a zero length segment
+    has_segment = np.zeros(len(node_xy), dtype=bool)
+    has_segment[:-1] |= same
+    has_segment[1:] |= same
+    single = ~has_segment
+    segments = np.concatenate((segments, np.stack((node_xy[single],
+                                                   node_xy[single]), axis=1)))
+    segment_sid = np.concatenate((segment_sid, node_sid[single]))
+    return segments, segment_sid
+
+
+def assign_to_streams(segments, feature_ids, node_xy, node_sid, samples=20):
+    """Assigns every bank feature to the stream with the nearest
+    centerline (the nodes joined in order, see centerline_segments()) to
+    its segment midpoints, by majority of up to samples segments per
+    feature. Returns the stream ID of each segment."""
+    feature_ids = np.asarray(feature_ids)
+    features, feature_inv = np.unique(feature_ids, return_inverse=True)
+
+    # evenly spaced sample of the segments of each feature
+    order = np.argsort(feature_inv, kind="mergesort")
+    count = np.bincount(feature_inv)
+    start = np.cumsum(count) - count
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(start, count)
+    step = np.maximum(count // samples, 1)[feature_inv]
+    sample = rank % step == 0
+
+    centerline, centerline_sid = centerline_segments(node_xy, node_sid)
+    centerline_index = SegmentIndex(centerline)
+    midpoints = segments[sample].mean(axis=1)
+    sample_sid = centerline_sid[centerline_index.nearest(midpoints)[1]]
+
+    # majority vote of the sampled segments of each feature
+    sids, sid_inv = np.unique(sample_sid, return_inverse=True)
+    votes = np.zeros((len(features), len(sids)), dtype=np.int64)
+    np.add.at(votes, (feature_inv[sample], sid_inv), 1)
+    return sids[votes.argmax(axis=1)][feature_inv]
+
+
+# SegmentIndex arrays copied to shared memory by StreamBankIndex.share()
+_SHARED_ARRAYS = {"segments": (ctypes.c_double, np.float64),
+                  "cell_segments": (ctypes.c_int64, np.int64),
+                  "cell_ids": (ctypes.c_int64, np.int64),
+                  "cell_start": (ctypes.c_int64, np.int64),
+                  "cell_count": (ctypes.c_int64, np.int64)}
+
+
+class StreamBankIndex(object):
+    """One SegmentIndex per stream. segment_sid is the stream ID of each
+    segment. Nodes of a stream without bank segments use all the
+    segments."""
+
+    def __init__(self, segments, segment_sid, cellSize=None):
+        segments = np.asarray(segments, dtype=float).reshape(-1, 2, 2)
+        segment_sid = np.asarray(segment_sid)
+        self.indexes = {}
+        order = np.argsort(segment_sid, kind="mergesort")
+        sids, start = np.unique(segment_sid[order], return_index=True)
+        for sid, idx in zip(sids.tolist(), np.split(order, start[1:])):
+            self.indexes[sid] = SegmentIndex(segments[idx], cellSize)
+        self.all_segments = SegmentIndex(segments, cellSize)
+        self.missing = set()
+
+    def share(self):
+        """Copies the arrays of all the indexes into shared memory
+        (RawArray) for worker processes. Returns the (layout, arrays)
+        to rebuild the index with from_shared()."""
+        items = [(False, sid, index) for sid, index in self.indexes.items()]
+        items.append((True, None, self.all_segments))
+        layout = []
+        parts = dict((k, []) for k in _SHARED_ARRAYS)
+        offsets = dict((k, 0) for k in _SHARED_ARRAYS)
+        for is_all, sid, index in items:
+            entry = {"all": is_all, "sid": sid, "x_min": index.x_min,
+                     "y_min": index.y_min, "cellSize": index.cellSize,
+                     "n_cols": index.n_cols, "n_rows": index.n_rows}
+            for k in _SHARED_ARRAYS:
+                values = getattr(index, k).ravel()
+                entry[k] = (offsets[k], offsets[k] + len(values))
+                offsets[k] += len(values)
+                parts[k].append(values)
+            layout.append(entry)
+
+        arrays = {}
+        for k, (ctype, dtype) in _SHARED_ARRAYS.items():
+            values = np.concatenate(parts[k]).astype(dtype)
+            arrays[k] = RawArray(ctype, max(len(values), 1))
+            np.frombuffer(arrays[k], dtype=dtype)[:len(values)] = values
+        return layout, arrays
+
+    @classmethod
+    def from_shared(cls, layout, arrays):
+        """Rebuilds an index from share() without copying the arrays"""
+        views = dict((k, np.frombuffer(arrays[k], dtype=dtype))
+                     for k, (ctype, dtype) in _SHARED_ARRAYS.items())
+        self = cls.__new__(cls)
+        self.indexes = {}
+        self.missing = set()
+        for entry in layout:
+            index = SegmentIndex.__new__(SegmentIndex)
+            for k in ["x_min", "y_min", "cellSize", "n_cols", "n_rows"]:
+                setattr(index, k, entry[k])
+            for k in _SHARED_ARRAYS:
+                start, stop = entry[k]
+                setattr(index, k, views[k][start:stop])
+            index.segments = index.segments.reshape(-1, 2, 2)
+            if entry["all"]:
+                self.all_segments = index
+            else:
+                self.indexes[entry["sid"]] = index
+        return self
+
+    def nearest(self, points, point_sid):
+        """Finds the nearest bank segment of each point's own stream.
+        Returns the distance and the nearest point as an (N, 2) array."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        point_sid = np.asarray(point_sid)
+        distance = np.empty(len(points))
+        nearest_xy = np.empty((len(points), 2))
+
+        order = np.argsort(point_sid, kind="mergesort")
+        sids, start = np.unique(point_sid[order], return_index=True)
+        for sid, idx in zip(sids.tolist(), np.split(order, start[1:])):
+            index = self.indexes.get(sid)
+            if index is None:
+                self.missing.add(sid)
+                index = self.all_segments
+            d, s, xy = index.nearest(points[idx])
+            distance[idx] = d
+            nearest_xy[idx] = xy
+        return distance, nearest_xy
+
+    def cast_rays(self, points, point_sid, directions, max_distance):
+        """Finds the first bank segment of each point's own stream
+        crossed by a ray in the direction of the matching unit vector,
+        see SegmentIndex.cast_rays(). Returns the distance and the
+        crossing point as an (N, 2) array."""
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        directions = np.asarray(directions, dtype=float).reshape(-1, 2)
+        point_sid = np.asarray(point_sid)
+        distance = np.empty(len(points))
+        crossing_xy = np.empty((len(points), 2))
+
+        order = np.argsort(point_sid, kind="mergesort")
+        sids, start = np.unique(point_sid[order], return_index=True)
+        for sid, idx in zip(sids.tolist(), np.split(order, start[1:])):
+            index = self.indexes.get(sid)
+            if index is None:
+                self.missing.add(sid)
+                index = self.all_segments
+            distance[idx], crossing_xy[idx] = index.cast_rays(
+                points[idx], directions[idx], max_distance)
+        return distance, crossing_xy
+
+
+def channel_width(node_xy, node_sid, rb_index, lb_index,
+                  width_method="NEAREST", node_azimuth=None,
+                  max_distance=None):
+    """Returns the distance from each node in the (N, 2) node_xy
+    array to the left and right bank segments of its stream, the
+    measured left and right bank points as (N, 2) arrays and the
+    method used for each node. NEAREST measures to the nearest bank
+    point, TRANSECT along the transect perpendicular to node_azimuth
+    (degrees) up to max_distance map units. Nodes where the transect
+    does not cross both banks use NEAREST."""
+    node_xy = np.asarray(node_xy, dtype=float).reshape(-1, 2)
+    if width_method == "TRANSECT":
+        # unit vectors to the left and right of the flow direction
+        azimuth = np.radians(node_azimuth)
+        left = np.column_stack((-np.cos(azimuth), np.sin(azimuth)))
+        lb_distance, lb_xy = lb_index.cast_rays(node_xy, node_sid, left,
+                                                max_distance)
+        rb_distance, rb_xy = rb_index.cast_rays(node_xy, node_sid, -left,
+                                                max_distance)
+        method = np.where(np.isfinite(lb_distance) & np.isfinite(rb_distance),
+                          "TRANSECT", "NEAREST")
+        nearest = method == "NEAREST"
+    else:
+        method = np.full(len(node_xy), "NEAREST", dtype="U8")
+        nearest = np.ones(len(node_xy), dtype=bool)
+        lb_distance = np.empty(len(node_xy))
+        rb_distance = np.empty(len(node_xy))
+        lb_xy = np.empty((len(node_xy), 2))
+        rb_xy = np.empty((len(node_xy), 2))
+
+    if nearest.any():
+        node_sid = np.asarray(node_sid)
+        rb_distance[nearest], rb_xy[nearest] = rb_index.nearest(node_xy[nearest],
+                                                                node_sid[nearest])
+        lb_distance[nearest], lb_xy[nearest] = lb_index.nearest(node_xy[nearest],
+                                                                node_sid[nearest])
+
+    return lb_distance, rb_distance, lb_xy, rb_xy, method
+
+
+# measure_parallel() gives each worker process the bank indexes and the
+# node coordinates in shared memory (RawArray, read only) when the pool
+# starts. A task is one stream's node range, and the results are streamed
+# back to the calling process as they finish (imap_unordered).
+
+_worker = {}
+
+
+def _init_worker(rb, lb, nodes, settings):
+    _worker["rb"] = StreamBankIndex.from_shared(*rb)
+    _worker["lb"] = StreamBankIndex.from_shared(*lb)
+    _worker["node_xy"] = np.frombuffer(nodes["xy"], dtype=float).reshape(-1, 2)
+    _worker["azimuth"] = np.frombuffer(nodes["azimuth"], dtype=float)
+    _worker["settings"] = settings
+
+
+def _measure_stream(task):
+    sid, start, stop = task
+    startTime = time.time()
+    width_method, max_distance = _worker["settings"]
+    result = channel_width(_worker["node_xy"][start:stop], [sid] * (stop - start),
+                           _worker["rb"], _worker["lb"], width_method,
+                           _worker["azimuth"][start:stop], max_distance)
+    return sid, start, result, time.time() - startTime
+
+
+def measure_parallel(node_xy, node_sid, rb_index, lb_index,
+                     width_method="NEAREST", node_azimuth=None,
+                     max_distance=None, processes=None):
+    """Same as channel_width() with the streams split over a
+    multiprocessing pool. The nodes of each stream must be consecutive.
+    processes defaults to the number of cores. Returns the
+    channel_width() arrays and a dictionary of the seconds taken to
+    measure each stream."""
+    node_xy = np.asarray(node_xy, dtype=float).reshape(-1, 2)
+    n = len(node_xy)
+    sid_list = np.asarray(node_sid).tolist()
+    if node_azimuth is None:
+        node_azimuth = np.zeros(n)
+
+    # one task per run of nodes with the same stream ID
+    breaks = [i for i in range(1, n) if sid_list[i] != sid_list[i - 1]]
+    starts = [0] + breaks
+    stops = breaks + [n]
+    tasks = [(sid_list[start], start, stop) for start, stop in zip(starts, stops)]
+
+    nodes = {"xy": RawArray(ctypes.c_double, max(2 * n, 1)),
+             "azimuth": RawArray(ctypes.c_double, max(n, 1))}
+    np.frombuffer(nodes["xy"], dtype=float)[:2 * n] = node_xy.ravel()
+    np.frombuffer(nodes["azimuth"], dtype=float)[:n] = node_azimuth
+
+    lb_distance = np.empty(n)
+    rb_distance = np.empty(n)
+    lb_xy = np.empty((n, 2))
+    rb_xy = np.empty((n, 2))
+    method = np.empty(n, dtype="U8")
+    seconds = {}
+
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, len(tasks) // (4 * processes))
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (rb_index.share(), lb_index.share(), nodes,
+                                 (width_method, max_distance)))
+    try:
+        for sid, start, result, t in pool.imap_unordered(_measure_stream, tasks,
+                                                         chunksize):
+            stop = start + len(result[0])
+            lb_distance[start:stop] = result[0]
+            rb_distance[start:stop] = result[1]
+            lb_xy[start:stop] = result[2]
+            rb_xy[start:stop] = result[3]
+            method[start:stop] = result[4]
+            seconds[sid] = seconds.get(sid, 0.0) + t
+    finally:
+        pool.close()
+        pool.join()
+
+    # the workers have their own copies of the indexes, record the
+    # streams without banks here
+    for index in [rb_index, lb_index]:
+        index.missing.update(sid for sid in seconds if sid not in index.indexes)
+
+    return (lb_distance, rb_distance, lb_xy, rb_xy, method), seconds
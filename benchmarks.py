@@ -0,0 +1,1758 @@
+#-------------------------------------------------------------------------------
+# Name:        benchmarks
+# Purpose:     Timing comparisons for the NumPy replacements of the slow
+#              parts of the TTools/Shade-a-lator scripts. These run on
+#              synthetic data and do not need arcpy.
+#
+# Usage:       python benchmarks.py            (runs all benchmarks)
+#              python benchmarks.py solar_cache (runs one benchmark)
+#
+# Author:      George
+#
+# Created:     18/10/2026
+# Copyright:   (c) George 2017
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+from __future__ import division, print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+from collections import OrderedDict
+import numpy as np
+
+
+def timeit(func, repeat=3):
+    """Returns the best wall time in seconds of repeat calls"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def synthetic_nodes(n_nodes, seed=0):
+    """Returns a Step 6 style node dictionary with random values"""
+    import shade_engine
+    rand = np.random.RandomState(seed)
+    nodes = {"ELEVATION": 1480 + rand.rand(n_nodes),
+             "STRM_AZMTH": rand.rand(n_nodes) * 360,
+             "CHANWIDTH": 5 + rand.rand(n_nodes) * 30,
+             "TOPO_W": rand.rand(n_nodes) * 5,
+             "TOPO_S": rand.rand(n_nodes) * 5,
+             "TOPO_E": rand.rand(n_nodes) * 5,
+             "LATITUDE": 43.2 + rand.rand(n_nodes) * 0.2,
+             "LONGITUDE": -114.2 + rand.rand(n_nodes) * 0.2}
+    for f in shade_engine.LC_FIELDS_LEFT + shade_engine.LC_FIELDS_RIGHT:
+        nodes[f] = 1 + rand.randint(0, 800, n_nodes)
+    for f in shade_engine.ELE_FIELDS_LEFT + shade_engine.ELE_FIELDS_RIGHT:
+        nodes[f] = 1480 + rand.rand(n_nodes) * 2
+    return nodes
+
+
+def bench_shade_engine():
+    """Python shade engine vs. the macro on the bundled output.xlsx/
+    output2.xlsx sample on the held out odd NODE_IDs, reported against
+    shade_engine.MACRO_TOLERANCE. The topo and veg parts of the hourly
+    shade must add up to it."""
+    import shade_engine
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    main_menu = os.path.join(here, "output.xlsx")
+    results = os.path.join(here, "output2.xlsx")
+    nodeIDs = [i for i in shade_engine.read_shade_results(results)["NODE_ID"]
+               if i % 2 == 1]
+    start = time.time()
+    stats = shade_engine.compare_with_macro(main_menu, results, nodeIDs)
+    print("  {0} held out nodes in {1:.2f} s, engine mean {2:.4f}, macro mean "
+          "{3:.4f}, mean difference {4:.4f}, mean abs error {5:.4f}, max "
+          "{6:.4f}".format(stats["nodes"], time.time() - start,
+                           stats["engine_mean"], stats["macro_mean"],
+                           stats["mean_difference"], stats["mean_abs_error"],
+                           stats["max_abs_error"]))
+    failed = shade_engine.macro_failures(stats)
+    print("  equivalent to the macro: {0}".format(
+        "yes" if not failed else "no (" + ", ".join(failed) + "), experimental"))
+
+    nodes, settings = shade_engine.read_main_menu(main_menu)
+    r = shade_engine.calculate_shade(nodes, cache=False, **settings)
+    parts = np.nan_to_num(r["TOPO_SHADE"] + r["VEG_SHADE"] - r["HOURLY_SHADE"])
+    assert np.abs(parts).max() < 1e-9
+
+
+def bench_solar_cache():
+    """Cost of the solar position per node-hour when every node computes
+    its own ephemeris vs. looking it up in the lat/lon bucket cache"""
+    import shade_engine
+    import solar_cache
+
+    n_nodes = 2000
+    numberDays = 30
+    nodes = synthetic_nodes(n_nodes)
+    times = shade_engine.time_steps("08/01/2016", numberDays)
+    node_hours = n_nodes * len(times)
+    settings = ("-8", "Yes", "08/01/2016", numberDays)
+
+    def per_node():
+        for lat, lon in zip(nodes["LATITUDE"], nodes["LONGITUDE"]):
+            shade_engine.solar_position(lat, lon, times, "-8", "Yes")
+
+    groups = solar_cache.bucket_nodes(nodes["LATITUDE"], nodes["LONGITUDE"])
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        def cold():
+            cache = solar_cache.EphemerisCache(cache_dir=tmp_dir)
+            cache.clear()
+            for lat, lon in groups:
+                cache.get(lat, lon, *settings)
+
+        def disk():
+            cache = solar_cache.EphemerisCache(cache_dir=tmp_dir)
+            for lat, lon in groups:
+                cache.get(lat, lon, *settings)
+
+        warm_cache = solar_cache.EphemerisCache(cache_dir=None)
+
+        def warm():
+            for lat, lon in groups:
+                warm_cache.get(lat, lon, *settings)
+
+        t_node = timeit(per_node, 1)
+        t_cold = timeit(cold, 1)
+        t_disk = timeit(disk)
+        warm()
+        t_warm = timeit(warm)
+
+        # tables saved by another EPHEMERIS_VERSION are not read
+        version = solar_cache.EPHEMERIS_VERSION
+        solar_cache.EPHEMERIS_VERSION = version + 1
+        try:
+            cache = solar_cache.EphemerisCache(cache_dir=tmp_dir)
+            lat, lon = list(groups)[0]
+            cache.get(lat, lon, *settings)
+            assert cache.disk_hits == 0 and cache.misses == 1
+        finally:
+            solar_cache.EPHEMERIS_VERSION = version
+
+        # eviction and clear() only delete the table files of the cache
+        others = ["other.npz", "notes.txt"]
+        for name in others:
+            open(os.path.join(tmp_dir, name), "w").close()
+        cache = solar_cache.EphemerisCache(cache_dir=tmp_dir, max_disk_entries=0)
+        assert sorted(os.listdir(tmp_dir)) == sorted(others)
+        cache.get(lat, lon, *settings)
+        cache.clear()
+        assert sorted(os.listdir(tmp_dir)) == sorted(others)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print("{0} nodes, {1} time steps, {2} lat/lon buckets".format(
+        n_nodes, len(times), len(groups)))
+    for label, t in [("no cache, per node", t_node),
+                     ("bucket cache, cold", t_cold),
+                     ("bucket cache, from disk", t_disk),
+                     ("bucket cache, in memory", t_warm)]:
+        print("  {0:<26} {1:8.3f} s {2:10.4f} us/node-hour".format(
+            label, t, t / node_hours * 1e6))
+
+
+def bench_node_table():
+    """Step 6 node export: one cursor scan per field with Python loop
+    transforms vs. one scan into columns with vectorized transforms.
+    The cursor is emulated with a list of row tuples."""
+    import node_table
+
+    n_nodes = 80000
+    fields = node_table.STEP6_FIELDS
+    rand = np.random.RandomState(0)
+    rows = [tuple(v) for v in (rand.rand(n_nodes, len(fields)) * 1000 - 50).tolist()]
+
+    def cursor(fieldList):
+        index = [fields.index(f) for f in fieldList]
+        for row in rows:
+            yield tuple(row[i] for i in index)
+
+    def per_field():
+        data = {}
+        for f in fields:
+            values = [row[0] for row in cursor([f])]
+            if f in node_table.LC_FIELDS:
+                values = [max(int(v), 0) + 1 for v in values]
+            elif f in ["ELEVATION", "TOPO_W", "TOPO_S", "TOPO_E"]:
+                values = [max(float(v), 0) for v in values]
+            data[f] = values
+        return data
+
+    def one_scan():
+        table = node_table.rows_to_columns(list(cursor(fields)), fields)
+        data = {}
+        for f in fields:
+            if f in node_table.LC_FIELDS:
+                data[f] = node_table.offset_by_1(table[f]).tolist()
+            elif f in ["ELEVATION", "TOPO_W", "TOPO_S", "TOPO_E"]:
+                data[f] = node_table.set_to_zero(table[f]).tolist()
+            else:
+                data[f] = table[f].tolist()
+        return data
+
+    a = per_field()
+    b = one_scan()
+    assert all(a[f] == b[f] for f in fields)
+
+    t_field = timeit(per_field, 1)
+    t_scan = timeit(one_scan)
+    print("{0} nodes, {1} fields".format(n_nodes, len(fields)))
+    for label, t in [("one scan per field", t_field),
+                     ("single columnar scan", t_scan)]:
+        print("  {0:<26} {1:8.3f} s".format(label, t))
+
+
+def bench_scenarios():
+    """Evaluating N vegetation scenarios: rebuilding every input per
+    scenario (like the addVeg scripts) vs. scenarios.run_batch sharing the
+    node table and solar position"""
+    import node_table
+    import scenarios
+    import shade_engine
+    import solar_cache
+
+    n_nodes = 2000
+    nodes = synthetic_nodes(n_nodes)
+    table = dict((f, np.asarray(v)) for f, v in nodes.items())
+    scenarioList = list(scenarios.PRESETS.values())
+    for height in [5, 10, 15, 20]:
+        for bank in ["Left", "Right"]:
+            scenarioList.append(scenarios.Scenario(
+                "{0}_{1}m".format(bank, height),
+                [scenarios.VegRule(bank, [1, 2, 3], height=height)]))
+    settings = ("08/01/2016", 1, 43.28, -114.02, -8, "Yes", 30.48)
+
+    # the old addVeg script rules
+    def addLC(listName):
+        ans = []
+        for row in listName:
+            row = float(row)
+            if row < 500:
+                row = 1000
+            if row > 5000:
+                row = 5000
+            ans.append(row + 1)
+        return ans
+
+    inputs = scenarios.scenario_inputs(table, scenarios.PRESETS["addVegLeftBank"])
+    assert np.array_equal(inputs["LC_T1_S1"], addLC(table["LC_T1_S1"]))
+    assert np.array_equal(inputs["LC_T2_S1"], table["LC_T2_S1"] + 1)
+    # planting 3 m keeps the taller codes below the threshold
+    rule = scenarios.VegRule("Left", [1], height=3)
+    assert np.array_equal(rule.modify(np.array([0.0, 250, 300, 450, 800, 6000])),
+                          [300, 300, 300, 450, 800, 5000])
+    base = scenarios.base_inputs(table)
+    inputs = scenarios.scenario_inputs(table, scenarioList[-1], base)
+    assert inputs["ELE_T1_S1"] is base["ELE_T1_S1"]
+
+    def separate():
+        results = {}
+        for scenario in scenarioList:
+            inputs = scenarios.scenario_inputs(table, scenario)
+            results[scenario.name] = shade_engine.calculate_shade(
+                inputs, *settings, cache=False)["SHADE"]
+        return results
+
+    cache = solar_cache.EphemerisCache(cache_dir=None)
+
+    def batch():
+        return scenarios.run_batch(table, scenarioList, *settings, cache=cache)
+
+    a = separate()
+    b = batch()
+    assert all(np.allclose(a[name], b[name]) for name in a)
+
+    t_separate = timeit(separate, 1)
+    t_batch = timeit(batch)
+    print("{0} nodes, {1} scenarios".format(n_nodes, len(scenarioList)))
+    for label, t in [("one run per scenario", t_separate),
+                     ("batch runner", t_batch)]:
+        print("  {0:<26} {1:8.3f} s".format(label, t))
+
+
+def bench_parallel_scenarios():
+    """scenarios.run_batch in one process vs. run_batch_parallel over a
+    process pool with the node arrays in shared memory"""
+    import multiprocessing
+    import scenarios
+    import solar_cache
+
+    n_nodes = 20000
+    nodes = synthetic_nodes(n_nodes)
+    table = dict((f, np.asarray(v)) for f, v in nodes.items())
+    scenarioList = []
+    for height in range(5, 25, 5):
+        for bank in ["Left", "Right", "Both"]:
+            scenarioList.append(scenarios.Scenario(
+                "{0}_{1}m".format(bank, height),
+                [scenarios.VegRule(bank, [1, 2, 3], height=height)]))
+    settings = ("08/01/2016", 1, 43.28, -114.02, -8, "Yes", 30.48)
+    cache = solar_cache.EphemerisCache(cache_dir=None)
+
+    start = time.time()
+    a = scenarios.run_batch(table, scenarioList, *settings, cache=cache)
+    t_serial = time.time() - start
+
+    start = time.time()
+    b = scenarios.run_batch_parallel(table, scenarioList, *settings,
+                                     cache=cache)
+    t_parallel = time.time() - start
+    assert all(np.array_equal(a[name], b[name]) for name in a)
+
+    print("{0} nodes, {1} scenarios, {2} cores".format(
+        n_nodes, len(scenarioList), multiprocessing.cpu_count()))
+    for label, t in [("run_batch", t_serial),
+                     ("run_batch_parallel", t_parallel)]:
+        print("  {0:<26} {1:8.3f} s".format(label, t))
+
+
+def synthetic_streams(n_streams, n_vertices=200, seed=0):
+    """Returns a list of meandering (n_vertices, 2) polylines in meters"""
+    rand = np.random.RandomState(seed)
+    streams = []
+    for i in range(n_streams):
+        t = np.linspace(0, 1, n_vertices)
+        length = rand.uniform(500, 5000)
+        x = 500000 + i * 10000 + t * length
+        y = 4800000 + 50 * np.sin(t * rand.uniform(5, 40)) + rand.rand(n_vertices)
+        streams.append(np.column_stack((x, y)))
+    return streams
+
+
+def bench_stream_nodes():
+    """Step 1 node generation: positionAlongLine() up to three times per
+    node (emulated with a walk along the vertices) vs. stream_nodes with
+    np.interp on the chainage"""
+    from math import atan2, degrees
+    import stream_nodes
+
+    node_dx = 50
+    con_to_m = 1.0
+    flip = 1
+    streams = synthetic_streams(200)
+
+    def position_along_line(xy, fraction):
+        target = fraction * line_length(xy)
+        dist = 0.0
+        for (x0, y0), (x1, y1) in zip(xy[:-1], xy[1:]):
+            seg = ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5
+            if dist + seg >= target and seg > 0:
+                f = (target - dist) / seg
+                return x0 + f * (x1 - x0), y0 + f * (y1 - y0)
+            dist += seg
+        return tuple(xy[-1])
+
+    def line_length(xy):
+        return float(np.hypot(*np.diff(xy, axis=0).T).sum())
+
+    def per_node():
+        nodeList = []
+        for xy in streams:
+            xy = xy.tolist()
+            lineLength = line_length(np.array(xy))
+            numNodes = int(lineLength * con_to_m / node_dx)
+            positions = [n * node_dx / lineLength for n in range(numNodes + 1)]
+            mid_distance = min(node_dx / lineLength, 1)
+            for position in positions:
+                node = position_along_line(xy, abs(flip - position))
+                if position == 0.0:
+                    mid_up = position_along_line(xy, abs(flip - (position + mid_distance)))
+                    mid_down = node
+                elif 0.0 < position + mid_distance < 1:
+                    mid_up = position_along_line(xy, abs(flip - (position + mid_distance)))
+                    mid_down = position_along_line(xy, abs(flip - (position - mid_distance)))
+                else:
+                    mid_up = node
+                    mid_down = position_along_line(xy, abs(flip - (position - mid_distance)))
+                azimuth = degrees(atan2(mid_down[0] - mid_up[0], mid_down[1] - mid_up[1]))
+                if azimuth < 0:
+                    azimuth = azimuth + 360
+                nodeList.append([position * lineLength / 1000, node[0], node[1], azimuth])
+        return np.array(nodeList)
+
+    def vectorized():
+        nodeList = []
+        for xy in streams:
+            lineLength = line_length(xy)
+            km, length, x, y, azimuth = stream_nodes.stream_nodes(
+                xy, None, lineLength, node_dx, con_to_m, flip)
+            nodeList.append(np.column_stack((km, x, y, azimuth)))
+        return np.vstack(nodeList)
+
+    a = per_node()
+    b = vectorized()
+    assert np.allclose(a, b, atol=1e-6)
+
+    t_node = timeit(per_node, 1)
+    t_vec = timeit(vectorized)
+    print("{0} streams, {1} nodes".format(len(streams), len(a)))
+    for label, t in [("positionAlongLine per node", t_node),
+                     ("stream_nodes (np.interp)", t_vec)]:
+        print("  {0:<26} {1:8.3f} s {2:10.2f} us/node".format(
+            label, t, t / len(a) * 1e6))
+
+
+def bench_duplicate_ids():
+    """Step 1 duplicate stream ID check: list.count() for every ID vs.
+    the hash index in stream_nodes.find_duplicate_ids"""
+    import stream_nodes
+
+    rand = np.random.RandomState(0)
+
+    def synthetic_ids(n):
+        # unique IDs with 10 duplicated ones
+        sid_list = list(range(n))
+        for i in rand.randint(0, n, 10):
+            sid_list[rand.randint(0, n)] = sid_list[i]
+        return sid_list, list(range(1, n + 1))
+
+    print("  {0:>8} {1:>12} {2:>12}".format("IDs", "count() s", "hash s"))
+    for n in [5000, 10000, 20000, 62500, 125000, 250000, 500000]:
+        sid_list, oid_list = synthetic_ids(n)
+        t_hash = timeit(lambda: stream_nodes.find_duplicate_ids(sid_list, oid_list))
+        if n <= 20000:
+            t_count = timeit(lambda: list(set([i for i in sid_list
+                                               if sid_list.count(i) > 1])), 1)
+            dups = stream_nodes.find_duplicate_ids(sid_list, oid_list)
+            assert sorted(dups) == sorted(set([i for i in sid_list
+                                                if sid_list.count(i) > 1]))
+            count = "{0:12.3f}".format(t_count)
+        else:
+            count = "{0:>12}".format("-")
+        print("  {0:8d} {1} {2:12.3f}".format(n, count, t_hash))
+
+
+def bench_projections():
+    """LONGITUDE/LATITUDE for 1M nodes with projections.to_geographic
+    (UTM 11N and Oregon Lambert ft) and the round trip error"""
+    import projections
+
+    n_nodes = 1000000
+    rand = np.random.RandomState(0)
+    for code, lon, lat in [(32611, rand.uniform(-120, -114, n_nodes),
+                            rand.uniform(42, 49, n_nodes)),
+                           (2992, rand.uniform(-124.6, -116.4, n_nodes),
+                            rand.uniform(41.9, 46.3, n_nodes))]:
+        parameters = projections.epsg_parameters(code)
+        x, y = projections.from_geographic(lon, lat, parameters)
+        t = timeit(lambda: projections.to_geographic(x, y, parameters))
+        lon2, lat2 = projections.to_geographic(x, y, parameters)
+        error = max(np.abs(lon2 - lon).max(), np.abs(lat2 - lat).max()) * 111320
+        print("  EPSG {0:<6} {1:8.3f} s {2:8.3f} us/node  round trip error < {3:.4f} m".format(
+            code, t, t / n_nodes * 1e6, error))
+
+
+def synthetic_channels(n_streams, length=5000, node_dx=50, seed=0, spacing=200):
+    """Returns node points on meandering centerlines and the left/right
+    bank segments of each stream as (nodes (N, 2), node stream index,
+    left segments (M, 2, 2), left stream index, right segments, right
+    stream index). Banks are offset 5-30 m from the centerline and
+    digitized every ~2 m, streams are spacing m apart."""
+    rand = np.random.RandomState(seed)
+    nodes, node_sid = [], []
+    banks = {"left": ([], []), "right": ([], [])}
+    for i in range(n_streams):
+        t = np.linspace(0, length, int(length / 2) + 1)
+        amplitude = rand.uniform(10, min(60, spacing / 4))
+        wavelength = rand.uniform(200, 800)
+        x0 = (i % 20) * 6000.0
+        y0 = (i // 20) * float(spacing)
+        cx = x0 + t
+        cy = y0 + amplitude * np.sin(2 * np.pi * t / wavelength)
+        # unit normal to the left of the flow direction (+x)
+        dx = np.gradient(cx)
+        dy = np.gradient(cy)
+        norm = np.hypot(dx, dy)
+        nx, ny = -dy / norm, dx / norm
+        half = rand.uniform(5, 30) / 2 + rand.rand(len(t))
+        for side, sign in [("left", 1), ("right", -1)]:
+            bx = cx + sign * half * nx
+            by = cy + sign * half * ny
+            xy = np.column_stack((bx, by))
+            banks[side][0].append(np.stack((xy[:-1], xy[1:]), axis=1))
+            banks[side][1].append(np.full(len(xy) - 1, i))
+        k = np.arange(0, len(t), int(node_dx / 2))
+        nodes.append(np.column_stack((cx[k], cy[k])))
+        node_sid.append(np.full(len(k), i))
+    return (np.vstack(nodes), np.concatenate(node_sid),
+            np.concatenate(banks["left"][0]), np.concatenate(banks["left"][1]),
+            np.concatenate(banks["right"][0]), np.concatenate(banks["right"][1]))
+
+
+def bench_bank_index():
+    """Step 2 nearest bank distance: every node against every bank segment
+    (bank_index.nearest_segments(), what distanceTo on the merged bank
+    polyline does) vs. the bank_index.SegmentIndex grid query"""
+    import bank_index
+
+    print("  {0:>8} {1:>10} {2:>12} {3:>12} {4:>12}".format(
+        "nodes", "segments", "all pairs s", "build s", "query s"))
+    for n_streams in [10, 40, 160]:
+        nodes, node_sid, left, left_sid, right, right_sid = synthetic_channels(n_streams)
+        start = time.time()
+        index = bank_index.SegmentIndex(left)
+        t_build = time.time() - start
+        t_query = timeit(lambda: index.nearest(nodes))
+        d = index.nearest(nodes)[0]
+        if n_streams <= 40:
+            t_all = timeit(lambda: bank_index.nearest_segments(nodes, left), 1)
+            assert np.allclose(d, bank_index.nearest_segments(nodes, left)[0])
+            all_pairs = "{0:12.3f}".format(t_all)
+        else:
+            all_pairs = "{0:>12}".format("-")
+        print("  {0:8d} {1:10d} {2} {3:12.3f} {4:12.3f}".format(
+            len(nodes), len(left), all_pairs, t_build, t_query))
+
+
+def bench_distance_kernel():
+    """Step 2 point to polyline distance one node at a time (the
+    PointGeometry.distanceTo loop) vs. bank_index.nearest_segments() on
+    all the nodes in chunks"""
+    import bank_index
+
+    nodes, node_sid, left, left_sid, right, right_sid = synthetic_channels(10)
+
+    def per_node():
+        d = np.empty(len(nodes))
+        for n, (x, y) in enumerate(nodes):
+            d[n] = bank_index.point_segment_distance(
+                np.full(len(left), x), np.full(len(left), y), left)[0].min()
+        return d
+
+    t_loop = timeit(per_node, 1)
+    print("  {0} nodes, {1} segments, one node at a time {2:8.3f} s".format(
+        len(nodes), len(left), t_loop))
+    d_loop = per_node()
+    for chunk in [100000, bank_index.CHUNK_PAIRS, 20000000]:
+        t = timeit(lambda: bank_index.nearest_segments(nodes, left, chunk))
+        d = bank_index.nearest_segments(nodes, left, chunk)[0]
+        assert np.allclose(d, d_loop)
+        print("  chunk {0:>9d} pairs ({1:6.0f} MB) {2:8.3f} s".format(
+            chunk, chunk * 8 * 4 / 1e6, t))
+
+
+def bench_stream_banks():
+    """Step 2 banks merged into one index vs. a bank index per stream
+    (bank_index.StreamBankIndex) on channels 40 m and 80 m apart. Counts
+    the bank features assigned to the wrong stream by the nearest
+    centerline and the nodes measured to another stream's bank."""
+    import bank_index
+
+    for spacing in [40, 80]:
+        nodes, node_sid, left, left_sid, right, right_sid = synthetic_channels(
+            400, spacing=spacing)
+        # one bank feature per 100 segments
+        feature = left_sid * 1000 + np.arange(len(left)) // 100
+        d_true = bank_index.StreamBankIndex(left, left_sid).nearest(nodes, node_sid)[0]
+
+        merged = bank_index.SegmentIndex(left)
+        t_merged = timeit(lambda: merged.nearest(nodes))
+        d_merged = merged.nearest(nodes)[0]
+
+        start = time.time()
+        assigned = bank_index.assign_to_streams(left, feature, nodes, node_sid)
+        t_assign = time.time() - start
+
+        per_stream = bank_index.StreamBankIndex(left, assigned)
+        t_stream = timeit(lambda: per_stream.nearest(nodes, node_sid))
+        d_stream = per_stream.nearest(nodes, node_sid)[0]
+
+        print("{0} m apart: {1} nodes, {2} streams, {3} bank segments".format(
+            spacing, len(nodes), len(np.unique(node_sid)), len(left)))
+        print("  bank features assigned to the wrong stream: {0} of {1}".format(
+            len(np.unique(feature[assigned != left_sid])), len(np.unique(feature))))
+        print("  nodes measured to another stream's bank: merged {0}, per stream {1}".format(
+            (np.abs(d_merged - d_true) > 1e-9).sum(),
+            (np.abs(d_stream - d_true) > 1e-9).sum()))
+        for label, t in [("merged index query", t_merged),
+                         ("stream assignment", t_assign),
+                         ("per stream query", t_stream)]:
+            print("  {0:<26} {1:8.3f} s".format(label, t))
+
+
+def bench_transect():
+    """Step 2 channel width measured to the nearest bank point vs. along
+    the transect perpendicular to the stream azimuth
+    (bank_index.StreamBankIndex.cast_rays())"""
+    import bank_index
+
+    print("  {0:>8} {1:>10} {2:>12} {3:>12} {4:>10} {5:>12}".format(
+        "nodes", "segments", "nearest s", "transect s", "no cross",
+        "median diff"))
+    for n_streams in [40, 160, 640]:
+        nodes, node_sid, left, left_sid, right, right_sid = synthetic_channels(n_streams)
+        # flow direction azimuth the same as Step 1
+        azimuth = np.concatenate([
+            np.degrees(np.arctan2(*np.gradient(nodes[node_sid == sid], axis=0).T)) % 360
+            for sid in np.unique(node_sid)])
+        a = np.radians(azimuth)
+        to_left = np.column_stack((-np.cos(a), np.sin(a)))
+        lb = bank_index.StreamBankIndex(left, left_sid)
+        rb = bank_index.StreamBankIndex(right, right_sid)
+
+        def nearest():
+            return (lb.nearest(nodes, node_sid)[0] +
+                    rb.nearest(nodes, node_sid)[0])
+
+        def transect():
+            return (lb.cast_rays(nodes, node_sid, to_left, 500)[0] +
+                    rb.cast_rays(nodes, node_sid, -to_left, 500)[0])
+
+        t_nearest = timeit(nearest)
+        t_transect = timeit(transect)
+        w_nearest = nearest()
+        w_transect = transect()
+        cross = np.isfinite(w_transect)
+        print("  {0:8d} {1:10d} {2:12.3f} {3:12.3f} {4:10d} {5:12.3f}".format(
+            len(nodes), len(left) + len(right), t_nearest, t_transect,
+            int((~cross).sum()),
+            float(np.median(w_transect[cross] - w_nearest[cross]))))
+
+
+def bench_parallel_widths():
+    """Step 2 streams measured in this process (bank_index.channel_width())
+    vs. a process pool (bank_index.measure_parallel()). The results must
+    be identical."""
+    import bank_index
+
+    nodes, node_sid, left, left_sid, right, right_sid = synthetic_channels(640)
+    azimuth = np.concatenate([
+        np.degrees(np.arctan2(*np.gradient(nodes[node_sid == sid], axis=0).T)) % 360
+        for sid in np.unique(node_sid)])
+    lb = bank_index.StreamBankIndex(left, left_sid)
+    rb = bank_index.StreamBankIndex(right, right_sid)
+    print("{0} nodes, {1} streams, {2} bank segments".format(
+        len(nodes), len(np.unique(node_sid)), len(left) + len(right)))
+
+    for method in ["NEAREST", "TRANSECT"]:
+        serial = bank_index.channel_width(nodes, node_sid, rb, lb, method,
+                                          azimuth, 500)
+        t_serial = timeit(lambda: bank_index.channel_width(
+            nodes, node_sid, rb, lb, method, azimuth, 500), 1)
+        print("  {0:<8} serial        {1:8.3f} s".format(method, t_serial))
+        for processes in [2, 4]:
+            start = time.time()
+            parallel, seconds = bank_index.measure_parallel(
+                nodes, node_sid, rb, lb, method, azimuth, 500, processes)
+            t_parallel = time.time() - start
+            assert all(a.tobytes() == b.tobytes() for a, b in zip(serial, parallel))
+            print("  {0:<8} {1} processes   {2:8.3f} s (slowest stream {3:.3f} s)".format(
+                method, processes, t_parallel, max(seconds.values())))
+
+
+def bench_window_minimum():
+    """Step 3 lowest elevation around each node: Python loop over the
+    nodes and the cellcoords window vs. raster_blocks.window_minimum()"""
+    import itertools
+    import raster_blocks
+
+    rand = np.random.RandomState(0)
+    array = rand.uniform(1000, 1100, (2000, 2000)).astype(np.float32)
+    array[rand.rand(*array.shape) < 0.05] = -9999
+    array[:200, :200] = -9999
+
+    def loop(rows, cols, searchCells):
+        cell_moves = [i for i in range(searchCells*-1, searchCells+1, 1)]
+        cellcoords = list(itertools.product(cell_moves, cell_moves))
+        z = []
+        for row, col in zip(rows.tolist(), cols.tolist()):
+            z_sampleList = [array[row + dy, col + dx] for dx, dy in cellcoords]
+            if not max(z_sampleList) < -9998:
+                z_sampleList = [v for v in z_sampleList if v > -9999]
+            z.append(min(z_sampleList))
+        return np.array(z)
+
+    print("  {0:>8} {1:>12} {2:>12} {3:>12}".format(
+        "nodes", "searchCells", "loop s", "vector s"))
+    for n_nodes, searchCells in [(5000, 2), (5000, 10), (50000, 2),
+                                 (50000, 25)]:
+        rows = rand.randint(searchCells, 2000 - searchCells, n_nodes)
+        cols = rand.randint(searchCells, 2000 - searchCells, n_nodes)
+        z = raster_blocks.window_minimum(array, rows, cols, searchCells)
+        t_vector = timeit(lambda: raster_blocks.window_minimum(
+            array, rows, cols, searchCells))
+        if n_nodes * (2 * searchCells + 1) ** 2 <= 20000000:
+            assert np.array_equal(z, loop(rows, cols, searchCells))
+            loop_time = "{0:12.3f}".format(timeit(lambda: loop(rows, cols, searchCells), 1))
+        else:
+            loop_time = "{0:>12}".format("-")
+        print("  {0:8d} {1:12d} {2} {3:12.3f}".format(
+            n_nodes, searchCells, loop_time, t_vector))
+
+
+def _calculate_gradient(zList, len_list, smooth_flag):
+    """The Step 3 calculate_gradient() before gradients.node_gradients()"""
+    skipupNodes = [0]
+    gradientList = [0 for i in zList]
+
+    for i in range(1,len(zList)):
+        z = zList[i]
+        zUp = zList[i - 1 - max(skipupNodes)]
+
+        if z > zUp and smooth_flag is True:
+            skipupNodes.append(max(skipupNodes) + 1)
+        else:
+            dx_meters = sum(len_list[i:i+max(skipupNodes)+1])
+            gradient = (zUp - z) / dx_meters
+            for Skip in skipupNodes:
+                gradientList[i-Skip] = gradient
+            skipupNodes = [0]
+
+    return (gradientList)
+
+
+def check_gradients(n_profiles=2000, seed=0):
+    """Compares gradients.node_gradients() to the original Step 3
+    calculate_gradient() on random stream profiles with adverse slopes,
+    flat reaches and nodata. Returns the largest relative difference."""
+    import gradients
+
+    rand = np.random.RandomState(seed)
+    worst = 0.0
+    for p in range(n_profiles):
+        n = rand.randint(0, 80)
+        z = np.cumsum(rand.normal(-0.2, 1, n)) * rand.choice([1, 10]) + 1000
+        z = np.round(z, rand.choice([0, 2]))
+        if p % 5 == 0:
+            z[rand.rand(n) < 0.2] = -9999
+        lengths = rand.uniform(1, 60, n) if p % 2 else np.full(n, 50.0)
+        for smooth_flag in [True, False]:
+            expected = np.array(_calculate_gradient(z.tolist(), lengths.tolist(),
+                                                    smooth_flag), dtype=float)
+            result = gradients.node_gradients(z, lengths, smooth_flag)
+            assert np.array_equal(expected == 0, result == 0)
+            nonzero = expected != 0
+            if nonzero.any():
+                worst = max(worst, np.max(np.abs(result - expected)[nonzero] /
+                                          np.abs(expected[nonzero])))
+    return worst
+
+
+def bench_gradients():
+    """Step 3 smoothed gradients: the original calculate_gradient() vs.
+    gradients.node_gradients() on long reaches with adverse slopes"""
+    import gradients
+
+    print("  random profiles, largest relative difference {0:.1e}".format(
+        check_gradients()))
+    rand = np.random.RandomState(1)
+    print("  {0:>8} {1:>12} {2:>12}".format("nodes", "loop s", "vector s"))
+    for n in [1000, 5000, 20000]:
+        # a falling reach with a long rise (many adverse slopes)
+        z = np.concatenate((np.linspace(1000, 900, n // 2),
+                            np.linspace(900, 950, n - n // 2))) + rand.normal(0, 0.5, n)
+        z[-1] = 800
+        lengths = np.full(n, 50.0)
+        t_loop = timeit(lambda: _calculate_gradient(z.tolist(), lengths.tolist(), True), 1)
+        t_vector = timeit(lambda: gradients.node_gradients(z, lengths, True))
+        print("  {0:8d} {1:12.3f} {2:12.4f}".format(n, t_loop, t_vector))
+
+
+def _create_block_list(x_coord_list, y_coord_list, block_size):
+    """The Step 3/5 create_block_list() block loops before
+    raster_blocks.plan_blocks()"""
+    x_min = min(x_coord_list)
+    x_max = max(x_coord_list)
+    y_min = min(y_coord_list)
+    y_max = max(y_coord_list)
+
+    x_width = int(x_max - x_min + 1)
+    y_width = int(y_max - y_min + 1)
+
+    block_extents = []
+    block_nodes = []
+    for x in range(0, x_width, block_size):
+        for y in range(0, y_width, block_size):
+            block0_x_min = min([x_min + x, x_max])
+            block0_y_min = min([y_min + y, y_max])
+            block0_x_max = min([block0_x_min + block_size, x_max])
+            block0_y_max = min([block0_y_min + block_size, y_max])
+
+            block_x_min = block0_x_max
+            block_x_max = block0_x_min
+            block_y_min = block0_y_max
+            block_y_max = block0_y_min
+
+            nodes_in_block = []
+            for i, (node_x, node_y) in enumerate(zip(x_coord_list, y_coord_list)):
+                if (block0_x_min <= node_x <= block0_x_max and
+                    block0_y_min <= node_y <= block0_y_max):
+                    nodes_in_block.append(i)
+                    if block_x_min > node_x: block_x_min = node_x
+                    if block_x_max < node_x: block_x_max = node_x
+                    if block_y_min > node_y: block_y_min = node_y
+                    if block_y_max < node_y: block_y_max = node_y
+
+            if nodes_in_block:
+                block_extents.append((block_x_min, block_y_min,
+                                      block_x_max, block_y_max))
+                block_nodes.append(nodes_in_block)
+    return block_extents, block_nodes
+
+
+def bench_block_planner():
+    """Steps 3-5 block planning: every node tested against every block
+    vs. raster_blocks.plan_blocks() (floor divide and sort)"""
+    import raster_blocks
+
+    nodes = synthetic_channels(400, spacing=500)[0]
+    x = nodes[:, 0].tolist()
+    y = nodes[:, 1].tolist()
+    print("  {0:>8} {1:>10} {2:>8} {3:>12} {4:>12}".format(
+        "nodes", "block m", "blocks", "loops s", "planner s"))
+    for block_size in [5000, 2000, 1000]:
+        extents, members = raster_blocks.plan_blocks(x, y, block_size)
+        expected = _create_block_list(x, y, block_size)
+        assert expected[0] == extents
+        assert expected[1] == [m.tolist() for m in members]
+        t_loop = timeit(lambda: _create_block_list(x, y, block_size), 1)
+        t_plan = timeit(lambda: raster_blocks.plan_blocks(x, y, block_size))
+        print("  {0:8d} {1:10d} {2:8d} {3:12.3f} {4:12.4f}".format(
+            len(x), block_size, len(extents), t_loop, t_plan))
+
+
+class EmulatedResult(object):
+    """Stand in for the arcpy Result of a geoprocessing tool"""
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+    def getOutput(self, i):
+        return self.outputs[i]
+
+
+class EmulatedRasterProperties(object):
+    """Stand in for arcpy.GetRasterProperties_management on one raster.
+    Returns the property as text like getOutput(0) and counts the calls.
+    It does not include the cost of running a geoprocessing tool."""
+
+    def __init__(self, properties):
+        self.properties = properties
+        self.calls = 0
+
+    def __call__(self, raster, name):
+        self.calls += 1
+        return EmulatedResult([str(self.properties[name])])
+
+
+def _block_window(block, raster, get_properties):
+    """The per-block raster setup of the old sample_raster()"""
+    x_cellsize = float(get_properties(raster, "CELLSIZEX").getOutput(0))
+    y_cellsize = float(get_properties(raster, "CELLSIZEY").getOutput(0))
+    raster_x_min = float(get_properties(raster, "LEFT").getOutput(0))
+    raster_y_min = float(get_properties(raster, "BOTTOM").getOutput(0))
+    raster_x_max = float(get_properties(raster, "RIGHT").getOutput(0))
+    raster_y_max = float(get_properties(raster, "TOP").getOutput(0))
+
+    block_x_min = block[0] - (block[0] - raster_x_min) % x_cellsize
+    block_y_min = block[1] - (block[1] - raster_y_min) % y_cellsize
+    block_x_max = block[2] + (raster_x_max - block[2]) % x_cellsize
+    block_y_max = block[3] + (raster_y_max - block[3]) % y_cellsize
+    lower_left = (block_x_min + (x_cellsize / 2), block_y_min + (y_cellsize / 2))
+    ncols = max([int(np.ceil((block_x_max - block_x_min) / x_cellsize)), 1])
+    nrows = max([int(np.ceil((block_y_max - block_y_min) / y_cellsize)), 1])
+    return block_x_min, block_y_max, lower_left, ncols, nrows
+
+
+def bench_raster_info():
+    """Steps 3-5 per-block raster setup: six GetRasterProperties calls
+    per block vs. a raster_blocks.RasterInfo read once per run. On
+    ArcGIS each call is a geoprocessing tool run, so the calls per block
+    are the overhead removed; the times are the Python setup only."""
+    import raster_blocks
+
+    properties = {"CELLSIZEX": 1.0, "CELLSIZEY": 1.0, "LEFT": 500000.5,
+                  "BOTTOM": 4800000.25, "RIGHT": 540000.5, "TOP": 4840000.25}
+    info = raster_blocks.RasterInfo("dem", properties["CELLSIZEX"],
+                                    properties["CELLSIZEY"], properties["LEFT"],
+                                    properties["BOTTOM"], properties["RIGHT"],
+                                    properties["TOP"], con_to_m=0.3048)
+    rand = np.random.RandomState(0)
+    x = rand.uniform(500000, 535000, 20000)
+    y = rand.uniform(4800000, 4835000, 20000)
+    blocks = [tuple(b) for b in np.column_stack([x, y, x + 5000, y + 5000]).tolist()]
+
+    get_properties = EmulatedRasterProperties(properties)
+    assert all(_block_window(b, "dem", get_properties) == info.block_window(b)
+               for b in blocks)
+
+    get_properties = EmulatedRasterProperties(properties)
+    t_calls = timeit(lambda: [_block_window(b, "dem", get_properties)
+                              for b in blocks])
+    calls = get_properties.calls // 3
+    t_info = timeit(lambda: [info.block_window(b) for b in blocks])
+    print("{0} blocks".format(len(blocks)))
+    for label, t, n in [("GetRasterProperties", t_calls, calls),
+                        ("RasterInfo", t_info, 0)]:
+        print("  {0:<20} {1:8.2f} us/block {2:3d} tool calls/block".format(
+            label, t / len(blocks) * 1e6, n // len(blocks)))
+
+
+def _raster_to_numpy_array(dem, info, lower_left, ncols, nrows):
+    """Emulated RasterToNumPyArray of a DEM array (row 0 at y_max).
+    lower_left is the lower left cell center, outside cells get the
+    nodata value."""
+    col0 = int(round((lower_left[0] - info.x_min) / info.x_cellsize - 0.5))
+    row0 = int(round((info.y_max - lower_left[1]) / info.y_cellsize - 0.5)) - nrows + 1
+    array = np.empty((nrows, ncols), dtype=dem.dtype)
+    array.fill(info.nodata_to_value)
+    r_lo, r_hi = max(row0, 0), min(row0 + nrows, dem.shape[0])
+    c_lo, c_hi = max(col0, 0), min(col0 + ncols, dem.shape[1])
+    if r_lo < r_hi and c_lo < c_hi:
+        array[r_lo - row0:r_hi - row0, c_lo - col0:c_hi - col0] = dem[r_lo:r_hi, c_lo:c_hi]
+    return array
+
+
+def bench_tile_cache():
+    """Steps 3-5 raster reads: every block window read from the raster
+    vs. raster_cache.TileCache, over two runs of the pipeline. The raster
+    is an emulated RasterToNumPyArray of a DEM .npy file, so the cells
+    read are the measure; the times do not include ArcGIS raster I/O."""
+    import raster_blocks
+    import raster_cache
+
+    cellsize = 4.0
+    ncells = 2000
+    tile_cells = 256
+    rand = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dem_path = os.path.join(tmp_dir, "dem.npy")
+        dem = (rand.rand(ncells, ncells) * 100).astype(np.float32)
+        dem[:50, :50] = -9999
+        np.save(dem_path, dem)
+        info = raster_blocks.RasterInfo(dem_path, cellsize, cellsize,
+                                        500000.0, 4800000.0,
+                                        500000.0 + ncells * cellsize,
+                                        4800000.0 + ncells * cellsize,
+                                        con_to_m=0.3048)
+        dem = np.load(dem_path, mmap_mode="r")
+
+        def reader(info, lower_left, ncols, nrows):
+            return _raster_to_numpy_array(dem, info, lower_left, ncols, nrows)
+
+        # nodes along streams crossing the raster
+        x = np.concatenate([np.linspace(500100, 507900, 400) for i in range(8)])
+        y = np.concatenate([4800100 + 1000 * i + 300 * np.sin(np.linspace(0, 9, 400))
+                            for i in range(8)])
+        extents = raster_blocks.plan_blocks(x, y, 1000)[0]
+        # Step 3 (searchCells = 1), Step 4 (1 km search) and the Step 5
+        # ELE samples (100 m transects) read the DEM with these buffers
+        blocks = [(e[0] - b, e[1] - b, e[2] + b, e[3] + b)
+                  for b in [2 * cellsize, 1000, 100] for e in extents]
+
+        cache_dir = os.path.join(tmp_dir, "tiles")
+        direct = raster_cache.TileCache(None, reader=reader)
+        expected = [direct.read_block(info, b)[0] for b in blocks]
+        print("{0} x {0} DEM, {1} block reads per run, tile {2} cells".format(
+            ncells, len(blocks), tile_cells))
+        print("  {0:<22} {1:>12} {2:>12} {3:>10}".format(
+            "", "cells read", "cached tiles", "seconds"))
+        for label, folder in [("no cache, run 1", None), ("no cache, run 2", None),
+                              ("tile cache, run 1", cache_dir),
+                              ("tile cache, run 2", cache_dir)]:
+            cache = raster_cache.TileCache(folder, tile_cells, reader=reader)
+            start = time.time()
+            arrays = [cache.read_block(info, b)[0] for b in blocks]
+            elapsed = time.time() - start
+            assert all(np.array_equal(a, e) for a, e in zip(arrays, expected))
+            print("  {0:<22} {1:12d} {2:12d} {3:10.3f}".format(
+                label, cache.cells_read, cache.hits + cache.disk_hits, elapsed))
+
+        # eviction and clear() only delete the raster folders of the cache
+        other = os.path.join(cache_dir, "other")
+        os.makedirs(other)
+        np.save(os.path.join(cache_dir, "other.npy"), dem[:2, :2])
+        old = time.time() - 100 * 86400
+        for name in os.listdir(cache_dir):
+            os.utime(os.path.join(cache_dir, name), (old, old))
+        cache = raster_cache.TileCache(cache_dir, tile_cells, reader=reader)
+        assert sorted(os.listdir(cache_dir)) == ["other", "other.npy"]
+        cache.read_block(info, blocks[0])
+        assert len(os.listdir(cache_dir)) == 3
+        cache.clear()
+        assert sorted(os.listdir(cache_dir)) == ["other", "other.npy"]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_corridor_reads():
+    """Step 4 DEM reads: every block window crossed by a topo line vs.
+    only the tiles crossed by the topo lines (raster_cache.line_tiles()).
+    The raster is an emulated RasterToNumPyArray, so the bytes read are
+    the measure. The topo line results are checked on the 10 m DEM; the
+    1 m DEM only counts the bytes."""
+    for azimuths in [[270, 180, 90], [45, 90, 135, 180, 225, 270, 315, 365]]:
+        _corridor_reads(azimuths)
+
+
+def _corridor_reads(azimuths, searchDistance_max=10000, block_size=5000):
+    """bench_corridor_reads() for a list of azimuths"""
+    import raster_blocks
+    import raster_cache
+
+    # a sinuous stream, nodes every 50 m
+    t = np.linspace(0, 1, 300)
+    node_x = 512500.0 + 15000 * t
+    node_y = 4820000.0 + 4000 * np.sin(t * 12)
+    x0 = np.repeat(node_x, len(azimuths))
+    y0 = np.repeat(node_y, len(azimuths))
+    a = np.tile(azimuths, len(node_x))
+    sin_a = np.sin(np.radians(a))
+    cos_a = np.cos(np.radians(a))
+    x1 = x0 + searchDistance_max * sin_a
+    y1 = y0 + searchDistance_max * cos_a
+    grid = raster_blocks.block_grid(min(x0.min(), x1.min()), min(y0.min(), y1.min()),
+                                    max(x0.max(), x1.max()), max(y0.max(), y1.max()),
+                                    block_size)
+    blocks, members = raster_blocks.boxes_in_blocks(
+        np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1),
+        np.maximum(y0, y1), grid, block_size)
+    (x_lo, x_hi), (y_lo, y_hi) = grid
+
+    # the part of each topo line in each block (slab clipping)
+    pieces = []
+    for block, member in zip(blocks.tolist(), members):
+        extent = (x_lo[block // len(y_lo)], y_lo[block % len(y_lo)],
+                  x_hi[block // len(y_lo)], y_hi[block % len(y_lo)])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tx = np.sort([(extent[0] - x0[member]) / sin_a[member],
+                          (extent[2] - x0[member]) / sin_a[member]], axis=0)
+            ty = np.sort([(extent[1] - y0[member]) / cos_a[member],
+                          (extent[3] - y0[member]) / cos_a[member]], axis=0)
+        tx[:, np.abs(sin_a[member]) < 1e-12] = [[-np.inf], [np.inf]]
+        ty[:, np.abs(cos_a[member]) < 1e-12] = [[-np.inf], [np.inf]]
+        start = np.maximum.reduce([tx[0], ty[0], np.zeros(len(member))])
+        end = np.minimum.reduce([tx[1], ty[1], np.full(len(member), searchDistance_max)])
+        inside = start < end
+        if inside.any():
+            pieces.append((extent, np.asarray(member)[inside], start[inside], end[inside]))
+
+    print("{0} nodes, {1} directions, {2:g} km search, {3} blocks".format(
+        len(node_x), len(azimuths), searchDistance_max / 1000.0, len(pieces)))
+    print("  {0:>6} {1:<18} {2:>14} {3:>14}".format(
+        "cells", "", "bytes read", "bytes / node"))
+    for cellsize, ncells in [(10.0, 4000), (1.0, 40000)]:
+        info = raster_blocks.RasterInfo("dem", cellsize, cellsize, 500000.0,
+                                        4800000.0, 500000.0 + ncells * cellsize,
+                                        4800000.0 + ncells * cellsize)
+        check = ncells <= 4000
+        if check:
+            rand = np.random.RandomState(0)
+            dem = (rand.rand(ncells, ncells) * 100).astype(np.float32)
+
+            def reader(info, lower_left, ncols, nrows):
+                return _raster_to_numpy_array(dem, info, lower_left, ncols, nrows)
+        else:
+            def reader(info, lower_left, ncols, nrows):
+                return np.broadcast_to(np.float32(50), (nrows, ncols))
+
+        cell = np.where(a % 90 == 45, np.hypot(cellsize, cellsize), cellsize)
+        for label, tile_cells in [("block windows", None), ("tiles 1024 cells", 1024),
+                                  ("tiles 256 cells", 256)]:
+            cache = raster_cache.TileCache(None, tile_cells or 1024, reader=reader)
+            for extent, i, start, end in pieces:
+                # a cell more so samples on the block edge are in the array
+                extent = (extent[0] - cellsize, extent[1] - cellsize,
+                          extent[2] + cellsize, extent[3] + cellsize)
+                tiles = None
+                if tile_cells is not None:
+                    tiles = raster_cache.line_tiles(info, *raster_blocks.topo_line_ends(
+                        x0[i], y0[i], sin_a[i], cos_a[i], start, end, cell[i]),
+                        tile_cells=tile_cells)
+                z_array, bx, by = cache.read_block(info, extent, tiles)
+                if check and tiles is not None:
+                    # the topo lines only sample the tiles read
+                    z_full = _raster_to_numpy_array(dem, info, info.block_window(extent)[2],
+                                                    z_array.shape[1], z_array.shape[0])
+                    args = (bx, by, cellsize, cellsize, x0[i], y0[i],
+                            np.full(len(i), 50.0), sin_a[i], cos_a[i], start,
+                            end, cell[i], 1.0)
+                    assert all(np.array_equal(u, v) for u, v in zip(
+                        raster_blocks.topo_angles(z_full, *args),
+                        raster_blocks.topo_angles(z_array, *args)))
+            print("  {0:5g}m {1:<18} {2:14d} {3:14.0f}".format(
+                cellsize, label, cache.bytes_read, cache.bytes_read / len(node_x)))
+
+
+def _topo_line_loop(z_array, block_x_min, block_y_max, x_cellsize,
+                    y_cellsize, block_samples, azimuthdisdict, con_to_m):
+    """The topo line loop of the old Step 4 get_topo_angles(). Returns
+    the topo_fc attributes of each line."""
+    from math import sin, cos, radians
+
+    topo_samples = []
+    for (nodeID, a, z_node, node_x, node_y,
+         block_search_start, block_search_end) in block_samples:
+        cellsize = azimuthdisdict[a]
+        # distances of the old build_search_array()
+        if block_search_start <= 0:
+            block_search_start = cellsize
+        if block_search_end - block_search_start >= cellsize:
+            distance_array = np.arange(block_search_start, block_search_end, cellsize)
+        else:
+            distance_array = np.array([block_search_start])
+        z_topo_list = []
+        for distance in distance_array:
+            pt_x = ((distance * sin(radians(a))) + node_x)
+            pt_y = ((distance * cos(radians(a))) + node_y)
+            col = int((pt_x - block_x_min) / x_cellsize)
+            row = int((pt_y - block_y_max) / y_cellsize * -1)
+            z_topo_list.append(z_array[row, col])
+
+        distance_array_m = distance_array * con_to_m
+        z_topo_array = np.array(z_topo_list)
+        angle_array = np.degrees(np.arctan((z_topo_array - z_node) / distance_array_m))
+        naindex = np.where(z_topo_array < -9998)
+        for x in naindex[0]: angle_array[x] = -9999
+        topoAngle = angle_array.max()
+        arryindex = np.where(angle_array==topoAngle)[0][0]
+        z_topo = z_topo_array[arryindex]
+        z_change = z_topo - z_node
+        topoAngleDistance = distance_array[arryindex]
+        topoAngle_x = (topoAngleDistance * sin(radians(a))) + node_x
+        topoAngle_y = (topoAngleDistance * cos(radians(a))) + node_y
+        topoAngleDistance_m = topoAngleDistance * con_to_m
+        off_rastersamples = (z_topo_array < -9998).sum()
+        topo_samples.append([topoAngle_x, topoAngle_y, nodeID, a, topoAngle,
+                             z_topo, z_node, z_change, topoAngleDistance_m,
+                             off_rastersamples])
+    return topo_samples
+
+
+def _topo_line_kernel(z_array, block_x_min, block_y_max, x_cellsize,
+                      y_cellsize, block_samples, azimuthdisdict, con_to_m):
+    """The new Step 4 get_topo_angles() with raster_blocks.topo_angles()"""
+    from math import sin, cos, radians
+    import raster_blocks
+
+    azimuths = [sample[1] for sample in block_samples]
+    (topoAngles, topoAngleDistances,
+     z_topos, off_rastersamples) = raster_blocks.topo_angles(
+        z_array, block_x_min, block_y_max, x_cellsize, y_cellsize,
+        [sample[3] for sample in block_samples],
+        [sample[4] for sample in block_samples],
+        [sample[2] for sample in block_samples],
+        [sin(radians(a)) for a in azimuths],
+        [cos(radians(a)) for a in azimuths],
+        [sample[5] for sample in block_samples],
+        [sample[6] for sample in block_samples],
+        [azimuthdisdict[a] for a in azimuths], con_to_m)
+
+    topo_samples = []
+    for i, (nodeID, a, z_node, node_x, node_y,
+            block_search_start, block_search_end) in enumerate(block_samples):
+        topoAngle = topoAngles[i]
+        z_topo = z_topos[i]
+        z_change = z_topo - z_node
+        topoAngleDistance = topoAngleDistances[i]
+        topoAngle_x = (topoAngleDistance * sin(radians(a))) + node_x
+        topoAngle_y = (topoAngleDistance * cos(radians(a))) + node_y
+        topoAngleDistance_m = topoAngleDistance * con_to_m
+        topo_samples.append([topoAngle_x, topoAngle_y, nodeID, a, topoAngle,
+                             z_topo, z_node, z_change, topoAngleDistance_m,
+                             off_rastersamples[i]])
+    return topo_samples
+
+
+def synthetic_topo_block(n_nodes, ncells=2500, cellsize=1.0, dtype=np.float64,
+                         seed=0):
+    """Returns a block elevation array with nodata patches and the topo
+    lines (nodeID, azimuth, z_node, node x, node y, search start, search
+    end) of nodes in the block in the 8 Step 4 directions"""
+    rand = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:ncells, 0:ncells] * cellsize
+    z = (50 * np.sin(xx / 300.0) * np.cos(yy / 450.0) + xx * 0.02 +
+         rand.rand(ncells, ncells))
+    z[rand.rand(ncells, ncells) < 0.01] = -9999
+    z[:200, -300:] = -9999
+    z = z.astype(dtype)
+
+    block_x_min, block_y_max = 500000.0, 4800000.0 + ncells * cellsize
+    width = ncells * cellsize
+    samples = []
+    for nodeID in range(n_nodes):
+        x = block_x_min + rand.uniform(0.05, 0.95) * width
+        y = block_y_max - rand.uniform(0.05, 0.95) * width
+        z_node = float(rand.uniform(-40, 60))
+        for a in [45, 90, 135, 180, 225, 270, 315, 365]:
+            # distance to the block edge along the line
+            dx, dy = np.sin(np.radians(a)), np.cos(np.radians(a))
+            tx = ((block_x_min + width - 1e-6 - x) / dx if dx > 1e-9 else
+                  (block_x_min + 1e-6 - x) / dx if dx < -1e-9 else np.inf)
+            ty = ((block_y_max - 1e-6 - y) / dy if dy > 1e-9 else
+                  (block_y_max - width + 1e-6 - y) / dy if dy < -1e-9 else np.inf)
+            end = float(min(tx, ty)) - 2 * cellsize
+            start = 0 if rand.rand() < 0.5 else float(rand.uniform(0, end))
+            if rand.rand() < 0.05:
+                # short line inside the block
+                end = start + 0.5 * cellsize
+            samples.append((nodeID, a, z_node, x, y, start, end))
+    return z, block_x_min, block_y_max, samples
+
+
+def bench_topo_angles():
+    """Step 4 topo lines: a Python loop over every sample of every line
+    vs. raster_blocks.topo_angles() on all the lines of a block"""
+    from math import hypot
+
+    print("  {0:>8} {1:>8} {2:>10} {3:>10} {4:>10}".format(
+        "dtype", "lines", "samples", "loop s", "kernel s"))
+    for dtype, n_nodes in [(np.float64, 20), (np.float32, 20), (np.int32, 20),
+                           (np.float64, 200)]:
+        cellsize = 1.0
+        z, block_x_min, block_y_max, samples = synthetic_topo_block(
+            n_nodes, cellsize=cellsize, dtype=dtype, seed=n_nodes)
+        disXY = hypot(cellsize, cellsize)
+        azimuthdisdict = {45:disXY,90:cellsize,135:disXY,180:cellsize,
+                          225:disXY,270:cellsize,315:disXY,365:cellsize}
+        args = (z, block_x_min, block_y_max, cellsize, cellsize, samples,
+                azimuthdisdict, 0.3048)
+        loop = _topo_line_loop(*args)
+        kernel = _topo_line_kernel(*args)
+        # same values and the same types
+        assert all(repr(u) == repr(v) for a, b in zip(loop, kernel)
+                   for u, v in zip(a, b))
+        t_loop = timeit(lambda: _topo_line_loop(*args), 1)
+        t_kernel = timeit(lambda: _topo_line_kernel(*args))
+        n_samples = sum(int((end - start) / azimuthdisdict[a])
+                        for _, a, _, _, _, start, end in samples)
+        print("  {0:>8} {1:8d} {2:10d} {3:10.3f} {4:10.3f}".format(
+            np.dtype(dtype).name, len(samples), n_samples, t_loop, t_kernel))
+
+
+def _find_intersection(a, b, c, d, check_collinear=True):
+    """find_intersection() of the old Step 4 create_blocks()"""
+    Dx_Cx = d[0] - c[0]
+    Ay_Cy = a[1] - c[1]
+    Dy_Cy = d[1] - c[1]
+    Ax_Cx = a[0] - c[0]
+    Bx_Ax = b[0] - a[0]
+    By_Ay = b[1] - a[1]
+
+    Cx_Bx = c[0] - b[0]
+    Dx_Ax = d[0] - a[0]
+    Cy_By = c[1] - b[1]
+    Dy_Ay = d[1] - a[1]
+
+    numerator_a = Dx_Cx * Ay_Cy - Dy_Cy * Ax_Cx
+    numerator_b = Bx_Ax * Ay_Cy - By_Ay * Ax_Cx
+    denominator = Dy_Cy * Bx_Ax - Dx_Cx * By_Ay
+
+    if (check_collinear and numerator_a == 0 and numerator_b == 0 and denominator == 0):
+        overlap_x = (Cx_Bx < 0) != (Dx_Ax < 0)
+        overlap_y = (Cy_By < 0) != (Dy_Ay < 0)
+        point_overlap = (a == d or b == c)
+        if (overlap_x or overlap_y or point_overlap):
+            x = sorted((a[0], b[0], c[0], d[0]))
+            y = sorted((a[1], b[1], c[1], d[1]))
+            return True, x[1], y[1], x[2], y[2]
+        return False, None, None, None, None
+
+    if denominator == 0:
+        return False, None, None, None, None
+
+    u_a = numerator_a / denominator
+    u_b = numerator_b / denominator
+
+    if (u_a >= 0) and (u_a <= 1) and (u_b >= 0) and (u_b <= 1):
+        ixa = a[0] + Bx_Ax * u_a
+        iyb = c[1] + Dy_Cy * u_b
+        return True, ixa, iyb, ixa, iyb
+    return False, None, None, None, None
+
+
+def _create_blocks_loop(topo_list, block_size, last_azimuth, searchDistance_max):
+    """The old Step 4 create_blocks() block loops, every topo line tested
+    against the edges of every block with find_intersection(). Returns
+    the same blocks and topo lines as raster_blocks.plan_topo_blocks()."""
+    from math import sin, cos, radians, hypot
+
+    x_coord_list = [row[6] for row in topo_list]
+    y_coord_list = [row[7] for row in topo_list]
+    x_min = min(x_coord_list)
+    x_max = max(x_coord_list)
+    y_min = min(y_coord_list)
+    y_max = max(y_coord_list)
+
+    x_width = int(x_max - x_min + 1)
+    y_width = int(y_max - y_min + 1)
+
+    updated = set()
+    plan = []
+    b = 0
+    for x in range(0, x_width, block_size):
+        for y in range(0, y_width, block_size):
+            block_x_min = min([x_min + x, x_max])
+            block_y_min = min([y_min + y, y_max])
+            block_x_max = min([block_x_min + block_size, x_max])
+            block_y_max = min([block_y_min + block_size, y_max])
+
+            nodes_to_update = []
+            topo_in_block = []
+
+            block_segments = (((block_x_min, block_y_max), (block_x_min, block_y_min)),
+                              ((block_x_min, block_y_min), (block_x_max, block_y_min)),
+                              ((block_x_max, block_y_min), (block_x_max, block_y_max)),
+                              ((block_x_max, block_y_max), (block_x_min, block_y_max)))
+
+            for row in topo_list:
+                nodeID, streamID, a, z_node, node_x, node_y, end_x, end_y = row
+                contains_node = (block_x_min <= node_x <= block_x_max and
+                                 block_y_min <= node_y <= block_y_max)
+                contains_end = (block_x_min <= end_x <= block_x_max and
+                                block_y_min <= end_y <= block_y_max)
+                last_sample = False
+                if a == last_azimuth:
+                    if a == 45:
+                        searchDistance_last = (hypot(searchDistance_max, searchDistance_max))
+                        last_x = ((searchDistance_last * sin(radians(a))) + node_x)
+                        last_y = ((searchDistance_last * cos(radians(a))) + node_y)
+                    else:
+                        last_x = end_x
+                        last_y = end_y
+                    last_sample = (block_x_min <= last_x <= block_x_max and
+                                   block_y_min <= last_y <= block_y_max)
+
+                if contains_node and contains_end:
+                    topo_in_block.append(row + [0, searchDistance_max])
+                    if last_sample: nodes_to_update.append(nodeID)
+                else:
+                    distance = []
+                    for block_segment in block_segments:
+                        intersects, inter1_x, inter1_y, inter2_x, inter2_y = _find_intersection(
+                            block_segment[0], block_segment[1],
+                            (node_x, node_y), (end_x, end_y), True)
+                        if intersects:
+                            if a in [0, 180]:
+                                distance.append((inter1_y - node_y) / cos(radians(a)))
+                            else:
+                                distance.append((inter1_x - node_x) / sin(radians(a)))
+
+                    if (len(distance) == 1 and
+                        (0 < distance[0] < searchDistance_max) and
+                        (contains_node or contains_end)):
+                        if contains_node:
+                            topo_in_block.append(row + [0, distance[0]])
+                        else:
+                            topo_in_block.append(row + [distance[0], searchDistance_max])
+                        if last_sample and nodeID not in updated:
+                            nodes_to_update.append(nodeID)
+                            updated.add(nodeID)
+                    elif len(distance) > 1:
+                        topo_in_block.append(row + [min(distance), max(distance)])
+                        if last_sample and contains_end and nodeID not in updated:
+                            nodes_to_update.append(nodeID)
+                            updated.add(nodeID)
+                    elif last_sample and not contains_end and nodeID not in updated:
+                        nodes_to_update.append(nodeID)
+                        updated.add(nodeID)
+
+            if topo_in_block:
+                plan.append((b, (block_x_min, block_y_min, block_x_max, block_y_max),
+                             topo_in_block, nodes_to_update))
+            b = b + 1
+    return plan
+
+
+def synthetic_topo_list(n_streams, azimuths, searchDistance_max, length=5000,
+                        node_dx=50, spacing=200, seed=0):
+    """Returns the Step 4 topo_list of nodes every node_dx on meandering
+    streams spacing apart"""
+    from math import sin, cos, radians
+    rand = np.random.RandomState(seed)
+    topo_list = []
+    nodeID = 0
+    for i in range(n_streams):
+        x = 500000.0 + np.arange(0, length, node_dx)
+        y = (4800000.0 + i * spacing +
+             rand.uniform(10, 50) * np.sin(x / rand.uniform(200, 800)))
+        for node_x, node_y in zip(x.tolist(), y.tolist()):
+            for a in azimuths:
+                end_x = ((searchDistance_max * sin(radians(a))) + node_x)
+                end_y = ((searchDistance_max * cos(radians(a))) + node_y)
+                topo_list.append([nodeID, i, a, 10.0, node_x, node_y, end_x, end_y])
+            nodeID += 1
+    return topo_list
+
+
+def bench_topo_planner():
+    """Step 4 create_blocks(): every topo line against the edges of every
+    block with find_intersection() vs. raster_blocks.plan_topo_blocks()"""
+    import raster_blocks
+
+    print("  {0:>8} {1:>8} {2:>8} {3:>8} {4:>10} {5:>12}".format(
+        "nodes", "lines", "block m", "blocks", "loops s", "planner s"))
+    for n_streams, azimuths, last_azimuth, block_size, loop in [
+            (10, [270, 180, 90], 90, 1000, True),
+            (10, [45, 90, 135, 180, 225, 270, 315, 365], 45, 1000, True),
+            (20, [45, 90, 135, 180, 225, 270, 315, 365], 45, 500, True),
+            (1000, [45, 90, 135, 180, 225, 270, 315, 365], 45, 5000, False)]:
+        searchDistance_max = 1000
+        topo_list = synthetic_topo_list(n_streams, azimuths, searchDistance_max)
+        args = (topo_list, block_size, searchDistance_max)
+        plan = raster_blocks.plan_topo_blocks(*args)
+        t_plan = timeit(lambda: raster_blocks.plan_topo_blocks(*args))
+
+        # every node is updated once, after its last block
+        updated = [nodeID for b, extent, lines, nodes in plan for nodeID in nodes]
+        assert sorted(updated) == sorted(set(row[0] for row in topo_list))
+        last_block = {}
+        for k, (b, extent, lines, nodes) in enumerate(plan):
+            for line in lines:
+                last_block[line[0]] = k
+        assert all(last_block[nodeID] == k for k, (b, extent, lines, nodes)
+                   in enumerate(plan) for nodeID in nodes)
+
+        t_loop = float("nan")
+        if loop:
+            # the same blocks and search distances
+            loop_args = (topo_list, block_size, last_azimuth, searchDistance_max)
+            assert ([p[:3] for p in _create_blocks_loop(*loop_args)] ==
+                    [p[:3] for p in plan])
+            t_loop = timeit(lambda: _create_blocks_loop(*loop_args), 1)
+        print("  {0:8d} {1:8d} {2:8d} {3:8d} {4:10.3f} {5:12.3f}".format(
+            len(topo_list) // len(azimuths), len(topo_list), block_size,
+            len(plan), t_loop, t_plan))
+
+
+def bench_horizon():
+    """Step 4 topo lines of 100,000 nodes in 8 directions from
+    raster_blocks.topo_angles() (RAY) vs. the horizon rasters of
+    horizon.HorizonRaster (HORIZON, RAY for 365 and the nodes on nodata
+    cells and Z_NODE other than the cell elevation): a first run building
+    the horizon tiles, a second run from the saved tiles, a run for new
+    nodes on the same tiles and a run with Z_NODE 0.5 m below the cell
+    (Step 3 searchCells > 0), which is all RAY."""
+    from math import sin, cos, radians, hypot
+    import raster_blocks
+    import raster_cache
+    import horizon
+
+    ncells, cellsize, searchDistance_max, tile_cells = 2048, 1.0, 300, 1024
+    x_min, y_max = 500000.0, 4800000.0 + ncells * cellsize
+    rand = np.random.RandomState(0)
+    xs = (np.arange(ncells, dtype=np.float32) * cellsize)[np.newaxis, :]
+    ys = (np.arange(ncells, dtype=np.float32) * cellsize)[:, np.newaxis]
+    dem = (60 * np.sin(xs / 300) * np.cos(ys / 450) +
+           20 * np.sin(xs / 70 + ys / 90) + 400).astype(np.float32)
+    dem += rand.rand(ncells, ncells).astype(np.float32)
+    dem[rand.rand(ncells, ncells) < 0.001] = -9999
+    info = raster_blocks.RasterInfo("dem", cellsize, cellsize, x_min,
+                                    y_max - ncells * cellsize,
+                                    x_min + ncells * cellsize, y_max)
+    disXY = hypot(cellsize, cellsize)
+    azimuthdisdict = {45:disXY,90:cellsize,135:disXY,180:cellsize,
+                      225:disXY,270:cellsize,315:disXY,365:cellsize}
+    azimuths = [45,90,135,180,225,270,315,365]
+
+    def reader(info, lower_left, ncols, nrows):
+        return _raster_to_numpy_array(dem, info, lower_left, ncols, nrows)
+
+    def nodes(shift):
+        # 50 meandering streams with a node every meter
+        x = np.tile(np.arange(24.0, 2024.0, 1.0), 50)
+        y = (np.repeat(20.0 + 40.0 * np.arange(50), 2000) + shift +
+             12 * np.sin(x / 150.0 + np.repeat(np.arange(50), 2000)))
+        node_x = x_min + x * cellsize
+        node_y = y_max - y * cellsize
+        rows, cols = raster_blocks.array_row_col(node_x, node_y, x_min,
+                                                 y_max, cellsize, cellsize)
+        return node_x, node_y, dem[rows, cols].astype(float)
+
+    # the block of the topo lines with the search distance around the DEM
+    pad = searchDistance_max + 2
+    block = np.pad(dem, pad, mode="constant", constant_values=-9999)
+
+    def ray(a, node_x, node_y, z_node):
+        n = len(node_x)
+        return raster_blocks.topo_angles(
+            block, x_min - pad * cellsize, y_max + pad * cellsize, cellsize,
+            cellsize, node_x, node_y, z_node,
+            [sin(radians(a))] * n, [cos(radians(a))] * n, [0] * n,
+            [searchDistance_max] * n, [azimuthdisdict[a]] * n, 1.0)
+
+    def run(cache, node_x, node_y, z_node):
+        results = []
+        built = 0
+        rays = 0
+        for a in azimuths:
+            if a not in horizon.DIRECTIONS:
+                results.append(ray(a, node_x, node_y, z_node))
+                continue
+            raster = horizon.HorizonRaster(cache, info, a, searchDistance_max,
+                                           azimuthdisdict[a], 1.0)
+            found = raster.sample(node_x, node_y, z_node)
+            rays += (~found[0]).sum()
+            result = list(ray(a, node_x[~found[0]], node_y[~found[0]],
+                              z_node[~found[0]]))
+            for p, values in enumerate(found[1:]):
+                out = np.empty(len(node_x), dtype=np.result_type(values, result[p]))
+                out[found[0]] = values
+                out[~found[0]] = result[p]
+                result[p] = out
+            results.append(result)
+            built += raster.built
+        return results, built, rays
+
+    node_x, node_y, z_node = nodes(0.0)
+    print("  {0} x {0} DEM, {1} nodes, {2} directions, {3} cell search, "
+          "{4} cell tiles".format(ncells, len(node_x), len(azimuths),
+                                  searchDistance_max, tile_cells))
+    start = time.time()
+    expected = [ray(a, node_x, node_y, z_node) for a in azimuths]
+    t_ray = time.time() - start
+    print("  {0:<32} {1:>8} {2:>10} {3:>10}".format(
+        "", "tiles", "RAY %", "seconds"))
+    print("  {0:<32} {1:>8} {2:>10} {3:10.3f}".format("RAY", "", "", t_ray))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache = raster_cache.TileCache(os.path.join(tmp_dir, "tiles"),
+                                       tile_cells, reader=reader)
+        for label, shift, z_change in [("HORIZON, first run", 0.0, 0.0),
+                                       ("HORIZON, saved tiles", 0.0, 0.0),
+                                       ("HORIZON, new nodes", 0.5, 0.0),
+                                       ("HORIZON, Z_NODE 0.5 m lower", 0.0, -0.5)]:
+            x, y, z = nodes(shift)
+            z = np.where(z > -9999, z + z_change, z)
+            if shift or z_change:
+                expected = [ray(a, x, y, z) for a in azimuths]
+            start = time.time()
+            results, built, rays = run(cache, x, y, z)
+            elapsed = time.time() - start
+            # the same as the topo lines
+            assert all(np.array_equal(u, v) for r, e in zip(results, expected)
+                       for u, v in zip(r, e))
+            print("  {0:<32} {1:8d} {2:10.1f} {3:10.3f}".format(
+                label, built, 100.0 * rays / (len(x) * (len(azimuths) - 1)),
+                elapsed))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bench_pyramid():
+    """Step 4 topo lines at full resolution vs. the max elevation pyramid
+    (pyramid.DemPyramid) for a range of tolerances: angle error, off
+    raster samples (NA_SAMPLES) as a share of the full resolution count
+    and time of a first run (building the levels) and a cached run. The
+    levels do not depend on the tolerance, so a first run only builds
+    the levels the tolerances before it did not use."""
+    import raster_blocks
+    import raster_cache
+    import pyramid
+
+    ncells, cellsize, searchDistance_max, block_size = 5120, 1.0, 2000, 1000
+    azimuths = [45, 90, 135, 180, 225, 270, 315, 365]
+    x_min, y_max = 497500.0, 4797800.0 + ncells * cellsize
+    rand = np.random.RandomState(0)
+    xs = (np.arange(ncells, dtype=np.float32) * cellsize)[np.newaxis, :]
+    ys = (np.arange(ncells, dtype=np.float32) * cellsize)[:, np.newaxis]
+    dem = (300 * np.sin(xs / 900) * np.cos(ys / 1300) +
+           80 * np.sin(xs / 170 + ys / 230) + 400).astype(np.float32)
+    dem += rand.rand(ncells, ncells).astype(np.float32) * 2
+    dem[rand.rand(ncells, ncells) < 0.001] = -9999
+    info = raster_blocks.RasterInfo("dem", cellsize, cellsize, x_min,
+                                    y_max - ncells * cellsize,
+                                    x_min + ncells * cellsize, y_max)
+
+    def reader(info, lower_left, ncols, nrows):
+        return _raster_to_numpy_array(dem, info, lower_left, ncols, nrows)
+
+    # nodes on the ground along three streams
+    topo_list = synthetic_topo_list(3, azimuths, searchDistance_max,
+                                    length=1000, node_dx=5)
+    for row in topo_list:
+        r, c = raster_blocks.array_row_col(row[4], row[5], x_min, y_max,
+                                           cellsize, cellsize)
+        row[3] = float(dem[r, c])
+    line = dict(((row[0], row[2]), k) for k, row in enumerate(topo_list))
+    plan = raster_blocks.plan_topo_blocks(topo_list, block_size,
+                                          searchDistance_max)
+    disXY = np.hypot(cellsize, cellsize)
+
+    def run(cache, z_pyramid):
+        angles = np.empty(len(topo_list))
+        angles.fill(-np.inf)
+        off = np.zeros(len(topo_list), dtype=np.int64)
+        for b, extent, samples_in_block, nodes_to_update in plan:
+            k = np.array([line[(s[0], s[2])] for s in samples_in_block])
+            a = np.radians([s[2] for s in samples_in_block])
+            args = ([s[4] for s in samples_in_block], [s[5] for s in samples_in_block],
+                    [s[3] for s in samples_in_block], np.sin(a), np.cos(a),
+                    [s[8] for s in samples_in_block], [s[9] for s in samples_in_block],
+                    [disXY if s[2] % 90 == 45 else cellsize for s in samples_in_block])
+            if z_pyramid is None:
+                tiles = raster_cache.line_tiles(info, *raster_blocks.topo_line_ends(
+                    *args[:2] + args[3:]), tile_cells=cache.tile_cells)
+                extent = (extent[0] - cellsize, extent[1] - cellsize,
+                          extent[2] + cellsize, extent[3] + cellsize)
+                z_array, bx, by = cache.read_block(info, extent, tiles)
+                result = raster_blocks.topo_angles(z_array, bx, by, cellsize,
+                                                   cellsize, *args + (1.0,))
+            else:
+                result = z_pyramid.topo_angles(extent, *args + (1.0,))
+            np.maximum.at(angles, k, result[0])
+            np.add.at(off, k, result[3])
+        return angles, off
+
+    folder = tempfile.mkdtemp()
+    try:
+        cache = raster_cache.TileCache(folder, reader=reader)
+        run(cache, None)
+        start = time.time()
+        full, full_off = run(cache, None)
+        t_full = time.time() - start
+        ok = full > -9999
+        print("  {0} topo lines, {1:g} km search, {2:g} m cells, full resolution "
+              "{3:.3f} s (cached tiles)".format(len(topo_list), searchDistance_max / 1000.0,
+                                                cellsize, t_full))
+
+        # the level cells are the max of the raster cells in them
+        z_pyramid = pyramid.DemPyramid(info, cache, 5.0, searchDistance_max)
+        level_info, level_cache = z_pyramid.levels[3]
+        block = (x_min + 800, y_max - 1600, x_min + 1600, y_max - 800)
+        z_level, bx, by = level_cache.read_block(level_info, block)
+        row0 = int(round((y_max - by) / cellsize))
+        col0 = int(round((bx - x_min) / cellsize))
+        nrows, ncols = z_level.shape
+        window = dem[row0:row0 + nrows * 8, col0:col0 + ncols * 8]
+        assert np.array_equal(z_level, window.reshape(nrows, 8, ncols, 8).max(axis=3).max(axis=1))
+
+        print("  {0:>9} {1:>6} {2:>9} {3:>9} {4:>8} {5:>10} {6:>10} {7:>10} {8:>8}".format(
+            "tolerance", "levels", "build s", "cached s", "speed-up",
+            "max err", "mean err", "> tol %", "NA %"))
+        for tolerance in [0.1, 0.25, 0.5, 1.0, 2.0, 4.0]:
+            z_pyramid = pyramid.DemPyramid(info, cache, tolerance, searchDistance_max)
+            start = time.time()
+            run(cache, z_pyramid)
+            t_build = time.time() - start
+            start = time.time()
+            angles, off = run(cache, z_pyramid)
+            t_cached = time.time() - start
+            error = np.abs(angles[ok] - full[ok])
+            print("  {0:9.2f} {1:6d} {2:9.3f} {3:9.3f} {4:8.1f} {5:10.3f} {6:10.4f} {7:10.2f} {8:8.1f}".format(
+                tolerance, len(z_pyramid.distances), t_build, t_cached,
+                t_full / t_cached, error.max(), error.mean(),
+                100.0 * (error > tolerance).mean(),
+                100.0 * off.sum() / max(full_off.sum(), 1)))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+class EmulatedUpdateCursor(object):
+    """In memory stand in for arcpy.da.UpdateCursor over a list of rows.
+    updateRow() stores a copy of the row and counts the writes."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.writes = 0
+        self.i = -1
+
+    def __iter__(self):
+        for self.i in range(len(self.rows)):
+            yield list(self.rows[self.i])
+
+    def updateRow(self, row):
+        self.rows[self.i] = tuple(row)
+        self.writes += 1
+
+
+def bench_write_back():
+    """Step 2 write back: nested dictionary lookups with updateRow() for
+    every field of every row vs. node_table.update_rows() with the
+    results indexed by NODE_ID and one updateRow() per row"""
+    import node_table
+    from collections import defaultdict
+
+    def nested_dict():
+        return defaultdict(nested_dict)
+
+    n_nodes = 100000
+    addFields = ["CHANWIDTH", "LEFT", "RIGHT", "WIDTH_MTHD"]
+    rand = np.random.RandomState(0)
+    node_ids = np.arange(n_nodes)
+    stream_ids = node_ids // 100
+    left = rand.uniform(1, 20, n_nodes)
+    right = rand.uniform(1, 20, n_nodes)
+    results = [left + right, left, right, np.full(n_nodes, "NEAREST")]
+    nodeDict = nested_dict()
+    for n in range(n_nodes):
+        for f, field in enumerate(addFields):
+            nodeDict[stream_ids[n]][node_ids[n]][field] = results[f][n]
+
+    # the cursor returns the rows in its own order
+    order = rand.permutation(n_nodes)
+    rows = [(int(stream_ids[i]), int(node_ids[i]), None, None, None, None)
+            for i in order]
+
+    def nested():
+        cursor = EmulatedUpdateCursor(list(rows))
+        for row in cursor:
+            for f, field in enumerate(addFields):
+                streamID = row[0]
+                nodeID = row[1]
+                row[f + 2] = nodeDict[streamID][nodeID][field]
+                cursor.updateRow(row)
+        return cursor
+
+    def keyed():
+        # opened with NODE_ID as the first field
+        cursor = EmulatedUpdateCursor([row[1:] for row in rows])
+        node_table.update_rows(cursor, node_ids.tolist(), results)
+        return cursor
+
+    a = nested()
+    b = keyed()
+    assert all(np.allclose(ra[2:5], rb[1:4]) and ra[5] == rb[4]
+               for ra, rb in zip(a.rows, b.rows))
+
+    t_nested = timeit(nested, 1)
+    t_keyed = timeit(keyed)
+    print("{0} nodes, {1} fields".format(n_nodes, len(addFields)))
+    for label, t, cursor in [("updateRow per field", t_nested, a),
+                             ("one keyed update per row", t_keyed, b)]:
+        print("  {0:<26} {1:8.3f} s {2:8d} writes".format(label, t, cursor.writes))
+
+
+BENCHMARKS = OrderedDict([("shade_engine", bench_shade_engine),
+                          ("solar_cache", bench_solar_cache),
+                          ("node_table", bench_node_table),
+                          ("scenarios", bench_scenarios),
+                          ("parallel_scenarios", bench_parallel_scenarios),
+                          ("stream_nodes", bench_stream_nodes),
+                          ("duplicate_ids", bench_duplicate_ids),
+                          ("projections", bench_projections),
+                          ("bank_index", bench_bank_index),
+                          ("distance_kernel", bench_distance_kernel),
+                          ("stream_banks", bench_stream_banks),
+                          ("transect", bench_transect),
+                          ("parallel_widths", bench_parallel_widths),
+                          ("write_back", bench_write_back),
+                          ("window_minimum", bench_window_minimum),
+                          ("gradients", bench_gradients),
+                          ("block_planner", bench_block_planner),
+                          ("raster_info", bench_raster_info),
+                          ("tile_cache", bench_tile_cache),
+                          ("topo_angles", bench_topo_angles),
+                          ("horizon", bench_horizon),
+                          ("corridor_reads", bench_corridor_reads),
+                          ("topo_planner", bench_topo_planner),
+                          ("pyramid", bench_pyramid)])
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print("--- {0}".format(name))
+        BENCHMARKS[name]()
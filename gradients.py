@@ -0,0 +1,50 @@
+########################################################################
+# TTools
+# Vectorized node gradients for Step 3
+
+# node_gradients() is the Step 3 gradient with smoothing in O(n) per
+# stream. A node closes a run of skipped (adverse slope) nodes when its
+# elevation is at or below the lowest elevation upstream, so the nodes
+# the gradient is measured between come from a running minimum and the
+# distances from a prefix sum of LENGTH.
+
+# This module does not need arcpy.
+
+########################################################################
+
+from __future__ import division, print_function
+import numpy as np
+
+
+def node_gradients(z, lengths, smooth_flag):
+    """Vectorized calculate_gradient() from Step 3. z and lengths are
+    the ELEVATION and LENGTH of the nodes of one stream from upstream
+    to downstream. With smooth_flag nodes higher than the node upstream
+    are skipped and get the gradient measured over the longer distance
+    to the next node that is not higher. Distances over skipped nodes
+    can differ from the original sum in the last digit."""
+    z = np.asarray(z, dtype=float)
+    lengths = np.asarray(lengths, dtype=float)
+    n = len(z)
+    gradient = np.zeros(n)
+    if n < 2:
+        return gradient
+
+    # nodes where the gradient is calculated and the node upstream
+    # it is measured from
+    if smooth_flag:
+        lowest = np.minimum.accumulate(z)
+        down = np.nonzero(~(z[1:] > lowest[:-1]))[0] + 1
+    else:
+        down = np.arange(1, n)
+    if len(down) == 0:
+        return gradient
+    up = np.concatenate(([0], down[:-1]))
+    skipped = down - up
+
+    # sum of the LENGTH of the skipped + 1 nodes from the down node
+    prefix = np.concatenate(([0.0], np.cumsum(lengths)))
+    dx = np.where(skipped == 1, lengths[down],
+                  prefix[np.minimum(down + skipped, n)] - prefix[down])
+    gradient[1:down[-1] + 1] = np.repeat((z[up] - z[down]) / dx, skipped)
+    return gradient
@@ -0,0 +1,408 @@
+########################################################################
+# TTools
+# Horizon rasters for Step 4
+
+# Horizon rasters for the Step 4 HORIZON topo method. The max topo angle
+# from a cell of an elevation array in one of the Step 4 directions is
+# measured from the cell elevation like the topo lines from Z_NODE. The
+# cells are swept one line of the array at a time (all lines in a group
+# at once) from the far end, keeping the upper convex hull of the
+# elevations ahead of the cell. The top of the angle from a cell is where
+# its tangent touches the hull and the hull points before the tangent
+# can be dropped for good, so each line is swept in linear time.
+
+# The search distance is kept exact by splitting each line into pieces
+# of the number of topo line samples (K). The cells of a piece see the
+# rest of the piece (the sweep above) and the start of the next piece,
+# which is a hull built forward from the start of the next piece and
+# searched with a binary search for the tangent.
+
+# Angles are compared with the same formula as the topo lines and the
+# nearest sample is kept on ties. Samples < -9998 are off raster. For the
+# 45/90/.../315 azimuths the results are the same as the topo lines from
+# a node whose Z_NODE is the elevation of its cell.
+
+# HorizonRaster builds the horizon of the raster one tile of the tile
+# cache at a time (the tiles with nodes on them) from a window of the
+# tile and the K cells ahead of it, and keeps the sample index, the
+# elevation there and the off raster samples of every cell in a folder
+# of the raster folder of the tile cache, so later runs on the same DEM
+# and search distance only sample them. The horizon is only used for
+# nodes with the elevation of their cell as Z_NODE (Step 3 searchCells 0),
+# because the max angle from a lower node is often a nearer sample, and
+# the topo lines are sampled for the other nodes.
+# A tile costs about as much as the topo lines of one node on every 10
+# to 20 cells (search distance of 300 cells), so the first run is only
+# faster for dense nodes and the later runs are faster for any nodes.
+
+# This module does not need arcpy.
+
+########################################################################
+
+from __future__ import division, print_function
+import os
+import hashlib
+import numpy as np
+
+import raster_blocks
+
+# array (row, col) step of each Step 4 azimuth. Rows increase southward.
+DIRECTIONS = {45: (-1, 1), 90: (0, 1), 135: (1, 1), 180: (1, 0),
+              225: (1, -1), 270: (0, -1), 315: (-1, -1)}
+
+# maximum number of cells swept at once
+SWEEP_CELLS = 4000000
+
+
+def line_cells(shape, direction, lines, positions):
+    """Returns the array rows and cols of positions (2D, one row for
+    each line) along lines of a 2D array in a direction from DIRECTIONS
+    and a mask of the cells inside the array. Moving one position along
+    a line moves one step in the direction."""
+    nrows, ncols = shape
+    dr, dc = direction
+    lines = np.asarray(lines, dtype=np.int64)[:, np.newaxis]
+    pos = np.asarray(positions, dtype=np.int64)
+    if dr == 0:
+        rows = lines
+        cols = pos if dc > 0 else ncols - 1 - pos
+    elif dc == 0:
+        cols = lines
+        rows = pos if dr > 0 else nrows - 1 - pos
+    else:
+        # diagonals of the array flipped to the (1, 1) direction
+        rows = pos if dr > 0 else nrows - 1 - pos
+        cols = lines - (nrows - 1) + pos
+        cols = cols if dc > 0 else ncols - 1 - cols
+    rows, cols = np.broadcast_arrays(rows, cols)
+    inside = (rows >= 0) & (rows < nrows) & (cols >= 0) & (cols < ncols)
+    return np.clip(rows, 0, nrows - 1), np.clip(cols, 0, ncols - 1), inside
+
+
+def cell_lines(shape, direction, rows, cols):
+    """Returns the line and position of array cells for line_cells()"""
+    nrows, ncols = shape
+    dr, dc = direction
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if dr == 0:
+        return rows, cols if dc > 0 else ncols - 1 - cols
+    if dc == 0:
+        return cols, rows if dr > 0 else nrows - 1 - rows
+    rows_f = rows if dr > 0 else nrows - 1 - rows
+    cols_f = cols if dc > 0 else ncols - 1 - cols
+    return cols_f - rows_f + nrows - 1, rows_f
+
+
+def _sweep(z, valid, K):
+    """Returns the position of the max angle sample ahead of each
+    position of the lines (rows) of z within K positions, -1 if there
+    is none. Two candidates are returned: the max in the rest of each
+    piece of K positions and the max in the start of the next piece."""
+    n, L = z.shape
+    best_rest = np.full((n, L), -1, dtype=np.int64)
+    best_next = np.full((n, L), -1, dtype=np.int64)
+    stack = np.zeros((n, K + 1), dtype=np.int64)
+
+    for j in range(0, L, K):
+        # backward sweep of the piece, the upper hull of the positions
+        # ahead with the nearest on the top of the stack
+        h = np.zeros(n, dtype=np.int64)
+        for t in range(min(j + K, L) - 1, j - 1, -1):
+            obs = np.nonzero(valid[:, t])[0]
+            zt = z[obs, t]
+            act = np.nonzero(h[obs] >= 2)[0]
+            while len(act):
+                rows = obs[act]
+                top = stack[rows, h[rows] - 1]
+                sec = stack[rows, h[rows] - 2]
+                # drop the top if the next one is strictly higher
+                pop = (z[rows, sec] - zt[act]) * (top - t) > (z[rows, top] - zt[act]) * (sec - t)
+                act = act[pop]
+                h[obs[act]] -= 1
+                act = act[h[obs[act]] >= 2]
+            seen = obs[h[obs] >= 1]
+            best_rest[seen, t] = stack[seen, h[seen] - 1]
+            stack[obs, h[obs]] = t
+            h[obs] += 1
+
+        # forward hull of the next piece, searched from each position
+        # of this piece for the samples up to K positions ahead
+        if j + K >= L:
+            break
+        h = np.zeros(n, dtype=np.int64)
+        for o in range(K):
+            p = j + K + o
+            if p < L:
+                add = np.nonzero(valid[:, p])[0]
+                act = add[h[add] >= 2]
+                while len(act):
+                    a = stack[act, h[act] - 2]
+                    b = stack[act, h[act] - 1]
+                    # drop b if it is on or below the line from a to p
+                    pop = (z[act, b] - z[act, a]) * (p - a) <= (z[act, p] - z[act, a]) * (b - a)
+                    act = act[pop]
+                    h[act] -= 1
+                    act = act[h[act] >= 2]
+                stack[add, h[add]] = p
+                h[add] += 1
+
+            t = j + o
+            obs = np.nonzero(valid[:, t] & (h >= 1))[0]
+            if len(obs) == 0:
+                continue
+            zt = z[obs, t]
+            # first hull point at least as high as the next one
+            lo = np.zeros(len(obs), dtype=np.int64)
+            hi = h[obs] - 1
+            act = np.nonzero(lo < hi)[0]
+            while len(act):
+                mid = (lo[act] + hi[act]) // 2
+                rows = obs[act]
+                a = stack[rows, mid]
+                b = stack[rows, mid + 1]
+                up = (z[rows, a] - zt[act]) * (b - t) >= (z[rows, b] - zt[act]) * (a - t)
+                hi[act] = np.where(up, mid, hi[act])
+                lo[act] = np.where(up, lo[act], mid + 1)
+                act = act[lo[act] < hi[act]]
+            best_next[obs, t] = stack[obs, lo]
+    return best_rest, best_next
+
+
+def segment_horizons(z_array, direction, lines, starts, lengths, distance,
+                     con_to_m):
+    """Sweeps segments of lines of z_array (line, start position and
+    number of positions). Returns for every position of each segment
+    (a list with one array of each segment) the max topo angle, the index
+    of its sample distance and the number of off raster samples.
+    distance is the sample distances of a topo line (units of the fc,
+    see raster_blocks.search_distances())."""
+    distance = np.asarray(distance, dtype=float)
+    lines = np.asarray(lines, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    K = len(distance)
+    # same type as the elevation array minus a node elevation
+    z_type = np.result_type(z_array.dtype, 0.0)
+    n = len(lines)
+    results = [None] * n
+
+    # segments of about the same length in each group
+    order = np.argsort(lengths, kind="mergesort")
+    sorted_lengths = lengths[order]
+    s = 0
+    while s < n:
+        cells = np.arange(1, n - s + 1) * (sorted_lengths[s:] + K)
+        e = s + max(1, np.searchsorted(cells, SWEEP_CELLS, side="right"))
+        i = order[s:e]
+        L = sorted_lengths[e - 1]
+        t = np.arange(L)
+        rows, cols, inside = line_cells(z_array.shape, direction, lines[i],
+                                        starts[i, np.newaxis] + t)
+        z = z_array[rows, cols]
+        valid = inside & ~(z < -9998)
+        best_rest, best_next = _sweep(z.astype(float), valid, K)
+
+        z = z.astype(z_type)
+        line = np.arange(len(i))[:, np.newaxis]
+        a, k = None, None
+        for best in [best_rest, best_next]:
+            found = best >= 0
+            k_best = np.where(found, best - t - 1, 0)
+            a_best = np.degrees(np.arctan(
+                (z[line, np.where(found, best, t)] - z) /
+                (distance[k_best] * con_to_m)))
+            a_best[~found] = -np.inf
+            if a is None:
+                a, k = a_best, k_best
+            else:
+                # the nearest sample is kept on ties
+                use = a_best > a
+                a = np.where(use, a_best, a)
+                k = np.where(use, k_best, k)
+        a[np.isinf(a)] = -9999
+        k[a == -9999] = 0
+
+        # off raster samples in the K positions ahead, past the end of
+        # the segment is off raster
+        bad = np.zeros((len(i), L + 1), dtype=np.int64)
+        np.cumsum(~valid, axis=1, out=bad[:, 1:])
+        end = np.minimum(t + K + 1, L)
+        off = bad[:, end] - bad[:, t + 1] + np.maximum(t + K + 1 - L, 0)
+
+        for g, segment in enumerate(i.tolist()):
+            length = lengths[segment]
+            results[segment] = (a[g, :length], k[g, :length], off[g, :length])
+        s = e
+    return results
+
+
+class HorizonRaster(object):
+    """Horizon of a raster (info is a raster_blocks.RasterInfo) in an
+    azimuth from DIRECTIONS for the topo lines of searchDistance_max by
+    cellsize (units of the fc), built on the tiles of tile_cache (a
+    raster_cache.TileCache) and kept in a folder of its raster folder.
+    Without a cache folder the tiles are built on every run."""
+
+    def __init__(self, tile_cache, info, azimuth, searchDistance_max,
+                 cellsize, con_to_m):
+        self.tile_cache = tile_cache
+        self.info = info
+        self.direction = DIRECTIONS[azimuth]
+        self.distance = raster_blocks.search_distances(
+            [0], [searchDistance_max], [cellsize])[0][0]
+        self.con_to_m = con_to_m
+        self.folder = None
+        raster_folder = tile_cache.raster_folder(info)
+        if raster_folder is not None:
+            key = (azimuth, len(self.distance), info.con_to_m)
+            self.folder = os.path.join(raster_folder, "horizon_{0}".format(
+                hashlib.sha1(repr(key).encode("utf-8")).hexdigest()))
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+        self.built = 0
+        self.loaded = 0
+
+    def build(self, row, col):
+        """Returns the sample index (-1 on nodata cells), the elevation
+        there, the off raster samples and the elevation of the cells of
+        a tile"""
+        info = self.info
+        size = self.tile_cache.tile_cells
+        K = len(self.distance)
+        dr, dc = self.direction
+        r0 = row * size
+        c0 = col * size
+        nrows = min(size, info.nrows - r0)
+        ncols = min(size, info.ncols - c0)
+
+        # window of the tile and the K cells ahead of it
+        w_r0 = r0 + min(dr, 0) * K
+        w_c0 = c0 + min(dc, 0) * K
+        w_nrows = nrows + abs(dr) * K
+        w_ncols = ncols + abs(dc) * K
+        block_x_min = info.x_min + w_c0 * info.x_cellsize
+        block_y_max = info.y_max - w_r0 * info.y_cellsize
+        lower_left = (block_x_min + info.x_cellsize / 2,
+                      block_y_max - (w_nrows - 0.5) * info.y_cellsize)
+        z_array = info.to_meters(self.tile_cache.read_window(
+            info, block_x_min, block_y_max, lower_left, w_ncols, w_nrows))
+
+        # the lines through the tile cells from the first cell to K
+        # past the last one
+        rows, cols = np.mgrid[r0 - w_r0:r0 - w_r0 + nrows,
+                              c0 - w_c0:c0 - w_c0 + ncols]
+        line, pos = cell_lines(z_array.shape, self.direction, rows.ravel(),
+                               cols.ravel())
+        order = np.lexsort((pos, line))
+        line = line[order]
+        pos = pos[order]
+        first = np.ones(len(line), dtype=bool)
+        first[1:] = line[1:] != line[:-1]
+        segment = np.cumsum(first) - 1
+        start = pos[first]
+        count = np.bincount(segment)
+        results = segment_horizons(z_array, self.direction, line[first],
+                                   start, count + K, self.distance,
+                                   self.con_to_m)
+        k = np.concatenate([r[1][:c] for r, c in zip(results, count.tolist())])
+        off = np.concatenate([r[2][:c] for r, c in zip(results, count.tolist())])
+
+        # the elevation at the sample, -9999 past the window like the
+        # cells off the raster
+        topo_rows, topo_cols, inside = line_cells(
+            z_array.shape, self.direction, line, (pos + k + 1)[:, np.newaxis])
+        z_topo = np.where(inside[:, 0], z_array[topo_rows[:, 0], topo_cols[:, 0]],
+                          -9999).astype(z_array.dtype)
+        z = z_array[rows.ravel()[order], cols.ravel()[order]]
+        k[z < -9998] = -1
+
+        tile = []
+        for values in [k.astype(np.int32), z_topo, off.astype(np.int32), z]:
+            cells = np.empty(len(values), dtype=values.dtype)
+            cells[order] = values
+            tile.append(cells.reshape(nrows, ncols))
+        self.built += 1
+        return tile
+
+    def tile(self, row, col):
+        """Returns the tile at tile row/col from disk or builds it"""
+        path = None
+        if self.folder is not None:
+            path = os.path.join(self.folder, "{0}_{1}.npz".format(row, col))
+            if os.path.exists(path):
+                try:
+                    data = np.load(path)
+                    tile = [data["index"], data["z_topo"], data["off"], data["z"]]
+                    data.close()
+                    self.loaded += 1
+                    return tile
+                except Exception:
+                    # corrupt or partial file, build it again
+                    pass
+        tile = self.build(row, col)
+        if path is not None:
+            tmp_path = path + ".tmp.npz"
+            np.savez(tmp_path, index=tile[0], z_topo=tile[1], off=tile[2],
+                     z=tile[3])
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        return tile
+
+    def sample(self, node_x, node_y, z_node):
+        """Returns the mask of the nodes with the elevation of their
+        raster cell as z_node (the cell has data) and the max topo angle,
+        the distance to it (units of the fc), the elevation there and the
+        number of off raster samples of those nodes, the same as
+        raster_blocks.topo_angles()"""
+        info = self.info
+        node_x = np.asarray(node_x, dtype=float)
+        node_y = np.asarray(node_y, dtype=float)
+        rows, cols = raster_blocks.array_row_col(node_x, node_y, info.x_min,
+                                                 info.y_max, info.x_cellsize,
+                                                 info.y_cellsize)
+        inside = ((node_x >= info.x_min) & (node_y <= info.y_max) &
+                  (rows < info.nrows) & (cols < info.ncols))
+        n = len(node_x)
+        index = np.empty(n, dtype=np.int64)
+        index.fill(-1)
+        off_raster = np.zeros(n, dtype=np.int64)
+        z_cell = np.zeros(n)
+        z_topo = None
+
+        # one tile at a time
+        size = self.tile_cache.tile_cells
+        tile_ids = (rows // size) * 4294967296 + cols // size
+        nodes = np.nonzero(inside)[0]
+        nodes = nodes[np.argsort(tile_ids[nodes], kind="mergesort")]
+        bounds = np.nonzero(np.diff(tile_ids[nodes]))[0] + 1
+        for group in np.split(nodes, bounds) if len(nodes) else []:
+            row = int(rows[group[0]] // size)
+            col = int(cols[group[0]] // size)
+            tile = self.tile(row, col)
+            r = rows[group] - row * size
+            c = cols[group] - col * size
+            if z_topo is None:
+                z_topo = np.zeros(n, dtype=tile[1].dtype)
+            index[group] = tile[0][r, c]
+            z_topo[group] = tile[1][r, c]
+            off_raster[group] = tile[2][r, c]
+            z_cell[group] = tile[3][r, c]
+
+        # the max angle from a lower or higher node can be another sample
+        z_node = np.asarray(z_node, dtype=float)
+        found = (index >= 0) & (z_node == z_cell)
+        if z_topo is None:
+            z_topo = np.zeros(n)
+        index = index[found]
+        z_topo = z_topo[found]
+        off_raster = off_raster[found]
+        distance = self.distance[index]
+        # same type as the elevation array minus a node elevation
+        z_node = z_node[found].astype(
+            np.result_type(z_topo.dtype, 0.0))
+        angle = np.degrees(np.arctan((z_topo - z_node) / (distance * self.con_to_m)))
+        # lines with every sample off raster
+        angle[off_raster >= len(self.distance)] = -9999
+        return found, angle, distance, z_topo, off_raster
@@ -0,0 +1,121 @@
+#-------------------------------------------------------------------------------
+# Name:        node_table
+# Purpose:     Read the node feature class in a single scan into NumPy arrays
+#              and apply the Step 6 value fixes as vectorized transforms.
+#              Write result arrays back keyed by NODE_ID with one update
+#              per row.
+#
+# Author:      George
+#
+# Created:     18/10/2026
+# Copyright:   (c) George 2017
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+from __future__ import division, print_function
+import numpy as np
+
+# Fields Step 6 exports to the Shade-a-lator. T1 = left bank, T2 = right bank
+LC_FIELDS = (["LC_T1_S{0}".format(s) for s in range(1, 10)] +
+             ["LC_T2_S{0}".format(s) for s in range(1, 10)])
+ELE_FIELDS = (["ELE_T1_S{0}".format(s) for s in range(1, 10)] +
+              ["ELE_T2_S{0}".format(s) for s in range(1, 10)])
+STEP6_FIELDS = (["STREAM_ID", "FID", "NODE_ID", "LONGITUDE", "LATITUDE",
+                 "STRM_AZMTH", "CHANWIDTH", "LEFT", "RIGHT", "ELEVATION",
+                 "TOPO_W", "TOPO_S", "TOPO_E"] + LC_FIELDS + ELE_FIELDS)
+
+
+def rows_to_columns(rows, fields):
+    """Converts a list of row tuples into a dictionary of column arrays.
+    Columns with null values or text are kept as object arrays."""
+    if rows:
+        columns = list(zip(*rows))
+    else:
+        columns = [()] * len(fields)
+
+    table = {}
+    for field, column in zip(fields, columns):
+        try:
+            if any(v is None for v in column):
+                raise TypeError
+            table[field] = np.array(column)
+            if table[field].dtype.kind not in "biuf":
+                table[field] = np.array(column, dtype=object)
+        except (TypeError, ValueError):
+            table[field] = np.array(column, dtype=object)
+    return table
+
+
+def read_node_table(fc, fields, whereclause=""):
+    """Reads all the fields from the feature class with one
+    SearchCursor and returns a dictionary of NumPy arrays keyed by
+    field name, in cursor order"""
+    import arcpy
+
+    with arcpy.da.SearchCursor(fc, fields, whereclause) as cursor:
+        rows = [row for row in cursor]
+    return rows_to_columns(rows, fields)
+
+
+def as_float(values):
+    """Returns values as a float array with nulls set to zero"""
+    values = np.asarray(values)
+    if values.dtype == object:
+        values = np.array([0 if v is None else v for v in values], dtype=float)
+    return values.astype(float)
+
+
+def set_to_zero(values):
+    """Vectorized setToZero(). Returns floats with negative values set
+    to 0 (e.g. elevations and topo angles) to avoid errors in the
+    Shade-a-lator"""
+    return np.maximum(as_float(values), 0.0)
+
+
+def offset_by_1(values, cap=None, as_int=True):
+    """Vectorized offsetBy1(). Negative landcover codes are set to 0,
+    optionally capped, and 1 is added to get round the problem with
+    Riparian Code 0 in the Shade-a-lator. as_int=True truncates the codes
+    to integers like the original Step 6."""
+    values = as_float(values)
+    if as_int:
+        values = np.trunc(values)
+    values = np.maximum(values, 0)
+    if cap is not None:
+        values = np.minimum(values, cap)
+    values = values + 1
+    if as_int:
+        values = values.astype(np.int64)
+    return values
+
+
+def update_rows(cursor, keys, columns):
+    """Writes the results to the rows of an update cursor opened with the
+    key field first and then the fields of columns, in the same order.
+    keys is the key (e.g. NODE_ID) of each result and columns a list of
+    result arrays or lists. The results are indexed by key once and every
+    row is updated once with all its fields. Rows without a result are
+    not changed. Returns the number of rows updated."""
+    index = dict((k, i) for i, k in enumerate(keys))
+    columns = [c.tolist() if hasattr(c, "tolist") else list(c) for c in columns]
+    n = 0
+    for row in cursor:
+        i = index.get(row[0])
+        if i is None:
+            continue
+        row = list(row)
+        for f, column in enumerate(columns):
+            row[f + 1] = column[i]
+        cursor.updateRow(row)
+        n += 1
+    return n
+
+
+def write_node_table(fc, keyField, keys, columns, fields, whereclause=""):
+    """Writes the result columns to fields of the feature class rows
+    matching keys in the keyField with one UpdateCursor. See
+    update_rows()"""
+    import arcpy
+
+    with arcpy.da.UpdateCursor(fc, [keyField] + list(fields), whereclause) as cursor:
+        return update_rows(cursor, keys, columns)
@@ -0,0 +1,252 @@
+########################################################################
+# TTools
+# Vectorized projected to geographic coordinate transforms
+
+# Converts arrays of projected x/y coordinates to longitude/latitude in
+# decimal degrees without arcpy for the common TTools projections:
+# Transverse Mercator (UTM, state plane) and Lambert Conformal Conic
+# (Oregon Lambert, state plane). The formulas are the ellipsoidal
+# equations from Snyder (1987) Map Projections - A Working Manual,
+# USGS Professional Paper 1395.
+
+# NAD83 (GRS80) and WGS84 differ by less than 0.1 mm in the ellipsoid
+# and no datum transformation is applied, the same as arcpy when no
+# geographic transformation is set.
+
+# transform_for() returns a transform for an arcpy spatial reference or
+# an EPSG code from EPSG_PARAMETERS and None if the projection is not
+# supported, in which case Step 1 falls back to arcpy.
+
+########################################################################
+
+from __future__ import division, print_function
+import numpy as np
+
+# semi-major axis (m) and flattening
+WGS84 = (6378137.0, 1 / 298.257223563)
+GRS80 = (6378137.0, 1 / 298.257222101)
+
+FEET_INTL = 0.3048
+
+# Oregon Statewide Lambert
+_OREGON_LAMBERT = {"projection": "Lambert_Conformal_Conic",
+                   "lat_1": 43.0, "lat_2": 45.5, "lat_0": 41.75,
+                   "lon_0": -120.5, "x_0": 400000.0, "y_0": 0.0,
+                   "ellipsoid": GRS80}
+
+EPSG_PARAMETERS = {
+    2991: dict(_OREGON_LAMBERT, metersPerUnit=1.0),
+    2992: dict(_OREGON_LAMBERT, metersPerUnit=FEET_INTL),
+    2993: dict(_OREGON_LAMBERT, metersPerUnit=1.0),
+    2994: dict(_OREGON_LAMBERT, metersPerUnit=FEET_INTL)}
+
+
+def utm_parameters(zone, south=False, ellipsoid=WGS84):
+    """Returns the transverse mercator parameters of a UTM zone"""
+    return {"projection": "Transverse_Mercator",
+            "lon_0": -183.0 + 6 * zone, "lat_0": 0.0, "k_0": 0.9996,
+            "x_0": 500000.0, "y_0": 10000000.0 if south else 0.0,
+            "ellipsoid": ellipsoid, "metersPerUnit": 1.0}
+
+
+def epsg_parameters(code):
+    """Returns the projection parameters of an EPSG code or None"""
+    code = int(code)
+    if code in EPSG_PARAMETERS:
+        return EPSG_PARAMETERS[code]
+    if 32601 <= code <= 32660:
+        return utm_parameters(code - 32600)
+    if 32701 <= code <= 32760:
+        return utm_parameters(code - 32700, south=True)
+    if 26901 <= code <= 26923:
+        return utm_parameters(code - 26900, ellipsoid=GRS80)
+    return None
+
+
+def spatial_reference_parameters(sr):
+    """Returns the projection parameters of an arcpy SpatialReference
+    or None if the projection is not supported"""
+    parameters = epsg_parameters(sr.factoryCode) if sr.factoryCode else None
+    if parameters is not None:
+        return parameters
+
+    if sr.type != "Projected":
+        return None
+    spheroid = sr.GCS.spheroidName.upper()
+    if "GRS" in spheroid and "1980" in spheroid:
+        ellipsoid = GRS80
+    elif "WGS" in spheroid and "1984" in spheroid:
+        ellipsoid = WGS84
+    else:
+        return None
+    parameters = {"ellipsoid": ellipsoid,
+                  "metersPerUnit": sr.metersPerUnit,
+                  "lon_0": sr.centralMeridian,
+                  "lat_0": sr.latitudeOfOrigin,
+                  "x_0": sr.falseEasting * sr.metersPerUnit,
+                  "y_0": sr.falseNorthing * sr.metersPerUnit}
+    if sr.projectionName == "Transverse_Mercator":
+        parameters.update(projection="Transverse_Mercator",
+                          k_0=sr.scaleFactor)
+    elif sr.projectionName == "Lambert_Conformal_Conic":
+        parameters.update(projection="Lambert_Conformal_Conic",
+                          lat_1=sr.standardParallel1,
+                          lat_2=sr.standardParallel2)
+    else:
+        return None
+    return parameters
+
+
+def _tm_inverse(x, y, lon_0, lat_0, k_0, x_0, y_0, ellipsoid):
+    a, f = ellipsoid
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+
+    m0 = _meridian_distance(np.radians(lat_0), a, e2)
+    m = m0 + (y - y_0) / k_0
+    mu = m / (a * (1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256))
+    e1 = (1 - np.sqrt(1 - e2)) / (1 + np.sqrt(1 - e2))
+
+    # footpoint latitude
+    phi1 = (mu + (3 * e1 / 2 - 27 * e1 ** 3 / 32) * np.sin(2 * mu) +
+            (21 * e1 ** 2 / 16 - 55 * e1 ** 4 / 32) * np.sin(4 * mu) +
+            (151 * e1 ** 3 / 96) * np.sin(6 * mu) +
+            (1097 * e1 ** 4 / 512) * np.sin(8 * mu))
+
+    sin1 = np.sin(phi1)
+    cos1 = np.cos(phi1)
+    tan1 = np.tan(phi1)
+    c1 = ep2 * cos1 ** 2
+    t1 = tan1 ** 2
+    n1 = a / np.sqrt(1 - e2 * sin1 ** 2)
+    r1 = a * (1 - e2) / (1 - e2 * sin1 ** 2) ** 1.5
+    d = (x - x_0) / (n1 * k_0)
+
+    lat = phi1 - (n1 * tan1 / r1) * (
+        d ** 2 / 2 -
+        (5 + 3 * t1 + 10 * c1 - 4 * c1 ** 2 - 9 * ep2) * d ** 4 / 24 +
+        (61 + 90 * t1 + 298 * c1 + 45 * t1 ** 2 - 252 * ep2 - 3 * c1 ** 2) * d ** 6 / 720)
+    lon = np.radians(lon_0) + (
+        d - (1 + 2 * t1 + c1) * d ** 3 / 6 +
+        (5 - 2 * c1 + 28 * t1 - 3 * c1 ** 2 + 8 * ep2 + 24 * t1 ** 2) * d ** 5 / 120) / cos1
+    return np.degrees(lon), np.degrees(lat)
+
+
+def _tm_forward(lon, lat, lon_0, lat_0, k_0, x_0, y_0, ellipsoid):
+    a, f = ellipsoid
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+
+    phi = np.radians(lat)
+    sin = np.sin(phi)
+    cos = np.cos(phi)
+    n = a / np.sqrt(1 - e2 * sin ** 2)
+    t = np.tan(phi) ** 2
+    c = ep2 * cos ** 2
+    aa = (np.radians(lon) - np.radians(lon_0)) * cos
+    m = _meridian_distance(phi, a, e2)
+    m0 = _meridian_distance(np.radians(lat_0), a, e2)
+
+    x = x_0 + k_0 * n * (aa + (1 - t + c) * aa ** 3 / 6 +
+                         (5 - 18 * t + t ** 2 + 72 * c - 58 * ep2) * aa ** 5 / 120)
+    y = y_0 + k_0 * (m - m0 + n * np.tan(phi) * (
+        aa ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * aa ** 4 / 24 +
+        (61 - 58 * t + t ** 2 + 600 * c - 330 * ep2) * aa ** 6 / 720))
+    return x, y
+
+
+def _meridian_distance(phi, a, e2):
+    return a * ((1 - e2 / 4 - 3 * e2 ** 2 / 64 - 5 * e2 ** 3 / 256) * phi -
+                (3 * e2 / 8 + 3 * e2 ** 2 / 32 + 45 * e2 ** 3 / 1024) * np.sin(2 * phi) +
+                (15 * e2 ** 2 / 256 + 45 * e2 ** 3 / 1024) * np.sin(4 * phi) -
+                (35 * e2 ** 3 / 3072) * np.sin(6 * phi))
+
+
+def _lcc_constants(lat_1, lat_2, lat_0, ellipsoid):
+    a, f = ellipsoid
+    e = np.sqrt(f * (2 - f))
+
+    def m(phi):
+        return np.cos(phi) / np.sqrt(1 - (e * np.sin(phi)) ** 2)
+
+    def t(phi):
+        return (np.tan(np.pi / 4 - phi / 2) /
+                ((1 - e * np.sin(phi)) / (1 + e * np.sin(phi))) ** (e / 2))
+
+    phi1, phi2, phi0 = np.radians([lat_1, lat_2, lat_0])
+    if abs(phi1 - phi2) > 1e-12:
+        n = (np.log(m(phi1)) - np.log(m(phi2))) / (np.log(t(phi1)) - np.log(t(phi2)))
+    else:
+        n = np.sin(phi1)
+    F = m(phi1) / (n * t(phi1) ** n)
+    rho0 = a * F * t(phi0) ** n
+    return a, e, n, F, rho0, t
+
+
+def _lcc_inverse(x, y, lat_1, lat_2, lat_0, lon_0, x_0, y_0, ellipsoid):
+    a, e, n, F, rho0, _ = _lcc_constants(lat_1, lat_2, lat_0, ellipsoid)
+    dx = x - x_0
+    dy = rho0 - (y - y_0)
+    rho = np.sign(n) * np.hypot(dx, dy)
+    theta = np.arctan2(np.sign(n) * dx, np.sign(n) * dy)
+    t = (rho / (a * F)) ** (1 / n)
+
+    # iterate for the latitude, converges to < 1e-12 rad in a few steps
+    phi = np.pi / 2 - 2 * np.arctan(t)
+    for i in range(15):
+        es = e * np.sin(phi)
+        phi_new = np.pi / 2 - 2 * np.arctan(t * ((1 - es) / (1 + es)) ** (e / 2))
+        done = np.max(np.abs(phi_new - phi)) < 1e-12 if np.size(phi) else True
+        phi = phi_new
+        if done:
+            break
+    lon = theta / n + np.radians(lon_0)
+    return np.degrees(lon), np.degrees(phi)
+
+
+def _lcc_forward(lon, lat, lat_1, lat_2, lat_0, lon_0, x_0, y_0, ellipsoid):
+    a, e, n, F, rho0, t = _lcc_constants(lat_1, lat_2, lat_0, ellipsoid)
+    rho = a * F * t(np.radians(lat)) ** n
+    theta = n * (np.radians(lon) - np.radians(lon_0))
+    return x_0 + rho * np.sin(theta), y_0 + rho0 - rho * np.cos(theta)
+
+
+def to_geographic(x, y, parameters):
+    """Converts projected x/y arrays (in the units of the projection) to
+    longitude/latitude arrays in decimal degrees"""
+    p = parameters
+    x = np.asarray(x, dtype=float) * p["metersPerUnit"]
+    y = np.asarray(y, dtype=float) * p["metersPerUnit"]
+    if p["projection"] == "Transverse_Mercator":
+        return _tm_inverse(x, y, p["lon_0"], p["lat_0"], p["k_0"],
+                           p["x_0"], p["y_0"], p["ellipsoid"])
+    return _lcc_inverse(x, y, p["lat_1"], p["lat_2"], p["lat_0"], p["lon_0"],
+                        p["x_0"], p["y_0"], p["ellipsoid"])
+
+
+def from_geographic(lon, lat, parameters):
+    """Converts longitude/latitude arrays in decimal degrees to projected
+    x/y arrays in the units of the projection"""
+    p = parameters
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    if p["projection"] == "Transverse_Mercator":
+        x, y = _tm_forward(lon, lat, p["lon_0"], p["lat_0"], p["k_0"],
+                           p["x_0"], p["y_0"], p["ellipsoid"])
+    else:
+        x, y = _lcc_forward(lon, lat, p["lat_1"], p["lat_2"], p["lat_0"],
+                            p["lon_0"], p["x_0"], p["y_0"], p["ellipsoid"])
+    return x / p["metersPerUnit"], y / p["metersPerUnit"]
+
+
+def transform_for(sr):
+    """Returns a function converting projected x/y arrays to lon/lat
+    for an arcpy SpatialReference or EPSG code, or None if the
+    projection is not supported"""
+    if isinstance(sr, int):
+        parameters = epsg_parameters(sr)
+    else:
+        parameters = spatial_reference_parameters(sr)
+    if parameters is None:
+        return None
+    return lambda x, y: to_geographic(x, y, parameters)
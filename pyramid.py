@@ -0,0 +1,183 @@
+########################################################################
+# TTools
+# Max elevation pyramid for the Step 4 topo lines
+
+# Far from a node a topo line at full resolution takes many samples
+# that the horizon does not need: a cell is a small part of the view
+# and the max elevation of a coarser cell gives about the same angle.
+# Level k of the pyramid has cells 2 ** k times the raster cells with
+# the max elevation of the raster cells in them (nodata cells are the
+# lowest value so they only stay nodata if all of them are).
+
+# A topo line takes its samples from level k past the distance where a
+# cell of level k is as wide as the tolerance angle seen from the node,
+# 2 ** k * cellsize / tan(tolerance), every 2 ** k topo line cellsizes.
+# So the number of samples of a line grows with the log of the search
+# distance instead of the search distance. The max elevations make the
+# angles a little high (a peak up to a coarse cell to the side of the
+# line is seen) by about the tolerance at most; bench_pyramid() in
+# benchmarks.py measures the error.
+
+# A level k sample stands for the 2 ** k full resolution samples in its
+# step along the line and its cell is only nodata if all the raster
+# cells in it are, so an off raster level k sample counts 2 ** k off
+# raster samples. NA_SAMPLES stays about the full resolution count.
+
+# Each level is read through its own raster_cache.TileCache with tiles
+# of tile_cells >> k cells so a level tile covers one raster tile and
+# is built from the level below the first time it is read. The level
+# tiles are kept in the tile cache folder like the raster tiles, so the
+# pyramid is built once per raster and only where the topo lines go.
+# Without a tile cache folder the levels are built from the raster on
+# each read.
+
+# This module does not need arcpy.
+
+########################################################################
+
+from __future__ import division, print_function
+from math import radians, tan
+import numpy as np
+
+import raster_blocks
+import raster_cache
+
+# smallest level tile in cells
+MIN_TILE_CELLS = 16
+
+
+def level_info(info, level):
+    """Returns the RasterInfo of a pyramid level with the same upper
+    left corner as the raster (info)"""
+    scale = 2 ** level
+    x_cellsize = info.x_cellsize * scale
+    y_cellsize = info.y_cellsize * scale
+    ncols = -(-info.ncols // scale)
+    nrows = -(-info.nrows // scale)
+    return raster_blocks.RasterInfo(info.raster, x_cellsize, y_cellsize,
+                                    info.x_min, info.y_max - nrows * y_cellsize,
+                                    info.x_min + ncols * x_cellsize, info.y_max,
+                                    info.nodata, info.pixel_type, info.con_to_m)
+
+
+def max_overview(array):
+    """Returns the max of each 2 x 2 cells of an array with an even
+    number of rows and cols"""
+    nrows, ncols = array.shape
+    return array.reshape(nrows // 2, 2, ncols // 2, 2).max(axis=3).max(axis=1)
+
+
+def level_distances(cellsize, tolerance, searchDistance_max,
+                    tile_cells=raster_cache.TILE_CELLS):
+    """Returns the distances where levels 1, 2, ... start for a raster
+    cellsize and a tolerance in degrees, up to searchDistance_max"""
+    distances = []
+    level = 1
+    while (tile_cells >> level) >= MIN_TILE_CELLS:
+        distance = (2 ** level) * cellsize / tan(radians(tolerance))
+        if distance >= searchDistance_max:
+            break
+        distances.append(distance)
+        level += 1
+    return distances
+
+
+class DemPyramid(object):
+    """Max elevation levels of a raster (info is a raster_blocks.
+    RasterInfo) read through tile_cache. tolerance is in degrees and
+    searchDistance_max in units of the raster."""
+
+    def __init__(self, info, tile_cache, tolerance, searchDistance_max):
+        self.tolerance = tolerance
+        self.distances = level_distances(max(info.x_cellsize, info.y_cellsize),
+                                         tolerance, searchDistance_max,
+                                         tile_cache.tile_cells)
+        self.levels = [(info, tile_cache)]
+        for level in range(1, len(self.distances) + 1):
+            lower_info, lower_cache = self.levels[-1]
+            self.levels.append((level_info(info, level), raster_cache.TileCache(
+                tile_cache.cache_dir, tile_cache.tile_cells >> level,
+                max_entries=tile_cache.max_entries, max_age_days=None,
+                reader=overview_reader(lower_info, lower_cache))))
+
+    def topo_angles(self, block_extent, node_x, node_y, z_node, sin_a, cos_a,
+                    start, end, cellsize, con_to_m):
+        """raster_blocks.topo_angles() of the topo lines of a block with
+        the samples past each level distance taken from that level. Reads
+        the tiles of each level crossed by the lines. The off raster
+        samples are counted in full resolution samples. Returns None if
+        the arrays read have no data."""
+        node_x = np.asarray(node_x, dtype=float)
+        node_y = np.asarray(node_y, dtype=float)
+        z_node = np.asarray(z_node, dtype=float)
+        sin_a = np.asarray(sin_a, dtype=float)
+        cos_a = np.asarray(cos_a, dtype=float)
+        cellsize = np.asarray(cellsize, dtype=float)
+        end = np.asarray(end, dtype=float)
+        # use next cell over to avoid divide by zero errors
+        start = np.asarray(start, dtype=float)
+        start = np.where(start <= 0, cellsize, start)
+
+        n = len(node_x)
+        topoAngle = np.empty(n)
+        topoAngle.fill(-np.inf)
+        distance_max = np.zeros(n)
+        z_topo = np.zeros(n)
+        off_raster = np.zeros(n, dtype=np.int64)
+
+        # the level of the first sample of each line
+        first = np.searchsorted(self.distances, start, side="right")
+        bounds = [0.0] + self.distances + [np.inf]
+        has_data = False
+        for level, (info, cache) in enumerate(self.levels):
+            lo = np.maximum(start, bounds[level])
+            hi = np.minimum(end, bounds[level + 1])
+            i = np.nonzero((first == level) | (lo < hi))[0]
+            if not len(i):
+                continue
+            step = cellsize[i] * 2 ** level
+            tiles = raster_cache.line_tiles(info, *raster_blocks.topo_line_ends(
+                node_x[i], node_y[i], sin_a[i], cos_a[i], lo[i], hi[i], step),
+                tile_cells=cache.tile_cells)
+
+            # a cell more so samples on the block edge are in the array
+            block = (block_extent[0] - info.x_cellsize, block_extent[1] - info.y_cellsize,
+                     block_extent[2] + info.x_cellsize, block_extent[3] + info.y_cellsize)
+            z_array, block_x_min, block_y_max = cache.read_block(info, block, tiles)
+            if z_array.max() > -9999:
+                has_data = True
+
+            angle, distance, z, off = raster_blocks.topo_angles(
+                z_array, block_x_min, block_y_max, info.x_cellsize,
+                info.y_cellsize, node_x[i], node_y[i], z_node[i], sin_a[i],
+                cos_a[i], lo[i], hi[i], step, con_to_m)
+
+            # levels are in distance order so the first max is kept
+            better = angle > topoAngle[i]
+            topoAngle[i[better]] = angle[better]
+            distance_max[i[better]] = distance[better]
+            z_topo[i[better]] = z[better]
+            # in full resolution samples
+            off_raster[i] += off * 2 ** level
+
+        if not has_data:
+            return None
+        return topoAngle, distance_max, z_topo, off_raster
+
+
+def overview_reader(lower_info, lower_cache):
+    """Returns a TileCache reader of a level built from the window of
+    the level below (lower_info) read through lower_cache"""
+
+    def reader(info, lower_left, ncols, nrows):
+        # upper left corner of the window
+        block_x_min = lower_left[0] - info.x_cellsize / 2
+        block_y_max = lower_left[1] + (nrows - 0.5) * info.y_cellsize
+        array = lower_cache.read_window(
+            lower_info, block_x_min, block_y_max,
+            (block_x_min + lower_info.x_cellsize / 2,
+             block_y_max - (2 * nrows - 0.5) * lower_info.y_cellsize),
+            2 * ncols, 2 * nrows)
+        return max_overview(array)
+
+    return reader
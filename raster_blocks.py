@@ -0,0 +1,503 @@
+########################################################################
+# TTools
+# Raster block sampling helpers for Steps 3, 4 and 5
+
+# window_minimum() finds the lowest value in the (2 * searchCells + 1)
+# square window around every node of a block array at once. Nodata
+# cells are skipped unless the whole window is nodata, the same as the
+# Python loop over cellcoords in Step 3. Few nodes on a large window
+# gather their window cells with fancy indexing; otherwise a sliding
+# minimum is run along the rows and then the columns of the whole array
+# (minimum is separable) with windows built up by doubling, so the cost
+# grows with log(searchCells) instead of searchCells squared.
+
+# plan_blocks() and boxes_in_blocks() assign nodes (or the bounding
+# boxes of the Step 4 topo lines) to the block grid of create_block_list()
+# with a floor divide of the coordinates and one sort instead of testing
+# every node against every block. Blocks include their edges so a node on
+# an edge is in both blocks, the same as the loops they replace.
+
+# plan_topo_blocks() clips the Step 4 topo lines to the blocks they
+# cross. The lines are paired with blocks by their bounding boxes and
+# segment_intersections() tests every pair against the four block edges
+# at once with the same arithmetic as the old find_intersection() loop,
+# so the start and end distances of each block segment are unchanged.
+# Each node is written after the last block with one of its lines (the
+# old loop wrote nodes on a block edge twice or not at all).
+
+# topo_angles() samples every Step 4 topo line of a block at once. The
+# sample distances of all the lines (from start to end by cellsize, the
+# values of np.arange) are built as one padded 2D array, the elevations
+# are gathered with one fancy index and the max angle, its distance and
+# the off raster samples are reduced along each line. Lines are sorted
+# by length and run in chunks of CHUNK_CELLS samples. topo_line_ends()
+# gives the first and last sample of each line so a block only reads the
+# raster tiles its lines cross.
+
+# RasterInfo holds the cell size, extent, size in cells, nodata value,
+# pixel type and z units conversion of a raster. describe_raster() reads
+# them once per raster per run so the block loops do not run
+# GetRasterProperties (a geoprocessing tool) six times for every block.
+# describe_raster() is the only function in this module that needs arcpy.
+
+########################################################################
+
+from __future__ import division, print_function
+from math import ceil, sin, cos, radians
+import numpy as np
+
+# maximum number of window cells (or topo line samples) gathered at once
+CHUNK_CELLS = 4000000
+
+
+class RasterInfo(object):
+    """Properties of a raster used to read and sample its block arrays.
+    con_to_m converts the raster values to meters (None = no conversion)."""
+
+    def __init__(self, raster, x_cellsize, y_cellsize, x_min, y_min,
+                 x_max, y_max, nodata=None, pixel_type=None, con_to_m=None):
+        self.raster = raster
+        self.x_cellsize = float(x_cellsize)
+        self.y_cellsize = float(y_cellsize)
+        self.x_min = float(x_min)
+        self.y_min = float(y_min)
+        self.x_max = float(x_max)
+        self.y_max = float(y_max)
+        self.nodata = nodata
+        self.pixel_type = pixel_type
+        self.ncols = int(round((self.x_max - self.x_min) / self.x_cellsize))
+        self.nrows = int(round((self.y_max - self.y_min) / self.y_cellsize))
+        self.con_to_m = con_to_m
+
+        # value given to nodata cells so they are -9999 after to_meters()
+        if con_to_m is not None:
+            self.nodata_to_value = -9999 / con_to_m
+        else:
+            self.nodata_to_value = -9999
+
+    def block_window(self, block):
+        """Snaps a block extent (x min, y min, x max, y max) out to the
+        raster cell corners. Returns the block x min and y max, the lower
+        left cell center for RasterToNumPyArray and the number of cols
+        and rows."""
+        block_x_min, block_y_min, block_x_max, block_y_max = block
+
+        # offset from the raster cell corners
+        block_x_min = block_x_min - (block_x_min - self.x_min) % self.x_cellsize
+        block_y_min = block_y_min - (block_y_min - self.y_min) % self.y_cellsize
+        block_x_max = block_x_max + (self.x_max - block_x_max) % self.x_cellsize
+        block_y_max = block_y_max + (self.y_max - block_y_max) % self.y_cellsize
+
+        # RasterToNumPyArray defaults to the adjacent lower left cell
+        lower_left = (block_x_min + (self.x_cellsize / 2),
+                      block_y_min + (self.y_cellsize / 2))
+
+        ncols = max([int(ceil((block_x_max - block_x_min) / self.x_cellsize)), 1])
+        nrows = max([int(ceil((block_y_max - block_y_min) / self.y_cellsize)), 1])
+        return block_x_min, block_y_max, lower_left, ncols, nrows
+
+    def to_meters(self, array):
+        """Converts the array values to meters if needed"""
+        if self.con_to_m is not None:
+            return array * self.con_to_m
+        return array
+
+
+def describe_raster(raster, con_to_m=None):
+    """Reads the raster properties once and returns a RasterInfo"""
+    import arcpy
+    r = arcpy.Raster(raster)
+    extent = r.extent
+    return RasterInfo(raster, r.meanCellWidth, r.meanCellHeight,
+                      extent.XMin, extent.YMin, extent.XMax, extent.YMax,
+                      r.noDataValue, r.pixelType, con_to_m)
+
+
+def array_row_col(x, y, block_x_min, block_y_max, x_cellsize, y_cellsize):
+    """Vectorized coord_to_array(). Returns the row and col arrays of
+    the x/y coordinates in a block array"""
+    col = ((np.asarray(x, dtype=float) - block_x_min) / x_cellsize).astype(np.int64)
+    row = ((np.asarray(y, dtype=float) - block_y_max) / y_cellsize * -1).astype(np.int64)
+    return row, col
+
+
+def sliding_minimum(array, size, axis):
+    """Minimum of the size (odd) cells centered on each cell along an
+    axis. Windows are clipped at the edges of the array."""
+    half = size // 2
+    pad = [(0, 0)] * array.ndim
+    pad[axis] = (half, half)
+    m = np.pad(array.astype(float), pad, mode="constant",
+               constant_values=np.inf)
+    n = array.shape[axis]
+
+    # m[i] = min of the 2 ** k cells starting at i
+    length = 1
+    while length * 2 <= size:
+        m = np.minimum(m.take(np.arange(m.shape[axis] - length), axis=axis),
+                       m.take(np.arange(length, m.shape[axis]), axis=axis))
+        length *= 2
+    # two overlapping windows of length cover the size cells
+    return np.minimum(m.take(np.arange(n), axis=axis),
+                      m.take(np.arange(size - length, size - length + n), axis=axis))
+
+
+def window_minimum(array, rows, cols, searchCells, nodata=-9999):
+    """Returns the lowest value in the window of searchCells around each
+    row/col of a 2D array. Values at or below nodata are skipped unless
+    the whole window is nodata."""
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    size = 2 * searchCells + 1
+    n = len(rows)
+    if n == 0:
+        return np.zeros(0)
+
+    valid = array > nodata
+    if n * size * size <= array.size:
+        # gather the window of each node
+        moves = np.arange(-searchCells, searchCells + 1)
+        d_row = np.repeat(moves, size)
+        d_col = np.tile(moves, size)
+        z_min = np.empty(n)
+        step = max(1, CHUNK_CELLS // (size * size))
+        for s in range(0, n, step):
+            r = rows[s:s + step, np.newaxis] + d_row
+            c = cols[s:s + step, np.newaxis] + d_col
+            window = array[r, c]
+            masked = np.where(valid[r, c], window, np.inf).min(axis=1)
+            z_min[s:s + step] = np.where(np.isinf(masked), window.min(axis=1), masked)
+        return z_min
+
+    masked = np.where(valid, array, np.inf)
+    masked = sliding_minimum(sliding_minimum(masked, size, 0), size, 1)
+    z_min = masked[rows, cols]
+    nodata_only = np.isinf(z_min)
+    if nodata_only.any():
+        raw = sliding_minimum(sliding_minimum(array, size, 0), size, 1)
+        z_min[nodata_only] = raw[rows[nodata_only], cols[nodata_only]]
+    return z_min
+
+
+def block_grid(x_min, y_min, x_max, y_max, block_size):
+    """Returns the lower and upper coordinates of the blocks along x and
+    along y, ((x_lo, x_hi), (y_lo, y_hi)). These are the blocks of the
+    for x/for y loops in create_block_list(), numbered x then y."""
+    def axis(v_min, v_max):
+        width = int(v_max - v_min + 1)
+        lo = np.minimum(v_min + np.arange(0, width, block_size), v_max)
+        hi = np.minimum(lo + block_size, v_max)
+        return lo, hi
+    return axis(x_min, x_max), axis(y_min, y_max)
+
+
+def _axis_pairs(v_lo, v_hi, lo, hi, block_size):
+    """Returns the box and block index pairs along one axis for every
+    block overlapping each box [v_lo, v_hi]"""
+    n = len(lo)
+    first = np.clip(np.floor((v_lo - lo[0]) / block_size).astype(np.int64) - 1, 0, n - 1)
+    last = np.clip(np.floor((v_hi - lo[0]) / block_size).astype(np.int64) + 1, 0, n - 1)
+    count = last - first + 1
+    box = np.repeat(np.arange(len(v_lo)), count)
+    k = np.repeat(first, count) + (np.arange(count.sum()) -
+                                   np.repeat(np.cumsum(count) - count, count))
+    keep = (lo[k] <= v_hi[box]) & (v_lo[box] <= hi[k])
+    return box[keep], k[keep]
+
+
+def boxes_in_blocks(box_x_min, box_y_min, box_x_max, box_y_max, grid,
+                    block_size):
+    """Finds the blocks of block_grid() each box overlaps. Returns the
+    block numbers (x index * number of y blocks + y index) with at least
+    one box, in order, and the box index array of each of those blocks,
+    in box order."""
+    (x_lo, x_hi), (y_lo, y_hi) = grid
+    box_x_min = np.asarray(box_x_min, dtype=float)
+    box_y_min = np.asarray(box_y_min, dtype=float)
+    bx, kx = _axis_pairs(box_x_min, np.asarray(box_x_max, dtype=float),
+                         x_lo, x_hi, block_size)
+    by, ky = _axis_pairs(box_y_min, np.asarray(box_y_max, dtype=float),
+                         y_lo, y_hi, block_size)
+
+    # every x block of a box with every y block of the box
+    cy = np.bincount(by, minlength=len(box_x_min))
+    y_start = np.cumsum(cy) - cy
+    rep = cy[bx]
+    xi = np.repeat(np.arange(len(bx)), rep)
+    box = bx[xi]
+    yi = y_start[box] + np.arange(len(xi)) - np.repeat(np.cumsum(rep) - rep, rep)
+    block = kx[xi] * len(y_lo) + ky[yi]
+
+    order = np.lexsort((box, block))
+    block = block[order]
+    box = box[order]
+    blocks, start = np.unique(block, return_index=True)
+    return blocks, np.split(box, start[1:])
+
+
+def segment_intersections(a_x, a_y, b_x, b_y, c_x, c_y, d_x, d_y):
+    """Vectorized find_intersection(a, b, c, d, check_collinear=True)
+    from Step 4 for segments a-b and c-d (arrays of the same length).
+    Returns the mask of the segments that intersect and the x/y of the
+    (first) intersection, with the same arithmetic as the loop."""
+    Dx_Cx = d_x - c_x
+    Ay_Cy = a_y - c_y
+    Dy_Cy = d_y - c_y
+    Ax_Cx = a_x - c_x
+    Bx_Ax = b_x - a_x
+    By_Ay = b_y - a_y
+
+    numerator_a = Dx_Cx * Ay_Cy - Dy_Cy * Ax_Cx
+    numerator_b = Bx_Ax * Ay_Cy - By_Ay * Ax_Cx
+    denominator = Dy_Cy * Bx_Ax - Dx_Cx * By_Ay
+
+    # collinear segments that overlap or touch
+    collinear = (numerator_a == 0) & (numerator_b == 0) & (denominator == 0)
+    overlap = (((c_x - b_x < 0) != (d_x - a_x < 0)) |
+               ((c_y - b_y < 0) != (d_y - a_y < 0)) |
+               ((a_x == d_x) & (a_y == d_y)) | ((b_x == c_x) & (b_y == c_y)))
+    overlap &= collinear
+    x = np.zeros(len(overlap))
+    y = np.zeros(len(overlap))
+    if overlap.any():
+        i = np.nonzero(overlap)[0]
+        x[i] = np.sort([a_x[i], b_x[i], c_x[i], d_x[i]], axis=0)[1]
+        y[i] = np.sort([a_y[i], b_y[i], c_y[i], d_y[i]], axis=0)[1]
+
+    # segments that cross
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u_a = numerator_a / denominator
+        u_b = numerator_b / denominator
+        x = np.where(denominator != 0, a_x + Bx_Ax * u_a, x)
+        y = np.where(denominator != 0, c_y + Dy_Cy * u_b, y)
+    cross = (~collinear & (denominator != 0) & (u_a >= 0) & (u_a <= 1) &
+             (u_b >= 0) & (u_b <= 1))
+    return overlap | cross, x, y
+
+
+def plan_topo_blocks(topo_list, block_size, searchDistance_max):
+    """Vectorized create_blocks() block loops of Step 4. topo_list has
+    a row for each topo line (node ID, stream ID, azimuth, z node, node x,
+    node y, end x, end y). Returns, for each block with at least one topo
+    line in order, the block number, the extent (x min, y min, x max,
+    y max), the topo lines in the block (the topo_list row with the block
+    search start and end distances) and the node IDs that can be updated
+    after the block. Each node is updated once, after the last block
+    with one of its topo lines."""
+    if not topo_list:
+        return []
+    azimuth, node_x, node_y, end_x, end_y = [
+        np.array([row[k] for row in topo_list], dtype=float) for k in [2, 4, 5, 6, 7]]
+    x_min, x_max = end_x.min(), end_x.max()
+    y_min, y_max = end_y.min(), end_y.max()
+
+    # same sin/cos as the loop
+    sin_a = dict((a, sin(radians(a))) for a in set(azimuth.tolist()))
+    cos_a = dict((a, cos(radians(a))) for a in set(azimuth.tolist()))
+    sin_a = np.array([sin_a[a] for a in azimuth.tolist()])
+    cos_a = np.array([cos_a[a] for a in azimuth.tolist()])
+
+    # Find the blocks each topo line can be in from the bounding box
+    # of the line. The boxes are padded a little so intersections at
+    # the block edges are never missed.
+    pad = 1e-6 * max(1.0, abs(x_max), abs(y_max))
+    grid = block_grid(x_min, y_min, x_max, y_max, block_size)
+    blocks, members = boxes_in_blocks(
+        np.minimum(node_x, end_x) - pad, np.minimum(node_y, end_y) - pad,
+        np.maximum(node_x, end_x) + pad, np.maximum(node_y, end_y) + pad,
+        grid, block_size)
+    if len(blocks) == 0:
+        return []
+
+    # every candidate topo line of every block, in block order
+    (x_lo, x_hi), (y_lo, y_hi) = grid
+    count = np.array([len(m) for m in members])
+    block = np.repeat(blocks, count)
+    t = np.concatenate(members)
+    b_x_min = x_lo[block // len(y_lo)]
+    b_x_max = x_hi[block // len(y_lo)]
+    b_y_min = y_lo[block % len(y_lo)]
+    b_y_max = y_hi[block % len(y_lo)]
+    n_x, n_y, e_x, e_y = node_x[t], node_y[t], end_x[t], end_y[t]
+
+    contains_node = ((b_x_min <= n_x) & (n_x <= b_x_max) &
+                     (b_y_min <= n_y) & (n_y <= b_y_max))
+    contains_end = ((b_x_min <= e_x) & (e_x <= b_x_max) &
+                    (b_y_min <= e_y) & (e_y <= b_y_max))
+
+    # distance from the node to where the topo line crosses each
+    # block edge (left, bottom, right, top)
+    use_y = (azimuth[t] == 0) | (azimuth[t] == 180)
+    n_cross = np.zeros(len(t), dtype=np.int64)
+    d_min = np.full(len(t), np.inf)
+    d_max = np.full(len(t), -np.inf)
+    for (a_x, a_y), (b_x, b_y) in [((b_x_min, b_y_max), (b_x_min, b_y_min)),
+                                   ((b_x_min, b_y_min), (b_x_max, b_y_min)),
+                                   ((b_x_max, b_y_min), (b_x_max, b_y_max)),
+                                   ((b_x_max, b_y_max), (b_x_min, b_y_max))]:
+        hit, i_x, i_y = segment_intersections(a_x, a_y, b_x, b_y,
+                                              n_x, n_y, e_x, e_y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d = np.where(use_y, (i_y - n_y) / cos_a[t], (i_x - n_x) / sin_a[t])
+        n_cross += hit
+        d_min = np.where(hit, np.minimum(d_min, d), d_min)
+        d_max = np.where(hit, np.maximum(d_max, d), d_max)
+
+    # the cases of the create_blocks() loop
+    both = contains_node & contains_end
+    one = (~both & (n_cross == 1) & (0 < d_min) & (d_min < searchDistance_max) &
+           (contains_node | contains_end))
+    many = ~both & ~one & (n_cross > 1)
+    in_block = both | one | many
+    start = np.where(both | (one & contains_node), 0, d_min)
+    end = np.where(both | (one & ~contains_node), searchDistance_max, d_max)
+
+    # nodes updated after the last block (in order) with one of their
+    # topo lines, so a node on a block edge is only written once. The
+    # pairs are in block order.
+    node = np.unique(np.array([row[0] for row in topo_list]),
+                     return_inverse=True)[1]
+    pairs = np.nonzero(in_block)[0]
+    pairs = pairs[np.lexsort((pairs, node[t[pairs]]))]
+    last_pair = np.append(node[t[pairs]][1:] != node[t[pairs]][:-1], True)
+    update = np.zeros(len(t), dtype=bool)
+    update[pairs[last_pair]] = True
+
+    plan = []
+    bounds = (np.cumsum(count) - count).tolist()
+    for k, b in enumerate(blocks.tolist()):
+        s, e = bounds[k], bounds[k] + count[k]
+        keep = np.nonzero(in_block[s:e])[0] + s
+        if len(keep) == 0:
+            continue
+        lines = [topo_list[i] + [d0, d1] for i, d0, d1 in
+                 zip(t[keep].tolist(), start[keep].tolist(), end[keep].tolist())]
+        extent = (float(b_x_min[s]), float(b_y_min[s]),
+                  float(b_x_max[s]), float(b_y_max[s]))
+        nodes_to_update = [topo_list[i][0] for i in t[s:e][update[s:e]].tolist()]
+        plan.append((b, extent, lines, nodes_to_update))
+    return plan
+
+
+def plan_blocks(x, y, block_size):
+    """Vectorized create_block_list(). Groups the points into the blocks
+    of block_size map units covering them. Returns the extent of the
+    points in each block (x min, y min, x max, y max, without a buffer)
+    and the point index array of each block."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) == 0:
+        return [], []
+    grid = block_grid(x.min(), y.min(), x.max(), y.max(), block_size)
+    blocks, members = boxes_in_blocks(x, y, x, y, grid, block_size)
+    extents = [(float(x[m].min()), float(y[m].min()),
+                float(x[m].max()), float(y[m].max())) for m in members]
+    return extents, members
+
+
+def _search_count(start, end, cellsize):
+    """Returns the first distance (the next cell over if start is 0)
+    and the number of distances from there to end by cellsize of each
+    topo line, at least one"""
+    # use next cell over to avoid divide by zero errors
+    start = np.where(start <= 0, cellsize, start)
+    count = np.ones(len(start), dtype=np.int64)
+    long_lines = end - start >= cellsize
+    count[long_lines] = np.ceil((end[long_lines] - start[long_lines]) /
+                                cellsize[long_lines]).astype(np.int64)
+    return start, count
+
+
+def search_distances(start, end, cellsize):
+    """Returns the sample distances of each topo line from start up to
+    end by cellsize (the values of np.arange, or only the first
+    distance if the line is shorter than cellsize) as rows of a 2D
+    array padded with nan and the number of distances of each line."""
+    cellsize = np.asarray(cellsize, dtype=float)
+    start, count = _search_count(np.asarray(start, dtype=float),
+                                 np.asarray(end, dtype=float), cellsize)
+
+    # np.arange fills start + i * ((start + step) - start)
+    k = np.arange(count.max() if len(count) else 0)
+    delta = (start + cellsize) - start
+    distance = start[:, np.newaxis] + k * delta[:, np.newaxis]
+    if len(k) > 1:
+        distance[:, 1] = start + cellsize
+    distance[k >= count[:, np.newaxis]] = np.nan
+    return distance, count
+
+
+def topo_line_ends(node_x, node_y, sin_a, cos_a, start, end, cellsize):
+    """Returns the x/y of the first and last samples of each topo line
+    of topo_angles(), (x0, y0, x1, y1)"""
+    sin_a = np.asarray(sin_a, dtype=float)
+    cos_a = np.asarray(cos_a, dtype=float)
+    cellsize = np.asarray(cellsize, dtype=float)
+    first, count = _search_count(np.asarray(start, dtype=float),
+                                 np.asarray(end, dtype=float), cellsize)
+    last = first + (count - 1) * cellsize
+    node_x = np.asarray(node_x, dtype=float)
+    node_y = np.asarray(node_y, dtype=float)
+    return (node_x + first * sin_a, node_y + first * cos_a,
+            node_x + last * sin_a, node_y + last * cos_a)
+
+
+def topo_angles(z_array, block_x_min, block_y_max, x_cellsize, y_cellsize,
+                node_x, node_y, z_node, sin_a, cos_a, start, end, cellsize,
+                con_to_m):
+    """Samples the topo lines of a block starting at the nodes in the
+    direction sin_a/cos_a from start to end by cellsize. Returns the max
+    topo angle, the distance to it (units of the fc), the elevation there
+    and the number of off raster samples (< -9998) of each line."""
+    node_x = np.asarray(node_x, dtype=float)
+    node_y = np.asarray(node_y, dtype=float)
+    sin_a = np.asarray(sin_a, dtype=float)
+    cos_a = np.asarray(cos_a, dtype=float)
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    cellsize = np.asarray(cellsize, dtype=float)
+    # same type as the elevation array minus a node elevation
+    z_node = np.asarray(z_node, dtype=float).astype(np.result_type(z_array.dtype, 0.0))
+
+    n = len(node_x)
+    topoAngle = np.empty(n)
+    distance_max = np.empty(n)
+    z_topo = np.empty(n, dtype=z_array.dtype)
+    off_raster = np.empty(n, dtype=np.int64)
+
+    # lines of about the same length in each chunk
+    count = _search_count(start, end, cellsize)[1]
+    order = np.argsort(count, kind="mergesort")
+    sorted_count = count[order]
+    s = 0
+    while s < n:
+        # a chunk is padded to its last (longest) line
+        samples = np.arange(1, n - s + 1) * sorted_count[s:]
+        e = s + max(1, np.searchsorted(samples, CHUNK_CELLS, side="right"))
+        i = order[s:e]
+        distance = search_distances(start[i], end[i], cellsize[i])[0]
+        padded = np.isnan(distance)
+        distance[padded] = np.repeat(distance[:, 0], padded.sum(axis=1))
+
+        pt_x = (distance * sin_a[i, np.newaxis]) + node_x[i, np.newaxis]
+        pt_y = (distance * cos_a[i, np.newaxis]) + node_y[i, np.newaxis]
+        rows, cols = array_row_col(pt_x, pt_y, block_x_min, block_y_max,
+                                   x_cellsize, y_cellsize)
+        z = z_array[rows, cols]
+
+        angle = np.degrees(np.arctan((z - z_node[i, np.newaxis]) /
+                                     (distance * con_to_m)))
+        # remove the off raster samples
+        off = (z < -9998) & ~padded
+        angle[off] = -9999
+        angle[padded] = -np.inf
+
+        # first sample at the max angle
+        k = angle.argmax(axis=1)
+        line = np.arange(len(i))
+        topoAngle[i] = angle[line, k]
+        distance_max[i] = distance[line, k]
+        z_topo[i] = z[line, k]
+        off_raster[i] = off.sum(axis=1)
+        s = e
+    return topoAngle, distance_max, z_topo, off_raster
@@ -0,0 +1,287 @@
+#-------------------------------------------------------------------------------
+# Name:        raster_cache
+# Purpose:     On-disk tile cache of the rasters read by TTools Steps 3-5 so
+#              repeated runs on the same DEM/landcover do not read the raster
+#
+# Author:      George
+#
+# Created:     18/10/2026
+# Copyright:   (c) George 2017
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+# Steps 3, 4 and 5 read overlapping windows of the same rasters (Step 5
+# reads the elevation raster again for the ELE samples). The tile cache
+# splits a raster into tiles of tile_cells x tile_cells cells on the
+# raster's own cell grid, starting at the upper left corner. Each tile is
+# read once with RasterToNumPyArray and saved as an .npy file. Block
+# windows are put together from the tiles, opened as memory maps, and
+# cells outside the raster get the nodata value like RasterToNumPyArray.
+
+# Tiles are saved in a folder keyed by a hash of the raster path, its
+# modification time, the tile size, the cell grid and the nodata value,
+# so a changed raster is read again. The most recently used tiles are
+# kept open (up to max_entries). Folders not used for max_age_days are
+# deleted when the cache is created. Only the folders named by the cache
+# (a sha1 hex digest) are deleted, other files and folders in cache_dir
+# are left alone. With cache_dir=None the windows are read from the
+# raster directly.
+
+# A block read can be limited to a set of tiles, e.g. the tiles crossed
+# by the Step 4 topo lines from line_tiles(). The other cells of the
+# block get the nodata value and are not read, so the cost of a block
+# grows with the tiles the lines cross instead of the block area. The
+# tiles are read directly when there is no cache folder.
+
+from __future__ import division, print_function
+import os
+import time
+import shutil
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".shadealator_cache", "tiles")
+
+# tile width and height in cells
+TILE_CELLS = 1024
+
+
+def raster_mtime(raster):
+    """Returns the modification time of a raster or None if it is not on
+    disk. Rasters stored as a folder (ESRI grids) or inside a file
+    geodatabase use the newest file in the folder."""
+    path = os.path.abspath(raster)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    if os.path.isdir(path):
+        times = [os.path.getmtime(os.path.join(path, name))
+                 for name in os.listdir(path)]
+        return max(times + [os.path.getmtime(path)])
+    return os.path.getmtime(path)
+
+
+def is_tile_folder(name):
+    """True if name is the name of a raster folder of the tile cache"""
+    return len(name) == 40 and all(c in "0123456789abcdef" for c in name)
+
+
+def read_raster_window(info, lower_left, ncols, nrows):
+    """Reads a window of a raster with RasterToNumPyArray. lower_left is
+    the lower left cell center of the window."""
+    import arcpy
+    return arcpy.RasterToNumPyArray(info.raster, arcpy.Point(*lower_left),
+                                    ncols, nrows, info.nodata_to_value)
+
+
+def line_tiles(info, x0, y0, x1, y1, tile_cells=TILE_CELLS):
+    """Returns the tiles (tile row and col arrays) of a raster crossed
+    by the line segments from x0/y0 to x1/y1. Tiles within half a cell
+    of a segment are included."""
+    # segment ends in tile units of the raster rows and cols
+    u0 = (np.asarray(x0, dtype=float) - info.x_min) / info.x_cellsize / tile_cells
+    u1 = (np.asarray(x1, dtype=float) - info.x_min) / info.x_cellsize / tile_cells
+    v0 = (info.y_max - np.asarray(y0, dtype=float)) / info.y_cellsize / tile_cells
+    v1 = (info.y_max - np.asarray(y1, dtype=float)) / info.y_cellsize / tile_cells
+    eps = 0.5 / tile_cells
+
+    # every tile col of each segment
+    u_lo = np.minimum(u0, u1) - eps
+    u_hi = np.maximum(u0, u1) + eps
+    first = np.floor(u_lo).astype(np.int64)
+    count = np.floor(u_hi).astype(np.int64) - first + 1
+    seg = np.repeat(np.arange(len(u0)), count)
+    col = np.repeat(first, count) + (np.arange(count.sum()) -
+                                     np.repeat(np.cumsum(count) - count, count))
+
+    # the rows of the segment inside the tile col
+    du = u1[seg] - u0[seg]
+    flat = np.abs(du) < 1e-12
+    t_a = np.where(flat, 0.0, (np.maximum(col, u_lo[seg]) - u0[seg]) / np.where(flat, 1.0, du))
+    t_b = np.where(flat, 1.0, (np.minimum(col + 1, u_hi[seg]) - u0[seg]) / np.where(flat, 1.0, du))
+    t_a, t_b = np.clip(np.minimum(t_a, t_b), 0, 1), np.clip(np.maximum(t_a, t_b), 0, 1)
+    v_a = v0[seg] + t_a * (v1[seg] - v0[seg])
+    v_b = v0[seg] + t_b * (v1[seg] - v0[seg])
+    first = np.floor(np.minimum(v_a, v_b) - eps).astype(np.int64)
+    count = np.floor(np.maximum(v_a, v_b) + eps).astype(np.int64) - first + 1
+    row = np.repeat(first, count) + (np.arange(count.sum()) -
+                                     np.repeat(np.cumsum(count) - count, count))
+    col = np.repeat(col, count)
+
+    tiles = np.unique(row * 4294967296 + (col + 2147483648))
+    return tiles // 4294967296, tiles % 4294967296 - 2147483648
+
+
+class TileCache(object):
+    """Reads raster block windows through an on-disk tile cache. info
+    is a raster_blocks.RasterInfo. reader(info, lower_left, ncols, nrows)
+    reads a window from the raster."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, tile_cells=TILE_CELLS,
+                 max_entries=64, max_age_days=90, reader=read_raster_window):
+        self.cache_dir = cache_dir
+        self.tile_cells = tile_cells
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.reader = reader
+        self.folders = {}
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.reads = 0
+        self.cells_read = 0
+        self.bytes_read = 0
+        self.evict()
+
+    def raster_folder(self, info):
+        """Returns the tile folder of a raster, or None if it is not
+        cached. Found once per raster for the life of the cache."""
+        key = (info.raster, info.nodata_to_value)
+        if key not in self.folders:
+            mtime = raster_mtime(info.raster)
+            if not self.cache_dir or mtime is None:
+                self.folders[key] = None
+            else:
+                raster_key = (os.path.normcase(os.path.abspath(info.raster)),
+                              mtime, self.tile_cells, info.x_cellsize,
+                              info.y_cellsize, info.x_min, info.y_max,
+                              info.nodata_to_value)
+                folder = os.path.join(self.cache_dir, hashlib.sha1(
+                    repr(raster_key).encode("utf-8")).hexdigest())
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+                # touch so unused folders are evicted
+                os.utime(folder, None)
+                self.folders[key] = folder
+        return self.folders[key]
+
+    def read(self, info, lower_left, ncols, nrows):
+        """Reads a window from the raster"""
+        self.reads += 1
+        self.cells_read += ncols * nrows
+        array = self.reader(info, lower_left, ncols, nrows)
+        self.bytes_read += array.nbytes
+        return array
+
+    def tile(self, info, folder, row, col):
+        """Returns the tile at tile row/col, from memory, disk or the
+        raster"""
+        key = (folder, row, col)
+        if key in self.tiles:
+            self.hits += 1
+            tile = self.tiles.pop(key)
+            self.tiles[key] = tile
+            return tile
+
+        path = os.path.join(folder, "{0}_{1}.npy".format(row, col))
+        tile = None
+        if os.path.exists(path):
+            try:
+                tile = np.load(path, mmap_mode="r")
+                self.disk_hits += 1
+            except Exception:
+                # corrupt or partial file, read it again
+                tile = None
+
+        if tile is None:
+            r0 = row * self.tile_cells
+            c0 = col * self.tile_cells
+            nrows = min(self.tile_cells, info.nrows - r0)
+            ncols = min(self.tile_cells, info.ncols - c0)
+            lower_left = (info.x_min + (c0 + 0.5) * info.x_cellsize,
+                          info.y_max - (r0 + nrows - 0.5) * info.y_cellsize)
+            tile = self.read(info, lower_left, ncols, nrows)
+            tmp_path = path + ".tmp.npy"
+            np.save(tmp_path, tile)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+
+        self.tiles[key] = tile
+        while len(self.tiles) > self.max_entries:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def read_window(self, info, block_x_min, block_y_max, lower_left,
+                    ncols, nrows, tiles=None):
+        """Returns the window of ncols x nrows cells with the upper left
+        corner at block_x_min, block_y_max (on the raster cell corners),
+        the same as RasterToNumPyArray at lower_left. tiles is an
+        optional (tile row, tile col) pair of arrays of the only tiles
+        to read."""
+        folder = self.raster_folder(info)
+        if folder is None and tiles is None:
+            return self.read(info, lower_left, ncols, nrows)
+        if tiles is not None:
+            tiles = set(zip(np.asarray(tiles[0]).tolist(),
+                            np.asarray(tiles[1]).tolist()))
+
+        # window position in raster rows and cols
+        row0 = int(round((info.y_max - block_y_max) / info.y_cellsize))
+        col0 = int(round((block_x_min - info.x_min) / info.x_cellsize))
+        r_lo, r_hi = max(row0, 0), min(row0 + nrows, info.nrows)
+        c_lo, c_hi = max(col0, 0), min(col0 + ncols, info.ncols)
+
+        array = None
+        size = self.tile_cells
+        if r_lo < r_hi and c_lo < c_hi:
+            for row in range(r_lo // size, (r_hi - 1) // size + 1):
+                for col in range(c_lo // size, (c_hi - 1) // size + 1):
+                    if tiles is not None and (row, col) not in tiles:
+                        continue
+                    # overlap of the tile and the window
+                    a = max(r_lo, row * size)
+                    b = min(r_hi, (row + 1) * size, info.nrows)
+                    c = max(c_lo, col * size)
+                    d = min(c_hi, (col + 1) * size, info.ncols)
+                    if folder is None:
+                        data = self.read(info, (info.x_min + (c + 0.5) * info.x_cellsize,
+                                                info.y_max - (b - 0.5) * info.y_cellsize),
+                                         d - c, b - a)
+                    else:
+                        tile = self.tile(info, folder, row, col)
+                        data = tile[a - row * size:b - row * size, c - col * size:d - col * size]
+                    if array is None:
+                        array = np.empty((nrows, ncols), dtype=data.dtype)
+                        array.fill(info.nodata_to_value)
+                    array[a - row0:b - row0, c - col0:d - col0] = data
+        if array is None:
+            # all outside the raster or the tiles
+            array = np.empty((nrows, ncols))
+            array.fill(info.nodata_to_value)
+        return array
+
+    def read_block(self, info, block, tiles=None):
+        """Reads the raster array of a block extent snapped to the cell
+        corners with the values in meters (only the tiles if given).
+        Returns the array and the block x min and y max."""
+        (block_x_min, block_y_max, lower_left,
+         ncols, nrows) = info.block_window(block)
+        array = self.read_window(info, block_x_min, block_y_max,
+                                 lower_left, ncols, nrows, tiles)
+        return info.to_meters(array), block_x_min, block_y_max
+
+    def evict(self):
+        """Deletes the raster folders not used for max_age_days"""
+        if (not self.cache_dir or self.max_age_days is None or
+                not os.path.exists(self.cache_dir)):
+            return
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if (is_tile_folder(name) and os.path.isdir(path) and
+                    now - os.path.getmtime(path) > self.max_age_days * 86400):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def clear(self):
+        """Empties the memory and disk caches (only the raster folders)"""
+        self.tiles.clear()
+        self.folders.clear()
+        if self.cache_dir and os.path.exists(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if is_tile_folder(name) and os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
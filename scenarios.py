@@ -0,0 +1,266 @@
+#-------------------------------------------------------------------------------
+# Name:        scenarios
+# Purpose:     Declarative vegetation scenarios for Step 6 and a batch runner
+#              that evaluates many scenarios on one node table
+#
+# Author:      George
+#
+# Created:     18/10/2026
+# Copyright:   (c) George 2017
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+# A scenario is a list of VegRules. Each rule changes the landcover
+# codes of some transect samples on one or both banks the same way
+# addLC() did in the old addVeg scripts: codes below threshold are raised
+# to floor (planted vegetation, taller existing codes are kept) and codes
+# are capped at cap. The
+# scenario inputs share every unchanged array with the base node table
+# so N scenarios only copy the landcover columns they modify.
+
+# Scenario files are JSON, for example:
+# [{"name": "plant_left",
+#   "rules": [{"bank": "Left", "samples": [1, 2], "height": 10}]},
+#  {"name": "wide", "widthFactor": 1.2}]
+
+from __future__ import division, print_function
+import csv
+import json
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from collections import OrderedDict
+import numpy as np
+
+import node_table
+import shade_engine
+
+BANK_FIELDS = {"Left": shade_engine.LC_FIELDS_LEFT,
+               "Right": shade_engine.LC_FIELDS_RIGHT,
+               "Both": shade_engine.LC_FIELDS_LEFT + shade_engine.LC_FIELDS_RIGHT}
+
+# the addVeg scripts cap every landcover code at 5000
+LC_CAP = 5000
+
+
+class VegRule(object):
+    """Changes the landcover codes of transect samples on a bank.
+    bank is "Left" (T1), "Right" (T2) or "Both", samples are the sample
+    numbers 1-9. height (m) sets floor to the veg code of that height."""
+
+    def __init__(self, bank="Both", samples=(1,), threshold=500, floor=1000,
+                 cap=LC_CAP, height=None):
+        if bank not in BANK_FIELDS:
+            raise ValueError("bank must be Left, Right or Both: {0}".format(bank))
+        if height is not None:
+            # veg codes are the height in cm
+            floor = float(height) * 100
+        self.bank = bank
+        self.samples = [int(s) for s in samples]
+        self.threshold = float(threshold)
+        self.floor = float(floor)
+        self.cap = float(cap)
+
+    def fields(self):
+        return [f for f in BANK_FIELDS[self.bank]
+                if int(f.split("_S")[1]) in self.samples]
+
+    def modify(self, values):
+        """Returns the raw landcover codes after the rule (before the +1
+        offset for the Shade-a-lator)"""
+        values = np.where(values < self.threshold,
+                          np.maximum(values, self.floor), values)
+        return np.minimum(values, self.cap)
+
+    def to_dict(self):
+        return {"bank": self.bank, "samples": self.samples,
+                "threshold": self.threshold, "floor": self.floor,
+                "cap": self.cap}
+
+
+class Scenario(object):
+    """A named list of VegRules. widthFactor scales CHANWIDTH."""
+
+    def __init__(self, name, rules=(), widthFactor=1.0):
+        self.name = name
+        self.rules = list(rules)
+        self.widthFactor = float(widthFactor)
+
+    def fields(self):
+        ans = []
+        for rule in self.rules:
+            ans.extend(f for f in rule.fields() if f not in ans)
+        return ans
+
+    def to_dict(self):
+        return {"name": self.name,
+                "rules": [r.to_dict() for r in self.rules],
+                "widthFactor": self.widthFactor}
+
+
+def scenario_from_dict(d):
+    rules = [VegRule(**r) for r in d.get("rules", [])]
+    return Scenario(d["name"], rules, d.get("widthFactor", 1.0))
+
+
+def load_scenarios(filename):
+    """Reads a list of scenarios from a JSON file"""
+    with open(filename) as f:
+        return [scenario_from_dict(d) for d in json.load(f)]
+
+
+# the old Step6_Interact_with_Shade_addVeg* scripts
+PRESETS = OrderedDict([
+    ("existing", Scenario("existing")),
+    ("addVeg", Scenario("addVeg", [VegRule("Both", [1])])),
+    ("addVegLeftBank", Scenario("addVegLeftBank", [VegRule("Left", [1])])),
+    ("addVegRightBank", Scenario("addVegRightBank", [VegRule("Right", [1])]))])
+
+
+def base_inputs(table):
+    """Returns the shade engine inputs for the unmodified node table with
+    the addVeg script fixes (negative values set to 0, landcover capped
+    at 5000 and offset by 1)"""
+    inputs = {}
+    for f in shade_engine.NODE_FIELDS:
+        if f in ["ELEVATION", "TOPO_W", "TOPO_S", "TOPO_E"]:
+            inputs[f] = node_table.set_to_zero(table[f])
+        elif f in BANK_FIELDS["Both"]:
+            inputs[f] = node_table.offset_by_1(table[f], cap=LC_CAP, as_int=False)
+        else:
+            inputs[f] = node_table.as_float(table[f])
+    return inputs
+
+
+def scenario_inputs(table, scenario, base=None):
+    """Returns the shade engine inputs for a scenario. Arrays the scenario
+    does not change are shared with base (from base_inputs())."""
+    if base is None:
+        base = base_inputs(table)
+    inputs = dict(base)
+    for f in scenario.fields():
+        values = node_table.as_float(table[f])
+        for rule in scenario.rules:
+            if f in rule.fields():
+                values = rule.modify(values)
+        inputs[f] = node_table.offset_by_1(values, cap=LC_CAP, as_int=False)
+    if scenario.widthFactor != 1.0:
+        inputs["CHANWIDTH"] = base["CHANWIDTH"] * scenario.widthFactor
+    return inputs
+
+
+def run_batch(table, scenarios, startDate, numberDays, lat, longi, timeZone,
+              daylightSavings, globalRiparianZoneWidth, cloudCover=0,
+              brasVisibilityFactor=2, ryanStolzenbachFactor=0.8,
+              elevationOrZone="Elevation", riparianExtinction="On",
+              solarModel="Bras", channelIncision=1.0, timeStep=60, cache=None):
+    """Calculates effective shade for every scenario on one node table.
+    The solar position and base inputs are computed once.
+    Returns an OrderedDict of scenario name to (node,) shade arrays."""
+    import solar_cache
+    if cache is None:
+        cache = solar_cache.get_default_cache()
+    sun = cache.get(lat, longi, timeZone, daylightSavings, startDate,
+                    numberDays, timeStep)
+    base = base_inputs(table)
+
+    results = OrderedDict()
+    for scenario in scenarios:
+        inputs = scenario_inputs(table, scenario, base)
+        r = shade_engine.shade_from_sun(inputs, sun.times, sun.altitude,
+                                        sun.azimuth, globalRiparianZoneWidth,
+                                        cloudCover, brasVisibilityFactor,
+                                        ryanStolzenbachFactor, elevationOrZone,
+                                        riparianExtinction, solarModel,
+                                        channelIncision)
+        results[scenario.name] = r["SHADE"]
+    return results
+
+
+# run_batch_parallel() splits the (scenario, node range) tasks over a
+# process pool. The base inputs and the raw landcover columns are copied
+# once into shared memory (RawArray, read only in the workers) when the
+# pool starts so the tasks only pickle a scenario and a node range.
+
+_worker = {}
+
+
+def share_arrays(arrays):
+    """Copies a dictionary of 1D float arrays into shared memory"""
+    shared = {}
+    for f, values in arrays.items():
+        values = np.asarray(values, dtype=float)
+        shared[f] = RawArray("d", len(values))
+        np.frombuffer(shared[f], dtype=float)[:] = values
+    return shared
+
+
+def _init_worker(base, raw, sun, settings):
+    _worker["base"] = dict((f, np.frombuffer(v, dtype=float))
+                           for f, v in base.items())
+    _worker["raw"] = dict((f, np.frombuffer(v, dtype=float))
+                          for f, v in raw.items())
+    _worker["sun"] = sun
+    _worker["settings"] = settings
+
+
+def _run_task(task):
+    scenarioDict, start, stop = task
+    scenario = scenario_from_dict(scenarioDict)
+    base = dict((f, v[start:stop]) for f, v in _worker["base"].items())
+    table = dict((f, v[start:stop]) for f, v in _worker["raw"].items())
+    inputs = scenario_inputs(table, scenario, base)
+    times, altitude, azimuth = _worker["sun"]
+    r = shade_engine.shade_from_sun(inputs, times, altitude, azimuth,
+                                    *_worker["settings"])
+    return scenario.name, start, r["SHADE"]
+
+
+def run_batch_parallel(table, scenarios, startDate, numberDays, lat, longi,
+                       timeZone, daylightSavings, globalRiparianZoneWidth,
+                       cloudCover=0, brasVisibilityFactor=2,
+                       ryanStolzenbachFactor=0.8, elevationOrZone="Elevation",
+                       riparianExtinction="On", solarModel="Bras",
+                       channelIncision=1.0, timeStep=60, cache=None,
+                       processes=None, chunkSize=5000):
+    """Same as run_batch() using a multiprocessing pool. Every scenario is
+    split into node ranges of chunkSize nodes. processes defaults to the
+    number of cores. Scenario names must be unique."""
+    import solar_cache
+    if cache is None:
+        cache = solar_cache.get_default_cache()
+    sun = cache.get(lat, longi, timeZone, daylightSavings, startDate,
+                    numberDays, timeStep)
+    settings = (globalRiparianZoneWidth, cloudCover, brasVisibilityFactor,
+                ryanStolzenbachFactor, elevationOrZone, riparianExtinction,
+                solarModel, channelIncision)
+
+    base = share_arrays(base_inputs(table))
+    raw = share_arrays(dict((f, node_table.as_float(table[f]))
+                            for f in BANK_FIELDS["Both"]))
+    n_nodes = len(table["ELEVATION"])
+    tasks = [(scenario.to_dict(), start, min(start + chunkSize, n_nodes))
+             for scenario in scenarios
+             for start in range(0, n_nodes, chunkSize)]
+
+    results = OrderedDict((scenario.name, np.zeros(n_nodes))
+                          for scenario in scenarios)
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (base, raw, (sun.times, sun.altitude,
+                                             sun.azimuth), settings))
+    try:
+        for name, start, shade in pool.imap_unordered(_run_task, tasks):
+            results[name][start:start + len(shade)] = shade
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def write_results(filename, nodeIds, results):
+    """Writes one row per scenario and NODE_ID to a csv file"""
+    with open(filename, "w") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["SCENARIO", "NODE_ID", "SHADE"])
+        for name, shade in results.items():
+            for nodeId, value in zip(nodeIds, shade):
+                writer.writerow([name, nodeId, float(value)])
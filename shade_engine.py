@@ -0,0 +1,693 @@
+#-------------------------------------------------------------------------------
+# Name:        shade_engine
+# Purpose:     Native NumPy version of the Shade-a-lator calculations so Step 6
+#              can compute effective shade without the Excel macro round-trip
+#
+# Author:      George
+#
+# Created:     18/10/2026
+# Copyright:   (c) George 2017
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+# The inputs are the same node attributes Step 6 writes to the
+# "Main Menu" sheet of shade_GD.xlsm (after setToZero/offsetBy1 have been
+# applied) and the same run settings from cells D2:D11 and I3:I9.
+# Every node is evaluated at once as arrays of shape (nodes, time steps).
+
+# Notes on the method (Chen 1996, Boyd & Kasper 2003):
+# - solar position is the NOAA ephemeris evaluated at the middle of
+#   each time step in local clock time
+# - solar radiation above the topography uses the Bras or
+#   Ryan-Stolzenbach clear sky models reduced for cloud cover and split
+#   into direct and diffuse components
+# - direct beam is blocked when the sun is below the topographic angle
+#   (TOPO_E/S/W) in the direction of the sun
+# - direct beam reaching the water is attenuated by the riparian zones on
+#   the bank facing the sun. The ray is traced from points across the
+#   wetted width and each zone it passes through below the canopy top
+#   removes the zone density from the beam (riparian extinction On) or
+#   blocks it completely (riparian extinction Off). A zone whose ground
+#   is above the ray blocks it completely
+# - diffuse radiation is reduced by the topographic view to sky and the
+#   angle to the tallest canopy top, seen from the stream center at the
+#   inner edge of its zone
+# - effective shade = 1 - (radiation at the stream / radiation above the
+#   topography), summed over all time steps
+
+# The engine is EXPERIMENTAL and is not equivalent to the macro. The
+# macro's VBA is not in this repository. The vegetation density is the
+# Den. value the macro writes next to its zone heights in output.xlsx
+# (0.5 for every zone). The opaque ground and the diffuse view angle
+# were picked on the even NODE_IDs of the bundled output.xlsx/
+# output2.xlsx sample and checked on the odd NODE_IDs (335 nodes):
+# the engine is still low, mean difference -0.021, mean absolute error
+# 0.029, max 0.12 and correlation 0.977. The macro writes no zone values
+# for nodes with no landcover or elevation samples, so they are left
+# out of the comparison. MACRO_TOLERANCE is the equivalence bound and
+# check_against_macro() (python shade_engine.py) fails until the engine
+# is within it.
+
+from __future__ import division, print_function
+from datetime import datetime, timedelta
+import numpy as np
+
+# Step 6 writes 9 samples on each bank. T1 = left bank, T2 = right bank
+NUM_ZONES = 9
+LC_FIELDS_LEFT = ["LC_T1_S{0}".format(z) for z in range(1, NUM_ZONES + 1)]
+LC_FIELDS_RIGHT = ["LC_T2_S{0}".format(z) for z in range(1, NUM_ZONES + 1)]
+ELE_FIELDS_LEFT = ["ELE_T1_S{0}".format(z) for z in range(1, NUM_ZONES + 1)]
+ELE_FIELDS_RIGHT = ["ELE_T2_S{0}".format(z) for z in range(1, NUM_ZONES + 1)]
+
+NODE_FIELDS = (["ELEVATION", "STRM_AZMTH", "CHANWIDTH",
+                "TOPO_W", "TOPO_S", "TOPO_E"] +
+               LC_FIELDS_LEFT + LC_FIELDS_RIGHT +
+               ELE_FIELDS_LEFT + ELE_FIELDS_RIGHT)
+
+SOLAR_CONSTANT = 1367.0  # W/m2
+
+# Vegetation density used when the landcover codes are heights, the
+# macro's Den. for height codes in the bundled output.xlsx
+DEFAULT_VEG_DENSITY = 0.5
+
+# Largest differences from the macro for the engine to be equivalent
+MACRO_TOLERANCE = {"mean_abs_error": 0.01, "max_abs_error": 0.05,
+                   "mean_difference": 0.005, "correlation": 0.99}
+
+# Number of points across the wetted width the direct beam is traced from
+CHANNEL_SAMPLES = 10
+
+# Maximum number of (node, time, channel sample, zone) elements
+# evaluated at once. Keeps memory bounded on large networks.
+CHUNK_ELEMENTS = 4000000
+
+
+def str_to_bool(s):
+    if s in [True, 'True', 'true', 'Yes', 'yes', 'On', 'on']:
+        return True
+    else:
+        return False
+
+
+def parse_date(startDate):
+    """Returns a datetime from the mm/dd/yyyy start date used in the
+    Main Menu sheet"""
+    if isinstance(startDate, datetime):
+        return startDate
+    return datetime.strptime(str(startDate).strip(), "%m/%d/%Y")
+
+
+def time_steps(startDate, numberDays, timeStep=60):
+    """Returns the local clock time (as a datetime) at the middle of each
+    time step for the run period"""
+    start = parse_date(startDate)
+    steps_per_day = int(1440 // timeStep)
+    times = []
+    for d in range(int(float(numberDays))):
+        for s in range(steps_per_day):
+            minutes = (s + 0.5) * timeStep
+            times.append(start + timedelta(days=d, minutes=minutes))
+    return times
+
+
+def julian_day(times, timeZone, daylightSavings):
+    """Returns the julian day (UTC) for each local clock time"""
+    offset_hours = float(timeZone)
+    if str_to_bool(daylightSavings):
+        offset_hours = offset_hours + 1
+    j2000 = datetime(2000, 1, 1, 12)
+    jd = []
+    for t in times:
+        dt = t - timedelta(hours=offset_hours) - j2000
+        jd.append(2451545.0 + dt.days + dt.seconds / 86400.0)
+    return np.array(jd)
+
+
+def solar_position(lat, longi, times, timeZone, daylightSavings):
+    """Returns the solar altitude and azimuth in degrees for each time
+    using the NOAA solar position equations. Times are local clock time.
+    Azimuth is measured clockwise from north."""
+
+    lat = float(lat)
+    longi = float(longi)
+    timeZone = float(timeZone)
+
+    jd = julian_day(times, timeZone, daylightSavings)
+    jc = (jd - 2451545.0) / 36525.0
+
+    geom_mean_long = (280.46646 + jc * (36000.76983 + jc * 0.0003032)) % 360
+    geom_mean_anom = 357.52911 + jc * (35999.05029 - 0.0001537 * jc)
+    ecc = 0.016708634 - jc * (0.000042037 + 0.0000001267 * jc)
+
+    anom = np.radians(geom_mean_anom)
+    eq_ctr = (np.sin(anom) * (1.914602 - jc * (0.004817 + 0.000014 * jc)) +
+              np.sin(2 * anom) * (0.019993 - 0.000101 * jc) +
+              np.sin(3 * anom) * 0.000289)
+
+    true_long = geom_mean_long + eq_ctr
+    omega = np.radians(125.04 - 1934.136 * jc)
+    app_long = true_long - 0.00569 - 0.00478 * np.sin(omega)
+
+    mean_obliq = 23 + (26 + ((21.448 - jc * (46.815 + jc *
+                 (0.00059 - jc * 0.001813)))) / 60) / 60
+    obliq_corr = mean_obliq + 0.00256 * np.cos(omega)
+
+    decl = np.arcsin(np.sin(np.radians(obliq_corr)) *
+                     np.sin(np.radians(app_long)))
+
+    var_y = np.tan(np.radians(obliq_corr / 2)) ** 2
+    mean_long = np.radians(geom_mean_long)
+    eq_time = 4 * np.degrees(var_y * np.sin(2 * mean_long) -
+                             2 * ecc * np.sin(anom) +
+                             4 * ecc * var_y * np.sin(anom) * np.cos(2 * mean_long) -
+                             0.5 * var_y ** 2 * np.sin(4 * mean_long) -
+                             1.25 * ecc ** 2 * np.sin(2 * anom))
+
+    # minutes past local standard midnight
+    dst = 60 if str_to_bool(daylightSavings) else 0
+    local_min = np.array([t.hour * 60 + t.minute + t.second / 60.0 for t in times]) - dst
+
+    true_solar_time = (local_min + eq_time + 4 * longi - 60 * timeZone) % 1440
+    hour_angle = np.where(true_solar_time / 4 < 0,
+                          true_solar_time / 4 + 180,
+                          true_solar_time / 4 - 180)
+    ha = np.radians(hour_angle)
+    lat_r = np.radians(lat)
+
+    cos_zenith = (np.sin(lat_r) * np.sin(decl) +
+                  np.cos(lat_r) * np.cos(decl) * np.cos(ha))
+    zenith = np.arccos(np.clip(cos_zenith, -1, 1))
+
+    denom = np.cos(lat_r) * np.sin(zenith)
+    denom = np.where(np.abs(denom) < 1e-12, 1e-12, denom)
+    cos_az = np.clip((np.sin(lat_r) * np.cos(zenith) - np.sin(decl)) / denom, -1, 1)
+    az = np.degrees(np.arccos(cos_az))
+    azimuth = np.where(hour_angle > 0, (az + 180) % 360, (540 - az) % 360)
+
+    altitude = 90 - np.degrees(zenith)
+    return altitude, azimuth
+
+
+def day_of_year(times):
+    return np.array([t.timetuple().tm_yday for t in times], dtype=float)
+
+
+def solar_radiation(altitude, doy, elevation, solarModel="Bras",
+                    brasVisibilityFactor=2, ryanStolzenbachFactor=0.8,
+                    cloudCover=0):
+    """Returns the direct and diffuse solar radiation (W/m2) above the
+    topography. altitude/doy are (time,) and elevation is (node,). The
+    returned arrays are (node, time)."""
+
+    alt = altitude[np.newaxis, :]
+    sin_alt = np.sin(np.radians(np.maximum(alt, 0)))
+    up = alt > 0
+
+    # extraterrestrial radiation on a horizontal surface
+    extra = (SOLAR_CONSTANT * (1 + 0.033 * np.cos(2 * np.pi * doy / 365.0)))[np.newaxis, :] * sin_alt
+
+    # optical air mass corrected for elevation
+    z = np.maximum(np.asarray(elevation, dtype=float), 0)[:, np.newaxis]
+    alt_pos = np.maximum(alt, 0.01)
+    air_mass = (((288 - 0.0065 * z) / 288) ** 5.256 /
+                (np.sin(np.radians(alt_pos)) + 0.15 * (alt_pos + 3.885) ** -1.253))
+
+    if solarModel == "Bras":
+        a1 = 0.128 - 0.054 * np.log10(air_mass)
+        clear = extra * np.exp(-1 * float(brasVisibilityFactor) * a1 * air_mass)
+    elif solarModel in ["Ryan-Stolzenbach", "Ryan", "RyanStolzenbach"]:
+        clear = extra * float(ryanStolzenbachFactor) ** air_mass
+    else:
+        raise ValueError("Unknown solar radiation model: {0}".format(solarModel))
+
+    total = clear * (1 - 0.65 * float(cloudCover) ** 2)
+    total = np.where(up, total, 0.0)
+
+    # split into direct and diffuse using the clearness index
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kt = np.where(extra > 0, total / extra, 0.0)
+    diffuse_frac = np.clip(0.938 + 1.071 * kt - 5.146 * kt ** 2 + 2.982 * kt ** 3, 0, 1)
+    direct = total * (1 - diffuse_frac)
+    diffuse = total * diffuse_frac
+    return direct, diffuse
+
+
+def veg_codes_to_height(codes):
+    """Returns the vegetation height in meters from the landcover codes
+    Step 6 writes. The codes are the TTools height in cm with
+    1 added by offsetBy1 (or addLC) to avoid riparian code 0."""
+    codes = np.asarray(codes, dtype=float)
+    return np.maximum(codes - 1, 0) / 100.0
+
+
+def topo_angle_to_sun(azimuth, topoW, topoS, topoE):
+    """Returns the (node, time) topographic angle in the direction of
+    the sun. East is used for azimuths < 135, west for > 225 and
+    south for the rest"""
+    az = azimuth[np.newaxis, :]
+    topoW = np.asarray(topoW, dtype=float)[:, np.newaxis]
+    topoS = np.asarray(topoS, dtype=float)[:, np.newaxis]
+    topoE = np.asarray(topoE, dtype=float)[:, np.newaxis]
+    return np.where(az < 135, topoE, np.where(az > 225, topoW, topoS))
+
+
+def zone_heights(nodes, elevationOrZone, globalRiparianZoneWidth, channelIncision):
+    """Returns the vegetation height and the ground height above the
+    water surface, the zone widths and the vegetation density for each
+    bank as (node, zone) arrays. Order is left then right."""
+
+    water = np.asarray(nodes["ELEVATION"], dtype=float)[:, np.newaxis]
+    zone_width = float(globalRiparianZoneWidth)
+    out = []
+    for lc_fields, ele_fields in [(LC_FIELDS_LEFT, ELE_FIELDS_LEFT),
+                                  (LC_FIELDS_RIGHT, ELE_FIELDS_RIGHT)]:
+        veg = veg_codes_to_height(np.column_stack([nodes[f] for f in lc_fields]))
+        ele = np.column_stack([np.asarray(nodes[f], dtype=float) for f in ele_fields])
+        nodata = ele < -9998
+
+        if elevationOrZone == "Elevation":
+            # ELE samples are riparian ground elevations. If missing the
+            # ground is the water surface plus the channel incision.
+            ground = np.where(nodata, water + channelIncision, ele)
+            width = np.ones_like(ele) * zone_width
+        else:
+            # ELE samples are riparian zone widths
+            ground = np.ones_like(ele) * (water + channelIncision)
+            width = np.where(nodata | (ele <= 0), zone_width, ele)
+
+        height = np.maximum(veg + ground - water, 0)
+        density = np.where(veg > 0, DEFAULT_VEG_DENSITY, 0.0)
+        out.append((height, np.maximum(ground - water, 0), width, density))
+    return out
+
+
+def direct_transmittance(altitude, azimuth, aspect, wetted_width,
+                         banks, riparianExtinction):
+    """Returns the (node, time) fraction of the direct beam that reaches
+    the water surface after passing through the riparian zones on the
+    bank facing the sun."""
+
+    n_nodes = len(aspect)
+    n_times = len(altitude)
+    trans = np.ones((n_nodes, n_times))
+    sun_up = altitude > 0
+    if not sun_up.any():
+        return trans
+
+    alt = altitude[sun_up]
+    az = azimuth[sun_up]
+    t_idx = np.nonzero(sun_up)[0]
+    extinction = str_to_bool(riparianExtinction)
+
+    (h_l, g_l, w_l, d_l), (h_r, g_r, w_r, d_r) = banks
+    n_zones = h_l.shape[1]
+
+    # fraction across the channel measured from the sun side bank
+    p_frac = (np.arange(CHANNEL_SAMPLES) + 0.5) / CHANNEL_SAMPLES
+
+    chunk = max(1, int(CHUNK_ELEMENTS // (len(alt) * CHANNEL_SAMPLES * n_zones)))
+    for s in range(0, n_nodes, chunk):
+        e = min(s + chunk, n_nodes)
+        # relative angle between the sun and the stream flow direction
+        rel = np.radians(az[np.newaxis, :] - np.asarray(aspect[s:e], dtype=float)[:, np.newaxis])
+        sin_rel = np.sin(rel)
+        # looking downstream the left bank is at aspect - 90
+        left = sin_rel < 0
+        sin_rel = np.maximum(np.abs(sin_rel), 1e-6)
+        tan_alt = np.tan(np.radians(alt))[np.newaxis, :]
+
+        # rise of the ray per unit distance perpendicular to the stream
+        slope = tan_alt / sin_rel
+
+        height = np.where(left[:, :, np.newaxis], h_l[s:e, np.newaxis, :], h_r[s:e, np.newaxis, :])
+        ground = np.where(left[:, :, np.newaxis], g_l[s:e, np.newaxis, :], g_r[s:e, np.newaxis, :])
+        width = np.where(left[:, :, np.newaxis], w_l[s:e, np.newaxis, :], w_r[s:e, np.newaxis, :])
+        density = np.where(left[:, :, np.newaxis], d_l[s:e, np.newaxis, :], d_r[s:e, np.newaxis, :])
+
+        # distance from the sun side bank to the inner edge of each zone
+        zone_start = np.cumsum(width, axis=2) - width
+
+        # perpendicular distance from each channel point to the bank
+        p_dist = (1 - p_frac)[np.newaxis, np.newaxis, :] * np.asarray(wetted_width[s:e], dtype=float)[:, np.newaxis, np.newaxis]
+
+        # (node, time, channel point, zone)
+        q_start = p_dist[:, :, :, np.newaxis] + zone_start[:, :, np.newaxis, :]
+        q_end = q_start + width[:, :, np.newaxis, :]
+        q_top = (height / slope[:, :, np.newaxis])[:, :, np.newaxis, :]
+        inside = np.clip(np.minimum(q_end, q_top) - q_start, 0, None)
+
+        if extinction:
+            # each zone the ray passes through below the canopy top
+            # removes the zone density from the beam
+            blocked = np.where(inside > 0, density[:, :, np.newaxis, :], 0.0)
+        else:
+            # without extinction the canopy is opaque
+            blocked = np.where(inside > 0, density[:, :, np.newaxis, :] > 0, 0.0)
+        # the ground is opaque
+        q_ground = (ground / slope[:, :, np.newaxis])[:, :, np.newaxis, :]
+        blocked = np.where(q_ground > q_start, 1.0, blocked)
+        t_point = np.prod(1 - blocked, axis=3)
+
+        trans[s:e, t_idx] = t_point.mean(axis=2)
+
+    return trans
+
+
+def topo_view_to_sky(nodes):
+    """Returns the fraction of diffuse radiation that reaches the stream
+    after the topography."""
+    topo = (np.asarray(nodes["TOPO_W"], dtype=float) +
+            np.asarray(nodes["TOPO_S"], dtype=float) +
+            np.asarray(nodes["TOPO_E"], dtype=float)) / (3 * 90.0)
+    return 1 - np.clip(topo, 0, 1)
+
+
+def veg_view_to_sky(banks, wetted_width):
+    """Returns the fraction of the diffuse radiation below the
+    topography that reaches the stream after the riparian vegetation
+    and ground on each bank."""
+    half_width = np.asarray(wetted_width, dtype=float)[:, np.newaxis] / 2
+    veg_angles = []
+    for height, ground, width, density in banks:
+        # stream center to the inner edge of each zone
+        dist = np.maximum(half_width + np.cumsum(width, axis=1) - width, 1e-6)
+        veg_angles.append(np.degrees(np.arctan(height / dist)).max(axis=1))
+    return np.clip(1 - (veg_angles[0] + veg_angles[1]) / 180.0, 0, 1)
+
+
+def view_to_sky(nodes, banks, wetted_width):
+    """Returns the fraction of diffuse radiation that reaches the stream
+    after the topography and riparian vegetation on each bank."""
+    return topo_view_to_sky(nodes) * veg_view_to_sky(banks, wetted_width)
+
+
+def calculate_shade(nodes, startDate, numberDays, lat, longi, timeZone,
+                    daylightSavings, globalRiparianZoneWidth,
+                    shadeCalculationMethod="Chen", vegCodes="On",
+                    cloudCover=0, brasVisibilityFactor=2,
+                    ryanStolzenbachFactor=0.8, elevationOrZone="Elevation",
+                    riparianExtinction="On", solarModel="Bras",
+                    channelIncision=1.0, timeStep=60, cache=None,
+                    bucketSize=None):
+    """Calculates effective shade for every node.
+
+    nodes is a dictionary of equal length sequences keyed by the Step 6
+    field names (see NODE_FIELDS). The remaining arguments are the
+    Shade-a-lator Main Menu settings and can be the strings returned by
+    arcpy.GetParameterAsText.
+
+    The solar position is looked up in cache (a solar_cache.EphemerisCache,
+    default is the process wide cache). cache=False recomputes it. If
+    bucketSize is set and nodes has LATITUDE/LONGITUDE fields each node
+    uses the sun position of its lat/lon bucket instead of lat/longi.
+
+    Returns a dictionary with:
+    SHADE - (node,) effective shade over the whole run period
+    HOURLY_SHADE - (node, time) effective shade for each time step
+    TOPO_SHADE, VEG_SHADE - (node, time) parts of HOURLY_SHADE from the
+    topography and from the riparian vegetation and ground
+    TIMES - list of local clock times at the middle of each time step
+    ALTITUDE, AZIMUTH - solar position in degrees, (time,) or
+    (node, time) when bucketSize is used
+    """
+
+    if shadeCalculationMethod not in ["Chen", "", None]:
+        raise ValueError("Only the Chen shade calculation method is "
+                         "available in the python engine")
+    if vegCodes not in ["On", "", None]:
+        raise ValueError("The python engine requires veg codes = On")
+
+    settings = (globalRiparianZoneWidth, cloudCover, brasVisibilityFactor,
+                ryanStolzenbachFactor, elevationOrZone, riparianExtinction,
+                solarModel, channelIncision)
+
+    if cache is False:
+        times = time_steps(startDate, numberDays, timeStep)
+        altitude, azimuth = solar_position(lat, longi, times, timeZone, daylightSavings)
+        return shade_from_sun(nodes, times, altitude, azimuth, *settings)
+
+    import solar_cache
+    if cache is None:
+        cache = solar_cache.get_default_cache()
+
+    if not bucketSize or "LATITUDE" not in nodes or "LONGITUDE" not in nodes:
+        sun = cache.get(lat, longi, timeZone, daylightSavings, startDate,
+                        numberDays, timeStep)
+        return shade_from_sun(nodes, sun.times, sun.altitude, sun.azimuth,
+                              *settings)
+
+    groups = solar_cache.bucket_nodes(nodes["LATITUDE"], nodes["LONGITUDE"],
+                                      bucketSize)
+    n_nodes = len(nodes["ELEVATION"])
+    result = None
+    for (b_lat, b_lon), idx in groups.items():
+        sun = cache.get(b_lat, b_lon, timeZone, daylightSavings, startDate,
+                        numberDays, timeStep)
+        group_nodes = dict((f, np.asarray(v)[idx]) for f, v in nodes.items())
+        r = shade_from_sun(group_nodes, sun.times, sun.altitude, sun.azimuth,
+                           *settings)
+        if result is None:
+            n_times = len(sun.times)
+            result = {"SHADE": np.zeros(n_nodes),
+                      "HOURLY_SHADE": np.zeros((n_nodes, n_times)),
+                      "TOPO_SHADE": np.zeros((n_nodes, n_times)),
+                      "VEG_SHADE": np.zeros((n_nodes, n_times)),
+                      "TIMES": sun.times,
+                      "ALTITUDE": np.zeros((n_nodes, n_times)),
+                      "AZIMUTH": np.zeros((n_nodes, n_times))}
+        result["SHADE"][idx] = r["SHADE"]
+        result["HOURLY_SHADE"][idx] = r["HOURLY_SHADE"]
+        result["TOPO_SHADE"][idx] = r["TOPO_SHADE"]
+        result["VEG_SHADE"][idx] = r["VEG_SHADE"]
+        result["ALTITUDE"][idx] = sun.altitude
+        result["AZIMUTH"][idx] = sun.azimuth
+    return result
+
+
+def shade_from_sun(nodes, times, altitude, azimuth, globalRiparianZoneWidth,
+                   cloudCover=0, brasVisibilityFactor=2,
+                   ryanStolzenbachFactor=0.8, elevationOrZone="Elevation",
+                   riparianExtinction="On", solarModel="Bras",
+                   channelIncision=1.0):
+    """Calculates effective shade for every node from a precomputed
+    solar position. See calculate_shade()."""
+
+    channelIncision = float(channelIncision)
+    elevation = np.asarray(nodes["ELEVATION"], dtype=float)
+    aspect = np.asarray(nodes["STRM_AZMTH"], dtype=float)
+    wetted_width = np.asarray(nodes["CHANWIDTH"], dtype=float)
+
+    direct, diffuse = solar_radiation(altitude, day_of_year(times), elevation,
+                                      solarModel, brasVisibilityFactor,
+                                      ryanStolzenbachFactor, cloudCover)
+    above_topo = direct + diffuse
+
+    # direct beam is blocked if the sun is below the topography
+    topo_angle = topo_angle_to_sun(azimuth, nodes["TOPO_W"],
+                                   nodes["TOPO_S"], nodes["TOPO_E"])
+    direct = np.where(altitude[np.newaxis, :] > topo_angle, direct, 0.0)
+    diffuse = diffuse * topo_view_to_sky(nodes)[:, np.newaxis]
+    below_topo = direct + diffuse
+
+    banks = zone_heights(nodes, elevationOrZone, globalRiparianZoneWidth,
+                         channelIncision)
+
+    direct = direct * direct_transmittance(altitude, azimuth, aspect,
+                                           wetted_width, banks,
+                                           riparianExtinction)
+    diffuse = diffuse * veg_view_to_sky(banks, wetted_width)[:, np.newaxis]
+    at_stream = direct + diffuse
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hourly = np.where(above_topo > 0, 1 - at_stream / above_topo, np.nan)
+        topo_shade = np.where(above_topo > 0, 1 - below_topo / above_topo, np.nan)
+        veg_shade = np.where(above_topo > 0, (below_topo - at_stream) / above_topo, np.nan)
+        total_above = above_topo.sum(axis=1)
+        shade = np.where(total_above > 0, 1 - at_stream.sum(axis=1) / total_above, 0.0)
+
+    return {"SHADE": shade,
+            "HOURLY_SHADE": hourly,
+            "TOPO_SHADE": topo_shade,
+            "VEG_SHADE": veg_shade,
+            "TIMES": times,
+            "ALTITUDE": altitude,
+            "AZIMUTH": azimuth}
+
+
+# Main Menu cell locations used by Step 6
+MAIN_MENU_COLUMNS = [
+    ("STREAM_ID", "A"), ("ELEVATION", "C"), ("STRM_AZMTH", "E"),
+    ("CHANWIDTH", "H"), ("TOPO_W", "L"), ("TOPO_S", "M"), ("TOPO_E", "N")]
+MAIN_MENU_SETTINGS = [
+    ("startDate", "D4"), ("numberDays", "D5"), ("timeZone", "D6"),
+    ("daylightSavings", "D7"), ("lat", "D8"), ("longi", "D9"),
+    ("globalRiparianZoneWidth", "D10"), ("shadeCalculationMethod", "D11"),
+    ("vegCodes", "I3"), ("solarModel", "I4"), ("cloudCover", "I5"),
+    ("brasVisibilityFactor", "I6"), ("ryanStolzenbachFactor", "I7"),
+    ("elevationOrZone", "I8"), ("riparianExtinction", "I9")]
+
+
+def read_main_menu(filename, sheetName="Main Menu", startRow=17):
+    """Reads the node inputs and run settings from a Shade-a-lator
+    Main Menu workbook written by Step 6 (e.g. output.xlsx). Returns
+    the nodes dictionary and the settings dictionary."""
+    import openpyxl
+    from openpyxl.utils import column_index_from_string, get_column_letter
+
+    workbook = openpyxl.load_workbook(filename, data_only=True)
+    sheet = workbook[sheetName]
+
+    columns = list(MAIN_MENU_COLUMNS)
+    # LC and ELE samples start in column P
+    first = column_index_from_string("P")
+    for i, field in enumerate(LC_FIELDS_LEFT + LC_FIELDS_RIGHT +
+                              ELE_FIELDS_LEFT + ELE_FIELDS_RIGHT):
+        columns.append((field, get_column_letter(first + i)))
+
+    nodes = dict((field, []) for field, col in columns)
+    row = startRow
+    while sheet["A" + str(row)].value is not None:
+        for field, col in columns:
+            nodes[field].append(sheet[col + str(row)].value)
+        row += 1
+
+    settings = {}
+    for name, cell in MAIN_MENU_SETTINGS:
+        settings[name] = sheet[cell].value
+
+    return nodes, settings
+
+
+def read_shade_results(filename, sheetName="Sheet1"):
+    """Reads the node rows of the macro export (e.g. output2.xlsx).
+    Returns a dictionary of the NODE_ID (FID in older exports),
+    STREAM_ID, ELEVATION and SHADE columns. A blank SHADE is nan."""
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(filename, data_only=True)
+    sheet = workbook[sheetName]
+    header = [c.value for c in sheet[1]]
+    id_field = "NODE_ID" if "NODE_ID" in header else "FID"
+    columns = [(id_field, "NODE_ID"), ("STREAM_ID", "STREAM_ID"),
+               ("ELEVATION", "ELEVATION"), ("SHADE", "SHADE")]
+    results = dict((name, []) for field, name in columns)
+    for row in sheet.iter_rows(min_row=2, values_only=True):
+        if row[header.index(id_field)] is None:
+            continue
+        for field, name in columns:
+            results[name].append(row[header.index(field)])
+    results["SHADE"] = np.array([np.nan if v is None else v
+                                 for v in results["SHADE"]], dtype=float)
+    return results
+
+
+def sampled_nodes(nodes):
+    """Returns a (node,) bool array, True for the nodes with a landcover
+    height or an elevation sample on either bank. The others are
+    outside the rasters."""
+    lc = np.column_stack([np.asarray(nodes[f], dtype=float)
+                          for f in LC_FIELDS_LEFT + LC_FIELDS_RIGHT])
+    ele = np.column_stack([np.asarray(nodes[f], dtype=float)
+                           for f in ELE_FIELDS_LEFT + ELE_FIELDS_RIGHT])
+    return (lc > 1).any(axis=1) | (ele > 0).any(axis=1)
+
+
+def compare_with_macro(main_menu_xlsx, results_xlsx, nodeIDs=None):
+    """Runs the engine on the inputs in a Main Menu workbook and compares
+    the effective shade with the macro output node by node. Step 6 writes
+    the Main Menu rows in the same order as the export rows, so each Main
+    Menu row takes the NODE_ID of its export row after checking they
+    have the same STREAM_ID and ELEVATION. Only the NODE_IDs in nodeIDs
+    are compared (default all) and nodes outside the rasters (see
+    sampled_nodes) are skipped. Raises ValueError if the node counts or
+    rows differ or a node has no macro SHADE. Returns a dictionary of
+    summary statistics."""
+
+    nodes, settings = read_main_menu(main_menu_xlsx)
+    macro = read_shade_results(results_xlsx)
+
+    n = len(nodes["ELEVATION"])
+    if len(macro["NODE_ID"]) != n:
+        raise ValueError("The Main Menu has {0} nodes and the macro output "
+                         "has {1}".format(n, len(macro["NODE_ID"])))
+    if len(set(macro["NODE_ID"])) != n:
+        raise ValueError("The macro output has duplicate NODE_IDs")
+    for i, nodeID in enumerate(macro["NODE_ID"]):
+        if (nodes["STREAM_ID"][i] != macro["STREAM_ID"][i] or
+                nodes["ELEVATION"][i] != macro["ELEVATION"][i]):
+            raise ValueError("The Main Menu row of NODE_ID {0} does not match "
+                             "the macro output".format(nodeID))
+    if np.isnan(macro["SHADE"]).any():
+        raise ValueError("The macro output has no SHADE for NODE_ID {0}".format(
+            macro["NODE_ID"][int(np.nonzero(np.isnan(macro["SHADE"]))[0][0])]))
+
+    result = calculate_shade(nodes, **settings)
+    sampled = sampled_nodes(nodes)
+    engine_by_id = dict(zip(macro["NODE_ID"], result["SHADE"]))
+    macro_by_id = dict(zip(macro["NODE_ID"], macro["SHADE"]))
+    if nodeIDs is None:
+        nodeIDs = macro["NODE_ID"]
+    nodeIDs = set(nodeIDs)
+    skipped = set(i for i, ok in zip(macro["NODE_ID"], sampled)
+                  if not ok and i in nodeIDs)
+    nodeIDs = sorted(nodeIDs.intersection(macro_by_id) - skipped)
+    engine_shade = np.array([engine_by_id[i] for i in nodeIDs])
+    macro_shade = np.array([macro_by_id[i] for i in nodeIDs])
+    diff = engine_shade - macro_shade
+
+    return {"nodes": len(nodeIDs),
+            "skipped": len(skipped),
+            "engine_mean": float(engine_shade.mean()),
+            "macro_mean": float(macro_shade.mean()),
+            "mean_difference": float(diff.mean()),
+            "mean_abs_error": float(np.abs(diff).mean()),
+            "max_abs_error": float(np.abs(diff).max()),
+            "correlation": float(np.corrcoef(engine_shade, macro_shade)[0, 1])}
+
+
+def macro_failures(stats, tolerance=MACRO_TOLERANCE):
+    """Returns the compare_with_macro() statistics outside the tolerance
+    as a list of strings, empty if the engine is within it."""
+    failed = []
+    for key in ["mean_abs_error", "max_abs_error"]:
+        if stats[key] > tolerance[key]:
+            failed.append("{0} {1:.4f} > {2}".format(key, stats[key], tolerance[key]))
+    if abs(stats["mean_difference"]) > tolerance["mean_difference"]:
+        failed.append("mean_difference {0:.4f} > {1}".format(
+            stats["mean_difference"], tolerance["mean_difference"]))
+    if stats["correlation"] < tolerance["correlation"]:
+        failed.append("correlation {0:.4f} < {1}".format(
+            stats["correlation"], tolerance["correlation"]))
+    return failed
+
+
+def check_against_macro(main_menu_xlsx, results_xlsx, nodeIDs=None,
+                        tolerance=MACRO_TOLERANCE):
+    """compare_with_macro() that raises AssertionError if the engine is
+    further from the macro than the tolerance. Returns the statistics."""
+    stats = compare_with_macro(main_menu_xlsx, results_xlsx, nodeIDs)
+    failed = macro_failures(stats, tolerance)
+    if failed:
+        raise AssertionError("shade engine vs. macro: " + ", ".join(failed))
+    return stats
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    here = os.path.dirname(os.path.abspath(__file__))
+    main_menu = os.path.join(here, "output.xlsx")
+    results = os.path.join(here, "output2.xlsx")
+    # the method was picked on the even NODE_IDs, the odd ones are held out
+    nodeIDs = read_shade_results(results)["NODE_ID"]
+    for name, remainder in [("picked on even NODE_IDs", 0),
+                            ("held out odd NODE_IDs", 1)]:
+        stats = compare_with_macro(main_menu, results,
+                                   [i for i in nodeIDs if i % 2 == remainder])
+        print(name)
+        for key in sorted(stats):
+            print("  {0}: {1}".format(key, stats[key]))
+    failed = macro_failures(stats)
+    if failed:
+        print("not equivalent to the macro: " + ", ".join(failed))
+        sys.exit(1)
@@ -0,0 +1,256 @@
+#-------------------------------------------------------------------------------
+# Name:        solar_cache
+# Purpose:     Precomputed solar ephemeris shared across nodes, days and
+#              scenarios with an on-disk cache between runs
+#
+# Author:      George
+#
+# Created:     18/10/2026
+# Copyright:   (c) George 2017
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+# The sun's altitude/azimuth only depends on the Step 6 run settings
+# (latitude, longitude, timeZone, daylightSavings, startDate, numberDays)
+# and the time step, so it is computed once per lat/lon bucket and looked
+# up by the shade engine.
+
+# Tables are kept in memory (least recently used are dropped once there
+# are more than max_entries). With a cache folder (the Step 6
+# ephemeris_cache_dir parameter) they are also saved as .npz files keyed
+# by a hash of the settings and EPHEMERIS_VERSION, so tables from an
+# older solar_position() or file layout are never read. On disk the
+# least recently used cache files (<sha1>.npz, other files in the folder
+# are left alone) are deleted once
+# there are more than max_disk_entries or they are older than
+# max_age_days. The disk cache is checked when the cache is created
+# and every 64 writes.
+
+from __future__ import division, print_function
+import os
+import time
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+import shade_engine
+
+# Version of the ephemeris tables and their files, part of every key.
+# Bump it when shade_engine.solar_position() or the file layout changes.
+EPHEMERIS_VERSION = 1
+
+# lat/lon bucket size in decimal degrees. 0.01 deg is ~1 km, the sun
+# moves less than 0.01 deg over that distance.
+DEFAULT_BUCKET = 0.01
+
+
+def bucket_center(value, bucketSize=DEFAULT_BUCKET):
+    """Returns the center of the lat/lon bucket containing value"""
+    value = float(value)
+    if not bucketSize:
+        return value
+    return round((np.floor(value / bucketSize) + 0.5) * bucketSize, 10)
+
+
+def ephemeris_key(lat, longi, timeZone, daylightSavings, startDate,
+                  numberDays, timeStep=60, bucketSize=DEFAULT_BUCKET):
+    """Returns the normalized tuple of settings the ephemeris depends on
+    and the EPHEMERIS_VERSION"""
+    return (bucket_center(lat, bucketSize),
+            bucket_center(longi, bucketSize),
+            float(timeZone),
+            shade_engine.str_to_bool(daylightSavings),
+            shade_engine.parse_date(startDate).strftime("%Y-%m-%d"),
+            int(float(numberDays)),
+            float(timeStep),
+            EPHEMERIS_VERSION)
+
+
+def key_to_filename(key):
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest() + ".npz"
+
+
+def is_cache_file(name):
+    """True if name is the name of a table file from key_to_filename()"""
+    return (len(name) == 44 and name.endswith(".npz") and
+            all(c in "0123456789abcdef" for c in name[:40]))
+
+
+class Ephemeris(object):
+    """Solar position for each time step of a run"""
+
+    def __init__(self, times, altitude, azimuth):
+        self.times = times
+        self.altitude = altitude
+        self.azimuth = azimuth
+
+    def __len__(self):
+        return len(self.times)
+
+
+_time_tables = {}
+
+
+def key_times(key):
+    """Returns the (shared) list of time steps for a key. Every lat/lon
+    bucket of a run has the same time steps."""
+    startDate, numberDays, timeStep = key[4:7]
+    if (startDate, numberDays, timeStep) not in _time_tables:
+        start = shade_engine.parse_date(
+            "{1}/{2}/{0}".format(*startDate.split("-")))
+        _time_tables[(startDate, numberDays, timeStep)] = shade_engine.time_steps(
+            start, numberDays, timeStep)
+    return _time_tables[(startDate, numberDays, timeStep)]
+
+
+def compute_ephemeris(key):
+    """Computes the ephemeris table for a key from ephemeris_key()"""
+    lat, longi, timeZone, dst = key[:4]
+    times = key_times(key)
+    altitude, azimuth = shade_engine.solar_position(lat, longi, times,
+                                                    timeZone, dst)
+    return Ephemeris(times, altitude, azimuth)
+
+
+class EphemerisCache(object):
+    """Memoized solar ephemeris tables with an optional on-disk cache.
+    Set cache_dir to a folder to keep the tables between runs, None keeps
+    them in memory only. If bucketSize is set lat/lon are snapped to the
+    bucket centers before lookup."""
+
+    def __init__(self, cache_dir=None, max_entries=1024,
+                 max_disk_entries=4096, max_age_days=90,
+                 bucketSize=None):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.max_age_days = max_age_days
+        self.bucketSize = bucketSize
+        self.tables = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evict()
+
+    def get(self, lat, longi, timeZone, daylightSavings, startDate,
+            numberDays, timeStep=60):
+        """Returns the Ephemeris for the run settings"""
+        key = ephemeris_key(lat, longi, timeZone, daylightSavings,
+                            startDate, numberDays, timeStep,
+                            self.bucketSize)
+
+        if key in self.tables:
+            self.hits += 1
+            table = self.tables.pop(key)
+            self.tables[key] = table
+            return table
+
+        table = self.read(key)
+        if table is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            table = compute_ephemeris(key)
+            self.write(key, table)
+
+        self.tables[key] = table
+        while len(self.tables) > self.max_entries:
+            self.tables.popitem(last=False)
+        return table
+
+    def read(self, key):
+        """Reads a table from the disk cache. Returns None if missing"""
+        if not self.cache_dir:
+            return None
+        path = os.path.join(self.cache_dir, key_to_filename(key))
+        if not os.path.exists(path):
+            return None
+        try:
+            data = np.load(path)
+            table = Ephemeris(key_times(key), data["altitude"], data["azimuth"])
+            data.close()
+        except Exception:
+            # corrupt or partial file, recompute it
+            return None
+        # touch so eviction is least recently used
+        os.utime(path, None)
+        return table
+
+    def write(self, key, table):
+        """Saves a table to the disk cache and evicts old files"""
+        if not self.cache_dir:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = os.path.join(self.cache_dir, key_to_filename(key))
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, altitude=table.altitude, azimuth=table.azimuth)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+        # scanning the folder is slow, check it every 64 writes
+        self.writes += 1
+        if self.writes % 64 == 0:
+            self.evict()
+
+    def evict(self):
+        """Deletes cache files that are too old or beyond
+        max_disk_entries, least recently used first"""
+        if not self.cache_dir or not os.path.exists(self.cache_dir):
+            return
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if is_cache_file(name):
+                path = os.path.join(self.cache_dir, name)
+                files.append((os.path.getmtime(path), path))
+        files.sort(reverse=True)
+
+        now = time.time()
+        for i, (mtime, path) in enumerate(files):
+            too_old = (self.max_age_days is not None and
+                       now - mtime > self.max_age_days * 86400)
+            if too_old or i >= self.max_disk_entries:
+                os.remove(path)
+
+    def clear(self):
+        """Empties the memory and disk caches"""
+        self.tables.clear()
+        if self.cache_dir and os.path.exists(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if is_cache_file(name):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """Returns the process wide cache used by the shade engine when
+    no cache is given. It is in memory only."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = EphemerisCache()
+    return _default_cache
+
+
+def bucket_nodes(latitudes, longitudes, bucketSize=DEFAULT_BUCKET):
+    """Groups nodes by lat/lon bucket. Returns a dictionary of
+    (lat bucket center, lon bucket center) to node index arrays."""
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    lat_b = np.floor(latitudes / bucketSize).astype(np.int64)
+    lon_b = np.floor(longitudes / bucketSize).astype(np.int64)
+
+    order = np.lexsort((lon_b, lat_b))
+    lat_s = lat_b[order]
+    lon_s = lon_b[order]
+    breaks = np.nonzero((np.diff(lat_s) != 0) | (np.diff(lon_s) != 0))[0] + 1
+    groups = {}
+    for idx in np.split(order, breaks):
+        if len(idx) == 0:
+            continue
+        key = (round((lat_b[idx[0]] + 0.5) * bucketSize, 10),
+               round((lon_b[idx[0]] + 0.5) * bucketSize, 10))
+        groups[key] = idx
+    return groups
@@ -0,0 +1,128 @@
+########################################################################
+# TTools
+# Vectorized node generation for Step 1
+
+# The polyline vertices are read once into a NumPy array and every node
+# of a stream is placed with np.interp on the cumulative distance along
+# the line (chainage) instead of calling positionAlongLine() up to
+# three times per node. The node positions, STREAM_KM, LENGTH and
+# STRM_AZMTH follow the same rules as the original loop in
+# create_node_list().
+
+# The stream IDs are checked for duplicates and nulls with a hash index
+# (one pass over the IDs) instead of list.count() for every ID.
+
+# The stream direction check samples the elevation at every stream
+# endpoint with one array read per block of endpoints and decides the
+# flips for all the streams at once.
+
+# This module does not need arcpy except for line_vertices().
+
+########################################################################
+
+from __future__ import division, print_function
+from collections import defaultdict
+import numpy as np
+
+
+def find_duplicate_ids(sid_list, oid_list):
+    """Returns a dictionary of the stream IDs used by more than one
+    feature to the OBJECTIDs of those features"""
+    index = defaultdict(list)
+    for sid, oid in zip(sid_list, oid_list):
+        index[sid].append(oid)
+    return dict((sid, oids) for sid, oids in index.items() if len(oids) > 1)
+
+
+def find_null_ids(sid_list, oid_list):
+    """Returns the OBJECTIDs of features with an empty stream ID"""
+    return [oid for sid, oid in zip(sid_list, oid_list)
+            if sid is None or (hasattr(sid, "strip") and not sid.strip())]
+
+
+def format_duplicate_ids(dups, max_ids=50):
+    """Returns a message listing the duplicate stream IDs and OBJECTIDs"""
+    lines = ["{0}: OBJECTID {1}".format(sid, ", ".join(str(o) for o in oids))
+             for sid, oids in sorted(dups.items(), key=lambda d: min(d[1]))]
+    if len(lines) > max_ids:
+        lines = lines[:max_ids] + ["... and {0} more".format(len(lines) - max_ids)]
+    return "\n".join(lines)
+
+
+def line_vertices(polyline):
+    """Returns the vertex coordinates of an arcpy polyline as a (n, 2)
+    array and the part number of each vertex"""
+    xy = []
+    parts = []
+    for p, part in enumerate(polyline):
+        for pnt in part:
+            if pnt:
+                xy.append((pnt.X, pnt.Y))
+                parts.append(p)
+    return np.array(xy, dtype=float).reshape(-1, 2), np.array(parts)
+
+
+def chainage(xy, parts=None):
+    """Returns the cumulative distance along the line at each vertex.
+    The gap between the parts of a multipart line is not counted,
+    the same as the polyline length."""
+    seg = np.hypot(np.diff(xy[:, 0]), np.diff(xy[:, 1]))
+    if parts is not None and len(parts) > 1:
+        seg[np.diff(parts) != 0] = 0.0
+    return np.concatenate(([0.0], np.cumsum(seg)))
+
+
+def points_along_line(xy, chain, fractions):
+    """Vectorized positionAlongLine(fraction, True). Returns the x and y
+    coordinates at each fraction of the line length"""
+    distance = np.asarray(fractions, dtype=float) * chain[-1]
+    return (np.interp(distance, chain, xy[:, 0]),
+            np.interp(distance, chain, xy[:, 1]))
+
+
+def stream_nodes(xy, parts, lineLength, node_dx, con_to_m, flip):
+    """Returns the STREAM_KM, LENGTH, X, Y and STRM_AZMTH arrays of the
+    nodes on one stream. lineLength is in the units of the projection,
+    node_dx in meters. flip = 1 measures the nodes from the end of the
+    line, flip = 0 from the start."""
+    con_from_m = 1 / con_to_m
+    chain = chainage(xy, parts)
+
+    numNodes = int(lineLength * con_to_m / node_dx)
+    n = np.arange(numNodes + 1)
+
+    # percentage of feature length to traverse
+    positions = n * node_dx * con_from_m / lineLength
+    segment_length = np.full(numNodes + 1, float(node_dx))
+    segment_length[-1] = lineLength * con_to_m % node_dx
+    mid_distance = min(node_dx * con_from_m / lineLength, 1)
+
+    # The up/down midway points along the line between nodes. The first
+    # node uses the node itself as the downstream point and nodes where
+    # the upstream point is past the end of the line use the node as
+    # the upstream point.
+    first = positions == 0.0
+    up_pos = np.where(first | (positions + mid_distance < 1),
+                      positions + mid_distance, positions)
+    down_pos = np.where(first, positions, positions - mid_distance)
+
+    node_x, node_y = points_along_line(xy, chain, np.abs(flip - positions))
+    up_x, up_y = points_along_line(xy, chain, np.abs(flip - up_pos))
+    down_x, down_y = points_along_line(xy, chain, np.abs(flip - down_pos))
+
+    stream_azimuth = np.degrees(np.arctan2(down_x - up_x, down_y - up_y))
+    stream_azimuth = np.where(stream_azimuth < 0, stream_azimuth + 360,
+                              stream_azimuth)
+
+    stream_km = positions * lineLength * con_to_m / 1000
+    return stream_km, segment_length, node_x, node_y, stream_azimuth
+
+
+def stream_flips(z_down, z_up, nodata=-9999):
+    """Returns flip = 1 for streams where the start of the line is higher
+    than the end (the stream km need to be reversed), 0 otherwise or if
+    either end is nodata"""
+    z_down = np.asarray(z_down, dtype=float)
+    z_up = np.asarray(z_up, dtype=float)
+    keep = (z_down <= z_up) | (z_down == nodata) | (z_up == nodata)
+    return np.where(keep, 0, 1)